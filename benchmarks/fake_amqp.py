@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- python -*-
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in AMQP 0-9-1 broker delivering vCD notifications to the exporter, for benchmarks
+
+It speaks just enough of the protocol for a consumer: connection and channel handshakes, queue
+declaration and binding, and consuming. Messages are only published by the fake vCD API, through
+FakeBroker.publish(), to the queues whose bindings match their routing key. Frames are encoded
+and decoded with pika, which has to be installed.
+"""
+
+import itertools
+
+# Twisted
+from twisted.internet import protocol
+
+# AMQP
+from pika import frame, spec
+
+FRAME_MAX = 131072
+
+
+def _matches(pattern, routing_key):
+    """
+    Whether a routing key matches the pattern of a topic binding, * is one word and # any number of them
+    """
+    def match(words, keys):
+        if not words:
+            return not keys
+        if words[0] == '#':
+            return any(match(words[1:], keys[skip:]) for skip in range(len(keys) + 1))
+        return bool(keys) and words[0] in ('*', keys[0]) and match(words[1:], keys[1:])
+
+    return match(pattern.split('.'), routing_key.split('.'))
+
+
+class FakeBroker(protocol.Factory):
+    """
+    Class for the queues, bindings and consumers of the stand-in broker
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.consumers = []
+        self.names = itertools.count(1)
+        self.published = 0
+
+    def buildProtocol(self, addr):
+        connection = FakeAmqpConnection()
+        connection.broker = self
+        return connection
+
+    def publish(self, exchange, routing_key, body):
+        """
+        Deliver a message to the consumers of the queues bound to the exchange with a matching key
+        """
+        self.published += 1
+        for connection, channel, tag, queue in list(self.consumers):
+            bindings = self.queues.get(queue, [])
+            if any(bound == exchange and _matches(pattern, routing_key) for bound, pattern in bindings):
+                connection.deliver(channel, tag, exchange, routing_key, body)
+
+    def disconnect(self):
+        """
+        Drop every consumer connection, like a broker restart
+        """
+        for connection in set(consumer[0] for consumer in self.consumers):
+            connection.transport.loseConnection()
+
+
+class FakeAmqpConnection(protocol.Protocol):
+    """
+    Class for one client connection of the stand-in broker
+    """
+
+    def connectionMade(self):
+        self.buffer = b''
+        self.deliveries = itertools.count(1)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.broker.consumers = [consumer for consumer in self.broker.consumers if consumer[0] is not self]
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while self.buffer:
+            consumed, received = frame.decode_frame(self.buffer)
+            if not consumed:
+                return
+            self.buffer = self.buffer[consumed:]
+            self.received(received)
+
+    def send(self, channel, method):
+        self.transport.write(frame.Method(channel, method).marshal())
+
+    def deliver(self, channel, tag, exchange, routing_key, body):
+        self.send(channel, spec.Basic.Deliver(consumer_tag=tag, delivery_tag=next(self.deliveries),
+                                              exchange=exchange, routing_key=routing_key))
+        self.transport.write(frame.Header(channel, len(body), spec.BasicProperties()).marshal())
+        self.transport.write(frame.Body(channel, body).marshal())
+
+    def received(self, received):
+        if isinstance(received, frame.ProtocolHeader):
+            self.send(0, spec.Connection.Start(server_properties={'product': 'fake_amqp'},
+                                               mechanisms=b'PLAIN', locales=b'en_US'))
+            return
+        if not isinstance(received, frame.Method):
+            return
+
+        channel, method = received.channel_number, received.method
+        if isinstance(method, spec.Connection.StartOk):
+            self.send(0, spec.Connection.Tune(channel_max=16, frame_max=FRAME_MAX, heartbeat=0))
+        elif isinstance(method, spec.Connection.Open):
+            self.send(0, spec.Connection.OpenOk())
+        elif isinstance(method, spec.Connection.Close):
+            self.send(0, spec.Connection.CloseOk())
+            self.transport.loseConnection()
+        elif isinstance(method, spec.Channel.Open):
+            self.send(channel, spec.Channel.OpenOk())
+        elif isinstance(method, spec.Channel.Close):
+            self.send(channel, spec.Channel.CloseOk())
+        elif isinstance(method, spec.Queue.Declare):
+            queue = method.queue or 'amq.gen-{}'.format(next(self.broker.names))
+            self.broker.queues.setdefault(queue, [])
+            self.send(channel, spec.Queue.DeclareOk(queue=queue, message_count=0, consumer_count=0))
+        elif isinstance(method, spec.Queue.Bind):
+            self.broker.queues.setdefault(method.queue, []).append((method.exchange, method.routing_key))
+            self.send(channel, spec.Queue.BindOk())
+        elif isinstance(method, spec.Basic.Qos):
+            self.send(channel, spec.Basic.QosOk())
+        elif isinstance(method, spec.Basic.Consume):
+            tag = method.consumer_tag or 'ctag-{}'.format(next(self.broker.names))
+            self.broker.consumers.append((self, channel, tag, method.queue))
+            self.send(channel, spec.Basic.ConsumeOk(consumer_tag=tag))
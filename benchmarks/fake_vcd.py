@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+# -*- python -*-
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in vCD REST API serving a synthetic tenant to pyvcloud, for benchmarks
+
+    python -m benchmarks.fake_vcd --port 18080 --tenant 4x3x10x4 --latency 0.05
+
+Besides the vCD API it answers /fake/calls with the API call counts, /fake/expire by dropping every
+session, /fake/touch by changing a VM behind the exporter's back and /fake/overload by failing API
+calls with 503 like an overloaded cell. With --amqp-port it also runs a stand-in AMQP broker, and
+/fake/touch publishes the vCD notification of the change to it.
+"""
+
+import json
+import random
+import time
+import uuid
+from argparse import ArgumentParser
+from urllib.parse import unquote
+from xml.sax.saxutils import quoteattr
+
+# Twisted
+from twisted.internet import reactor
+from twisted.web.server import Site, NOT_DONE_YET
+from twisted.web.resource import Resource
+
+VCLOUD_NS = 'http://www.vmware.com/vcloud/v1.5'
+VMEXT_NS = 'http://www.vmware.com/vcloud/extension/v1.5'
+
+VM_STATES = ['POWERED_ON', 'POWERED_OFF', 'SUSPENDED']
+STATUS_CODES = {
+    'FAILED_CREATION': -1,
+    'UNRESOLVED': 0,
+    'RESOLVED': 1,
+    'DEPLOYED': 2,
+    'SUSPENDED': 3,
+    'POWERED_ON': 4,
+    'WAITING_FOR_INPUT': 5,
+    'UNKNOWN': 6,
+    'UNRECOGNIZED': 7,
+    'POWERED_OFF': 8,
+    'INCONSISTENT_STATE': 9,
+    'MIXED': 10
+}
+
+
+def _uuid(*parts):
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, '/'.join(str(p) for p in parts)))
+
+
+def _attrs(**kwargs):
+    return ' '.join('{}={}'.format(k, quoteattr(str(v))) for k, v in kwargs.items() if v is not None)
+
+
+class FakeTenant:
+    """
+    Class for a synthetic vCD tenant of N orgs x M vDCs x K vApps x V VMs
+    """
+
+    def __init__(self, orgs=2, vdcs=2, vapps=2, vms=2):
+        self.orgs = {}
+        self.vdcs = {}
+        self.vapps = {}
+        self.vms = {}
+        self.tasks = []
+        for o in range(orgs):
+            org_id = _uuid('org', o)
+            self.orgs[org_id] = {'id': org_id, 'name': 'org-{}'.format(o), 'enabled': o % 5 != 4, 'vdcs': []}
+            for d in range(vdcs):
+                vdc_id = _uuid('vdc', o, d)
+                self.orgs[org_id]['vdcs'].append(vdc_id)
+                self.vdcs[vdc_id] = {
+                    'id': vdc_id, 'name': 'vdc-{}-{}'.format(o, d), 'org': org_id, 'enabled': True,
+                    'allocation_model': 'AllocationVApp', 'cpu_allocated': 1000 * d, 'memory_allocated': 2048 * d,
+                    'memory_used': 512 * d, 'vcpu_mhz': 1000, 'networks': d, 'vapps': []
+                }
+                for a in range(vapps):
+                    vapp_id = _uuid('vapp', o, d, a)
+                    self.vdcs[vdc_id]['vapps'].append(vapp_id)
+                    self.vapps[vapp_id] = {
+                        'id': vapp_id, 'name': 'vapp-{}-{}-{}'.format(o, d, a), 'vdc': vdc_id, 'org': org_id,
+                        'deployed': a % 2 == 0, 'status': 'POWERED_ON' if a % 2 == 0 else 'POWERED_OFF',
+                        'maintenance': False, 'vms': []
+                    }
+                    for v in range(vms):
+                        vm_id = _uuid('vm', o, d, a, v)
+                        self.vapps[vapp_id]['vms'].append(vm_id)
+                        self.vms[vm_id] = {
+                            'id': vm_id, 'name': 'vm-{}-{}-{}-{}'.format(o, d, a, v), 'vapp': vapp_id,
+                            'vdc': vdc_id, 'org': org_id, 'deployed': a % 2 == 0,
+                            'status': VM_STATES[(a + v) % len(VM_STATES)], 'os_type': 'ubuntu64Guest',
+                            'cpus': 1 + v % 4, 'memory': 1024 * (1 + v % 8)
+                        }
+
+
+class FakeVcdResource(Resource):
+    """
+    Class for a stand-in vCD REST API serving the endpoints pyvcloud uses
+    """
+    isLeaf = True
+
+    def __init__(self, tenant, latency=0.0, page_size_max=128):
+        Resource.__init__(self)
+        self.tenant = tenant
+        self.latency = latency
+        self.page_size_max = page_size_max
+        self.calls = {}
+        self.base = ''
+        self.tokens = set()
+        self.inflight = 0
+        self.overload = {'rate': 0.0, 'concurrency': 0, 'code': 503}
+        self.broker = None
+
+    def render(self, request):
+        self.base = 'http://{}:{}'.format(request.getHost().host, request.getHost().port)
+        path = request.path.decode('utf-8')
+        endpoint = self._endpoint(path, request)
+
+        if endpoint == 'expire':
+            self.tokens.clear()
+            return self._finish(request, 204, b'')
+        if endpoint == 'fake_calls':
+            return self._finish(request, 200, json.dumps(self.calls).encode())
+        if endpoint == 'touch':
+            return self._finish(request, 200, self._touch(request))
+        if endpoint == 'overload':
+            # ?rate=0.2 fails that share of API calls, ?concurrency=N fails the calls beyond N in flight
+            args = {k.decode('utf-8'): v[0].decode('utf-8') for k, v in request.args.items()}
+            self.overload = {'rate': float(args.get('rate', 0)), 'concurrency': int(args.get('concurrency', 0)),
+                             'code': int(args.get('code', 503))}
+            return self._finish(request, 204, b'')
+
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if endpoint not in ('versions', 'login') and request.getHeader('x-vcloud-authorization') not in self.tokens:
+            return self._finish(request, 401, self._error('Unauthorized'))
+        if endpoint not in ('versions', 'login') and (
+                random.random() < self.overload['rate'] or
+                0 < self.overload['concurrency'] <= self.inflight):
+            return self._finish(request, self.overload['code'], self._error('Service unavailable'))
+
+        try:
+            code, body = self._dispatch(endpoint, path, request)
+        except KeyError:
+            code, body = 404, self._error('Not found: {}'.format(path))
+        return self._finish(request, code, body)
+
+    def _finish(self, request, code, body):
+        request.setResponseCode(code)
+        request.setHeader('Content-Type', 'application/*+xml;version=31.0')
+        if not self.latency:
+            return body
+        self.inflight += 1
+        reactor.callLater(self.latency, self._write, request, body)
+        return NOT_DONE_YET
+
+    def _write(self, request, body):
+        self.inflight -= 1
+        if not request._disconnected:
+            request.write(body)
+            request.finish()
+
+    @staticmethod
+    def _endpoint(path, request):
+        parts = [p for p in path.split('/') if p]
+        if path == '/api/versions':
+            return 'versions'
+        if path == '/api/sessions':
+            return 'login'
+        if path == '/api/session':
+            return 'session'
+        if path == '/fake/expire':
+            return 'expire'
+        if path == '/fake/touch':
+            return 'touch'
+        if path == '/fake/calls':
+            return 'fake_calls'
+        if path == '/fake/overload':
+            return 'overload'
+        if path.startswith('/api/query'):
+            if b'type' in request.args:
+                return 'query:{}'.format(request.args[b'type'][0].decode('utf-8'))
+            return 'query_list'
+        if path.endswith('/metrics/current'):
+            return 'vm_metrics'
+        if parts[1:3] == ['admin', 'org']:
+            return 'admin_org'
+        if parts[1] == 'org':
+            return 'org' if len(parts) > 2 else 'org_list'
+        if parts[1] == 'vdc' or parts[1:3] == ['admin', 'vdc']:
+            return 'vdc'
+        if parts[1] == 'vApp':
+            return 'vm' if parts[2].startswith('vm-') else 'vapp'
+        return 'unknown'
+
+    def _dispatch(self, endpoint, path, request):
+        entity_id = path.rstrip('/').split('/')[-1].replace('vapp-', '').replace('vm-', '')
+        if endpoint == 'versions':
+            return 200, self._versions()
+        if endpoint == 'login':
+            token = 'fake-vcd-token-{}'.format(self.calls['login'])
+            self.tokens.add(token)
+            request.setHeader('x-vcloud-authorization', token)
+            return 200, self._session()
+        if endpoint == 'session':
+            if request.method == b'DELETE':
+                self.tokens.discard(request.getHeader('x-vcloud-authorization'))
+                return 204, b''
+            return 200, self._session()
+        if endpoint == 'org_list':
+            return 200, self._org_list()
+        if endpoint == 'org':
+            return 200, self._org(self.tenant.orgs[entity_id])
+        if endpoint == 'admin_org':
+            return 200, self._admin_org(self.tenant.orgs[entity_id])
+        if endpoint == 'vdc':
+            return 200, self._vdc(self.tenant.vdcs[entity_id])
+        if endpoint == 'vapp':
+            return 200, self._vapp(self.tenant.vapps[entity_id])
+        if endpoint == 'vm':
+            return 200, self._wrap(self._vm(self.tenant.vms[entity_id]))
+        if endpoint == 'vm_metrics':
+            vm_id = path.split('/')[3].replace('vm-', '')
+            return 200, self._vm_metrics(self.tenant.vms[vm_id])
+        if endpoint == 'query_list':
+            return 200, self._query_list()
+        if endpoint.startswith('query:'):
+            return self._query(endpoint.split(':', 1)[1], request)
+        raise KeyError(path)
+
+    def _href(self, path):
+        return '{}/api/{}'.format(self.base, path)
+
+    @staticmethod
+    def _doc(tag, attrs, body=''):
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<{0} xmlns="{1}" {2}>{3}</{0}>'.format(
+            tag, VCLOUD_NS, attrs, body).encode('utf-8')
+
+    def _wrap(self, body):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n' + body.replace('<Vm ', '<Vm xmlns="{}" '.format(
+            VCLOUD_NS), 1)).encode('utf-8')
+
+    def _link(self, rel, media_type, href, name=None):
+        return '<Link {}/>'.format(_attrs(rel=rel, type=media_type, href=href, name=name))
+
+    def _error(self, message):
+        return self._doc('Error', _attrs(majorErrorCode=404, message=message))
+
+    def _versions(self):
+        return self._doc(
+            'SupportedVersions', '',
+            '<VersionInfo deprecated="false"><Version>31.0</Version>'
+            '<LoginUrl>{}</LoginUrl></VersionInfo>'.format(self._href('sessions')))
+
+    def _session(self):
+        links = [
+            self._link('down', 'application/vnd.vmware.vcloud.orgList+xml', self._href('org/')),
+            self._link('down', 'application/vnd.vmware.vcloud.query.queryList+xml', self._href('query')),
+            self._link('down', 'application/vnd.vmware.admin.vcloud+xml', self._href('admin/')),
+        ]
+        return self._doc('Session', _attrs(user='admin', org='System', href=self._href('session/')), ''.join(links))
+
+    def _org_list(self):
+        orgs = ''.join('<Org {}/>'.format(_attrs(
+            href=self._href('org/{}'.format(org['id'])), name=org['name'],
+            type='application/vnd.vmware.vcloud.org+xml')) for org in self.tenant.orgs.values())
+        return self._doc('OrgList', _attrs(href=self._href('org/')), orgs)
+
+    def _org(self, org):
+        links = ''.join(self._link('down', 'application/vnd.vmware.vcloud.vdc+xml',
+                                   self._href('vdc/{}'.format(vdc_id)), self.tenant.vdcs[vdc_id]['name'])
+                        for vdc_id in org['vdcs'])
+        return self._doc('Org', _attrs(id='urn:vcloud:org:{}'.format(org['id']), name=org['name'],
+                                       href=self._href('org/{}'.format(org['id']))),
+                         links + '<FullName>{}</FullName>'.format(org['name']))
+
+    def _admin_org(self, org):
+        return self._doc('AdminOrg', _attrs(id='urn:vcloud:org:{}'.format(org['id']), name=org['name'],
+                                            href=self._href('admin/org/{}'.format(org['id']))),
+                         '<FullName>{}</FullName><IsEnabled>{}</IsEnabled>'.format(
+                             org['name'], str(org['enabled']).lower()))
+
+    def _vdc(self, vdc):
+        entities = ''.join('<ResourceEntity {}/>'.format(_attrs(
+            href=self._href('vApp/vapp-{}'.format(vapp_id)), name=self.tenant.vapps[vapp_id]['name'],
+            type='application/vnd.vmware.vcloud.vApp+xml')) for vapp_id in vdc['vapps'])
+        body = (
+            '<AllocationModel>{allocation_model}</AllocationModel>'
+            '<ComputeCapacity><Cpu><Units>MHz</Units><Allocated>{cpu_allocated}</Allocated><Limit>0</Limit>'
+            '<Reserved>0</Reserved><Used>0</Used></Cpu>'
+            '<Memory><Units>MB</Units><Allocated>{memory_allocated}</Allocated><Limit>0</Limit>'
+            '<Reserved>0</Reserved><Used>{memory_used}</Used></Memory></ComputeCapacity>'
+            '<ResourceEntities>{entities}</ResourceEntities>'
+            '<UsedNetworkCount>{networks}</UsedNetworkCount>'
+            '<IsEnabled>{enabled}</IsEnabled><VCpuInMhz2>{vcpu_mhz}</VCpuInMhz2>'
+        ).format(entities=entities, **dict(vdc, enabled=str(vdc['enabled']).lower()))
+        return self._doc('Vdc', _attrs(id='urn:vcloud:vdc:{}'.format(vdc['id']), name=vdc['name'], status=1,
+                                       href=self._href('vdc/{}'.format(vdc['id']))), body)
+
+    def _vm(self, vm):
+        return (
+            '<Vm {attrs}><VmSpecSection Modified="false"><OsType>{os_type}</OsType>'
+            '<NumCpus>{cpus}</NumCpus><NumCoresPerSocket>1</NumCoresPerSocket>'
+            '<MemoryResourceMb><Configured>{memory}</Configured></MemoryResourceMb></VmSpecSection></Vm>'
+        ).format(attrs=_attrs(id='urn:vcloud:vm:{}'.format(vm['id']), name=vm['name'],
+                              deployed=str(vm['deployed']).lower(), status=STATUS_CODES[vm['status']],
+                              href=self._href('vApp/vm-{}'.format(vm['id']))), **vm)
+
+    def _vapp(self, vapp):
+        vms = ''.join(self._vm(self.tenant.vms[vm_id]) for vm_id in vapp['vms'])
+        return self._doc('VApp', _attrs(id='urn:vcloud:vapp:{}'.format(vapp['id']), name=vapp['name'],
+                                        deployed=str(vapp['deployed']).lower(),
+                                        status=STATUS_CODES[vapp['status']],
+                                        href=self._href('vApp/vapp-{}'.format(vapp['id']))),
+                         '<InMaintenanceMode>{}</InMaintenanceMode><Children>{}</Children>'.format(
+                             str(vapp['maintenance']).lower(), vms))
+
+    def _vm_metrics(self, vm):
+        metrics = ''.join('<Metric {}/>'.format(_attrs(name=name, unit=unit, value=value)) for name, unit, value in (
+            ('cpu.usage.average', 'PERCENT', 10.0 + vm['cpus']),
+            ('cpu.usagemhz.average', 'MEGAHERTZ', 100.0 * vm['cpus']),
+            ('mem.usage.average', 'PERCENT', 25.0),
+            ('disk.used.latest', 'KILOBYTE', 1048576),
+            ('disk.provisioned.latest', 'KILOBYTE', 4194304),
+        ))
+        return self._doc('CurrentUsage', '', metrics)
+
+    def _touch(self, request):
+        # Change a VM behind the exporter's back: ?vm=<id>&cpus=N records a task, &silent=1 does not
+        args = {k.decode('utf-8'): v[0].decode('utf-8') for k, v in request.args.items()}
+        vm = self.tenant.vms[args['vm']] if 'vm' in args else list(self.tenant.vms.values())[0]
+        if 'cpus' in args:
+            vm['cpus'] = int(args['cpus'])
+        if 'os_type' in args:
+            vm['os_type'] = args['os_type']
+        if not args.get('silent'):
+            self.tenant.tasks.append({
+                'href': self._href('task/{}'.format(len(self.tenant.tasks))), 'name': 'vappUpdateVm',
+                'object': self._href('vApp/vm-{}'.format(vm['id'])),
+                'endDate': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())})
+            if self.broker is not None:
+                self._notify('vm/modify', 'vm', vm['id'], 'vapp', vm['vapp'], vm['org'])
+        return vm['id'].encode()
+
+    def _notify(self, event, entity_type, entity_id, parent_type, parent_id, org_id):
+        # Publish a notification like vCD does to its AMQP extension exchange
+        event_type = 'com/vmware/vcloud/event/{}'.format(event)
+        body = (
+            '<vmext:Notification xmlns:vmext={} xmlns:vcloud={} type={} eventId={}>'
+            '<vmext:EntityLink rel="entity" type="vcloud:{}" id="urn:vcloud:{}:{}"/>'
+            '<vmext:EntityLink rel="up" type="vcloud:{}" id="urn:vcloud:{}:{}"/>'
+            '<vmext:EntityLink rel="down" type="vcloud:org" id="urn:vcloud:org:{}"/>'
+            '<vmext:Timestamp>{}</vmext:Timestamp><vmext:OperationSuccess>true</vmext:OperationSuccess>'
+            '</vmext:Notification>'
+        ).format(quoteattr(VMEXT_NS), quoteattr(VCLOUD_NS), quoteattr(event_type), quoteattr(str(uuid.uuid4())),
+                 entity_type, entity_type, entity_id, parent_type, parent_type, parent_id, org_id,
+                 time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()))
+        routing_key = 'true.{}.{}.{}.{}'.format(entity_id, org_id, _uuid('user'), event_type.replace('/', '.'))
+        self.broker.publish('systemExchange', routing_key, body.encode('utf-8'))
+
+    QUERY_TYPES = ('organization', 'adminOrgVdc', 'orgVdc', 'vApp', 'adminVApp', 'adminVM', 'vm', 'adminTask')
+
+    def _query_list(self):
+        links = ''.join(self._link('down', 'application/vnd.vmware.vcloud.query.records+xml',
+                                   self._href('query?type={}&format=records'.format(name)), name)
+                        for name in self.QUERY_TYPES)
+        return self._doc('QueryList', _attrs(href=self._href('query')), links)
+
+    def _records(self, query_type):
+        tenant = self.tenant
+        if query_type == 'organization':
+            for org in tenant.orgs.values():
+                yield 'OrgRecord', {
+                    'href': self._href('org/{}'.format(org['id'])), 'name': org['name'],
+                    'displayName': org['name'], 'isEnabled': str(org['enabled']).lower(),
+                    'numberOfVdcs': len(org['vdcs'])}
+        elif query_type in ('adminOrgVdc', 'orgVdc'):
+            for vdc in tenant.vdcs.values():
+                yield 'AdminVdcRecord', {
+                    'href': self._href('vdc/{}'.format(vdc['id'])), 'name': vdc['name'],
+                    'org': self._href('org/{}'.format(vdc['org'])), 'orgName': tenant.orgs[vdc['org']]['name'],
+                    'isEnabled': str(vdc['enabled']).lower(), 'allocationModel': vdc['allocation_model'],
+                    'cpuAllocationMhz': vdc['cpu_allocated'], 'memoryAllocationMB': vdc['memory_allocated'],
+                    'memoryUsedMB': vdc['memory_used'], 'numberOfVApps': len(vdc['vapps'])}
+        elif query_type in ('vApp', 'adminVApp'):
+            for vapp in tenant.vapps.values():
+                yield 'AdminVAppRecord', {
+                    'href': self._href('vApp/vapp-{}'.format(vapp['id'])), 'name': vapp['name'],
+                    'vdc': self._href('vdc/{}'.format(vapp['vdc'])), 'vdcName': tenant.vdcs[vapp['vdc']]['name'],
+                    'org': self._href('org/{}'.format(vapp['org'])), 'status': vapp['status'],
+                    'isDeployed': str(vapp['deployed']).lower(),
+                    'isInMaintenanceMode': str(vapp['maintenance']).lower(),
+                    'numberOfVMs': len(vapp['vms'])}
+        elif query_type in ('vm', 'adminVM'):
+            for vm in tenant.vms.values():
+                yield 'AdminVMRecord', {
+                    'href': self._href('vApp/vm-{}'.format(vm['id'])), 'name': vm['name'],
+                    'container': self._href('vApp/vapp-{}'.format(vm['vapp'])),
+                    'containerName': tenant.vapps[vm['vapp']]['name'],
+                    'vdc': self._href('vdc/{}'.format(vm['vdc'])), 'org': self._href('org/{}'.format(vm['org'])),
+                    'status': vm['status'], 'isDeployed': str(vm['deployed']).lower(),
+                    'guestOs': vm['os_type'], 'numberOfCpus': vm['cpus'], 'memoryMB': vm['memory'],
+                    'isVAppTemplate': 'false'}
+        elif query_type in ('task', 'adminTask'):
+            for task in tenant.tasks:
+                yield 'AdminTaskRecord', task
+
+    def _query(self, query_type, request):
+        args = {k.decode('utf-8'): v[0].decode('utf-8') for k, v in request.args.items()}
+        page = int(args.get('page', 1))
+        page_size = min(int(args.get('pageSize', 25)), self.page_size_max)
+        filters = []
+        for expression in [f for f in args.get('filter', '').split(';') if f]:
+            if '=ge=' in expression:
+                key, value = expression.split('=ge=', 1)
+                filters.append((key, lambda v, bound=unquote(value): v is not None and v >= bound))
+                continue
+            # Only alternatives of the same attribute, as in (org==a,org==b)
+            values = set()
+            for alternative in expression.strip('()').split(','):
+                key, value = alternative.split('==', 1)
+                values.add(unquote(value) if args.get('filterEncoded') else value)
+            filters.append((key, lambda v, values=values: str(v) in values))
+        fields = args.get('fields', '').split(',') if args.get('fields') else None
+
+        records = [(tag, record) for tag, record in self._records(query_type)
+                   if all(match(record.get(k)) for k, match in filters)]
+        chunk = records[(page - 1) * page_size:page * page_size]
+        body = ''
+        if page * page_size < len(records):
+            next_page = request.uri.decode('utf-8').replace('page={}'.format(page), 'page={}'.format(page + 1))
+            body += self._link('nextPage', 'application/vnd.vmware.vcloud.query.records+xml', self.base + next_page)
+        for tag, record in chunk:
+            if fields:
+                record = {k: v for k, v in record.items() if k in fields or k == 'href'}
+            body += '<{} {}/>'.format(tag, _attrs(**record))
+        return 200, self._doc('QueryResultRecords', _attrs(
+            name=query_type, page=page, pageSize=page_size, total=len(records),
+            href=self._href('query?type={}'.format(query_type))), body)
+
+
+def serve(tenant, port=0, latency=0.0, amqp_port=None):
+    """
+    Start the fake vCD API on localhost, and its AMQP broker when given a port for it,
+    returning the listening port and resource
+    """
+    resource = FakeVcdResource(tenant, latency=latency)
+    listener = reactor.listenTCP(port, Site(resource), interface='127.0.0.1')
+    if amqp_port is not None:
+        # Only needs pika when asked for
+        from benchmarks.fake_amqp import FakeBroker
+        resource.broker = FakeBroker()
+        reactor.listenTCP(amqp_port, resource.broker, interface='127.0.0.1')
+    return listener, resource
+
+
+def main(argv=None):
+    """
+    Serve a synthetic tenant until interrupted
+    """
+    parser = ArgumentParser(description='Fake vCD API for vcd_exporter benchmarks')
+    parser.add_argument('--port', dest='port', type=int, default=18080, help="HTTP port to listen on")
+    parser.add_argument('--tenant', dest='tenant', default='2x2x2x2',
+                        help="orgs x vDCs per org x vApps per vDC x VMs per vApp")
+    parser.add_argument('--latency', dest='latency', type=float, default=0.0,
+                        help="seconds added to every API response")
+    parser.add_argument('--amqp-port', dest='amqp_port', type=int, default=None,
+                        help="port of a stand-in AMQP broker publishing notifications, none by default")
+    args = parser.parse_args(argv)
+
+    orgs, vdcs, vapps, vms = [int(count) for count in args.tenant.split('x')]
+    serve(FakeTenant(orgs, vdcs, vapps, vms), port=args.port, latency=args.latency, amqp_port=args.amqp_port)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
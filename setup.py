@@ -10,7 +10,7 @@ setup(
     url='https://gitlab.com/frenchtoasters/vcd_exporter',
     keywords=['VMware', 'vCD', 'Prometheus'],
     license=vcd_exporter.__license__,
-    packages=find_packages(exclude=['*.test', '*.test.*']),
+    packages=find_packages(exclude=['*.test', '*.test.*', 'benchmarks', 'benchmarks.*']),
     include_package_data=True,
     install_requires=open('requirements.txt').readlines(),
     entry_points={
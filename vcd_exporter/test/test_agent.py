@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import unittest
+
+import requests
+from pyvcloud.vcd.client import Client
+from pyvcloud.vcd.exceptions import VcdResponseException
+from twisted.internet import error
+from twisted.internet.testing import MemoryReactorClock, StringTransport
+from twisted.python import failure
+from twisted.web.client import BrowserLikePolicyForHTTPS, ResponseNeverReceived
+
+from vcd_exporter.vcd_exporter import VcdAgent, _transient, _UnverifiedPolicy
+
+ERROR = (b'<Error xmlns="http://www.vmware.com/vcloud/v1.5" majorErrorCode="{}" message="Busy" '
+         b'minorErrorCode="BUSY"/>')
+
+
+def _client(verify=False):
+    client = Client('vcd.example', verify_ssl_certs=verify, api_version='36.0')
+    client._session = requests.Session()
+    client._session.headers['x-vcloud-authorization'] = 'token'
+    return client
+
+
+def _response(code, body, *headers):
+    lines = [b'HTTP/1.1 ' + str(code).encode() + b' Status', b'Content-Length: ' + str(len(body)).encode()]
+    return b'\r\n'.join(lines + list(headers)) + b'\r\n\r\n' + body
+
+
+class VcdAgentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = MemoryReactorClock()
+        self.agent = VcdAgent(_client(), 'a', pool_size=2, clock=self.reactor)
+        self.connections = []
+
+    def get(self, uri='http://127.0.0.1:8080/api/org'):
+        results = []
+        self.agent.get(uri).addBoth(results.append)
+        return results
+
+    def connect(self):
+        """
+        Connect the requests the agent opened a connection for since the last call
+        """
+        for _, _, factory, _, _ in self.reactor.tcpClients[len(self.connections):]:
+            transport = StringTransport()
+            protocol = factory.buildProtocol(None)
+            protocol.makeConnection(transport)
+            self.connections.append((protocol, transport))
+        return self.connections
+
+    def test_tls_policy(self):
+        policies = []
+        for verify in (False, True):
+            agent = VcdAgent(_client(verify), 'a', clock=self.reactor)
+            policies.append(agent.agent._agent._endpointFactory._policyForHTTPS)
+        self.assertIsInstance(policies[0], _UnverifiedPolicy)
+        self.assertIsInstance(policies[1], BrowserLikePolicyForHTTPS)
+
+    def test_session_headers_and_gzip(self):
+        results = self.get()
+        protocol, transport = self.connect()[0]
+        request = transport.value()
+        self.assertTrue(request.startswith(b'GET /api/org HTTP/1.1\r\n'))
+        self.assertIn(b'Accept: application/*+xml;version=36.0\r\n', request)
+        self.assertIn(b'X-Vcloud-Authorization: token\r\n', request)
+        self.assertIn(b'Accept-Encoding: gzip\r\n', request)
+
+        protocol.dataReceived(_response(200, gzip.compress(b'<Org/>'), b'Content-Encoding: gzip'))
+        self.assertEqual(results, [b'<Org/>'])
+
+    def test_concurrent_connections_bounded(self):
+        results = [self.get() for _ in range(3)]
+        self.assertEqual(len(self.connect()), 2)
+
+        protocol, transport = self.connections[0]
+        protocol.dataReceived(_response(200, b'<Org/>'))
+        self.assertEqual(results[0], [b'<Org/>'])
+        # The third request goes on the connection given back to the pool
+        self.assertEqual(len(self.connect()), 2)
+        self.assertEqual(transport.value().count(b'GET /api/org'), 2)
+        protocol.dataReceived(_response(200, b'<Org/>'))
+        self.assertEqual(results[2], [b'<Org/>'])
+
+    def test_transient_status(self):
+        results = self.get()
+        protocol, _ = self.connect()[0]
+        protocol.dataReceived(_response(503, ERROR.replace(b'{}', b'503'), b'X-VMWARE-VCLOUD-REQUEST-ID: 42'))
+        self.assertIsInstance(results[0].value, VcdResponseException)
+        self.assertEqual(results[0].value.status_code, 503)
+        self.assertTrue(_transient(results[0].value))
+
+    def test_permanent_status(self):
+        results = self.get()
+        protocol, _ = self.connect()[0]
+        protocol.dataReceived(_response(403, ERROR.replace(b'{}', b'403')))
+        self.assertIsInstance(results[0].value, VcdResponseException)
+        self.assertFalse(_transient(results[0].value))
+
+    def test_connection_lost(self):
+        results = self.get()
+        protocol, _ = self.connect()[0]
+        protocol.connectionLost(failure.Failure(error.ConnectionLost()))
+        self.assertIsInstance(results[0].value, ResponseNeverReceived)
+        self.assertTrue(_transient(results[0].value))
+
+        # The connection slot is given back
+        self.get()
+        self.assertEqual(len(self.connect()), 2)
+
+    def test_connection_refused(self):
+        results = self.get()
+        _, _, factory, _, _ = self.reactor.tcpClients[0]
+        factory.clientConnectionFailed(self.reactor.connectors[0], failure.Failure(error.ConnectionRefusedError()))
+        # The endpoint fails once its connection attempts are over
+        self.reactor.advance(1)
+        self.assertIsInstance(results[0].value, error.ConnectionRefusedError)
+        self.assertTrue(_transient(results[0].value))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from unittest import mock
+
+from twisted.internet import defer, task
+
+from vcd_exporter.vcd_exporter import GaugeFamily, Snapshot, VcdApplicationResource, VcdCollector
+
+
+class Args(object):
+
+    def __init__(self):
+        self.config_file = None
+        self.shard_index, self.shard_count = 0, 1
+        self.threads = 1
+
+
+class FakeCollector(object):
+
+    def partial_families(self):
+        return [_family('partial')]
+
+    def completeness(self):
+        return {'org': 1.0, 'vdc': 0.5}
+
+
+def _family(name):
+    family = GaugeFamily(name, name)
+    family.add_metric((), 1)
+    return family
+
+
+def _collector(levels=('org', 'vdc', 'vapp', 'vm')):
+    return VcdCollector('vcd', 'user', 'org', 'password', False, None, target='a', levels=levels)
+
+
+class WithinTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.vcd = VcdApplicationResource(Args(), clock=self.clock)
+        self.key = ('a', (0, 1))
+        self.settings = {'collect_levels': ['org', 'vdc']}
+        self.log = mock.patch('vcd_exporter.vcd_exporter.log').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def within(self, result):
+        served = []
+        answer = self.vcd.within(result, 'a', self.settings, (0, 1), 10)
+        answer.addBoth(served.append)
+        return served
+
+    def names(self, families):
+        return [family.name for family in families]
+
+    def completeness(self, families):
+        return dict((labels[0], value) for labels, value in families[-1].samples)
+
+    def test_collected_in_time(self):
+        result = defer.Deferred()
+        self.vcd.unserved[self.key] = [_family('unserved')]
+        served = self.within(result)
+        self.clock.advance(9)
+        self.assertEqual(served, [])
+
+        result.callback([_family('collected')])
+        self.assertEqual(self.names(served[0]), ['collected'])
+        self.assertNotIn(self.key, self.vcd.unserved)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_failed_in_time(self):
+        result = defer.Deferred()
+        served = self.within(result)
+        result.errback(ValueError('Login failed'))
+        self.assertIsInstance(served[0].value, ValueError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_serving_order(self):
+        self.vcd.unserved[self.key] = [_family('unserved')]
+        self.vcd.restored[self.key] = Snapshot([_family('restored')], restored=True)
+        self.vcd.running[self.key] = FakeCollector()
+
+        served = self.within(defer.Deferred())
+        self.clock.advance(10)
+        self.assertEqual(self.names(served[0]), ['unserved'])
+
+        served = self.within(defer.Deferred())
+        self.clock.advance(10)
+        self.assertEqual(self.names(served[0]), ['restored'])
+
+        del self.vcd.restored[self.key]
+        served = self.within(defer.Deferred())
+        self.clock.advance(10)
+        self.assertEqual(self.names(served[0]), ['partial', 'vcd_scrape_completeness'])
+        self.assertEqual(self.completeness(served[0]), {'org': 1.0, 'vdc': 0.5})
+
+        del self.vcd.running[self.key]
+        served = self.within(defer.Deferred())
+        self.clock.advance(10)
+        self.assertEqual(self.names(served[0]), ['vcd_scrape_completeness'])
+        self.assertEqual(self.completeness(served[0]), {'org': 0.0, 'vdc': 0.0})
+
+    def test_late_collection_served_next(self):
+        result = defer.Deferred()
+        served = self.within(result)
+        self.clock.advance(10)
+        result.callback([_family('late')])
+        self.assertEqual(len(served), 1)
+        self.assertEqual(self.names(self.vcd.unserved[self.key]), ['late'])
+
+        served = self.within(defer.Deferred())
+        self.clock.advance(10)
+        self.assertEqual(self.names(served[0]), ['late'])
+        self.assertNotIn(self.key, self.vcd.unserved)
+
+    def test_late_failure_logged(self):
+        result = defer.Deferred()
+        served = self.within(result)
+        self.clock.advance(10)
+        result.errback(ValueError('Login failed'))
+        self.assertEqual(len(served), 1)
+        self.assertNotIn(self.key, self.vcd.unserved)
+        self.assertIn('after its scrape was answered', self.log.call_args[0][0])
+
+
+class CompletenessTest(unittest.TestCase):
+
+    def test_nothing_listed(self):
+        self.assertEqual(_collector().completeness(), {'org': 0.0, 'vdc': 0.0, 'vapp': 0.0, 'vm': 0.0})
+
+    def test_parents_not_collected(self):
+        collector = _collector()
+        collector._progress('org', listed=4)
+        collector._progress('org', done=2)
+        self.assertEqual(collector.completeness(), {'org': 0.5, 'vdc': 0.0, 'vapp': 0.0, 'vm': 0.0})
+
+        collector._progress('vdc', listed=2)
+        collector._progress('vdc', done=1)
+        collector._progress('vapp', listed=4)
+        collector._progress('vapp', done=4)
+        self.assertEqual(collector.completeness(), {'org': 0.5, 'vdc': 0.25, 'vapp': 0.25, 'vm': 0.25})
+
+    def test_parents_collected(self):
+        collector = _collector()
+        collector._progress('org', done=2, listed=2)
+        self.assertEqual(collector.completeness(), {'org': 1.0, 'vdc': 1.0, 'vapp': 1.0, 'vm': 1.0})
+
+        collector._progress('vdc', listed=3)
+        collector._progress('vdc', done=1)
+        self.assertEqual(collector.completeness(), {'org': 1.0, 'vdc': 1.0 / 3, 'vapp': 0.0, 'vm': 0.0})
+
+    def test_finished(self):
+        collector = _collector(levels=('org', 'vm'))
+        collector._progress('org', listed=2)
+        collector.finished = True
+        self.assertEqual(collector.completeness(), {'org': 1.0, 'vm': 1.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
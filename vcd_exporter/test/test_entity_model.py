@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from vcd_exporter.vcd_exporter import EntityModel, _parse_notification
+
+PARENTS = ('urn:vcloud:vdc:1', 'vdc1', 'urn:vcloud:org:1', 'org1', 'true')
+NOTIFICATION = (
+    '<vmext:Notification xmlns:vmext="http://www.vmware.com/vcloud/extension/v1.5" '
+    'type="com/vmware/vcloud/event/vm/modify">'
+    '<vmext:EntityLink rel="entity" type="vcloud:vm" id="urn:vcloud:vm:1"/>'
+    '<vmext:EntityLink rel="up" type="vcloud:vapp" id="urn:vcloud:vapp:1"/>'
+    '<vmext:EntityLink rel="down" type="vcloud:org" id="urn:vcloud:org:1"/>'
+    '<vmext:OperationSuccess>true</vmext:OperationSuccess>'
+    '</vmext:Notification>'
+)
+
+
+def _notification(entity, up, event='modify', success=True):
+    return {'type': 'com/vmware/vcloud/event/{}/{}'.format(entity[0].split(':')[1], event), 'success': success,
+            'entity': entity, 'up': up}
+
+
+def _samples(urn, value):
+    labels = (urn, urn.rsplit(':', 1)[-1]) + PARENTS
+    return [('vcd_vdc_vapp_status', labels, value)]
+
+
+class EntityModelTest(unittest.TestCase):
+
+    def setUp(self):
+        # A full collection of two vApps of one vDC
+        self.model = EntityModel()
+        self.model.begin()
+        self.model.parents['urn:vcloud:vdc:1'] = PARENTS
+        self.static = [('vcd_org_is_enabled', ('urn:vcloud:org:1', 'org1'), 1.0)]
+        self.vapp1, self.vapp2 = _samples('urn:vcloud:vapp:1', 4.0), _samples('urn:vcloud:vapp:2', 8.0)
+        self.model.store('urn:vcloud:vapp:1', 'fp1', self.vapp1, PARENTS, 'https://vcd/api/vApp/vapp-1')
+        self.model.store('urn:vcloud:vapp:2', 'fp2', self.vapp2, PARENTS, 'https://vcd/api/vApp/vapp-2')
+        self.model.commit(self.static + self.vapp2 + self.vapp1)
+
+    def test_commit_keeps_output_order(self):
+        self.assertEqual(list(self.model.entities), ['urn:vcloud:vapp:2', 'urn:vcloud:vapp:1'])
+        self.assertEqual(self.model.static, self.static)
+        self.assertEqual(self.model.get('urn:vcloud:vapp:1', 'fp1'), self.vapp1)
+        self.assertIsNone(self.model.get('urn:vcloud:vapp:1', 'changed'))
+
+    def test_vm_change_fetches_its_vapp(self):
+        self.model.notify(_notification(('vcloud:vm', 'urn:vcloud:vm:1'), ('vcloud:vapp', 'urn:vcloud:vapp:1')))
+        self.assertEqual(self.model.patch(), [('urn:vcloud:vapp:1', PARENTS, 'https://vcd/api/vApp/vapp-1')])
+        self.assertEqual(self.model.patch(), [])
+        self.assertFalse(self.model.stale)
+
+    def test_created_vapp_of_known_vdc(self):
+        self.model.notify(_notification(('vcloud:vapp', 'urn:vcloud:vapp:3'), ('vcloud:vdc', 'urn:vcloud:vdc:1'),
+                                        'create'))
+        self.model.notify(_notification(('vcloud:vapp', 'urn:vcloud:vapp:4'), ('vcloud:vdc', 'urn:vcloud:vdc:9'),
+                                        'create'))
+        self.assertEqual(self.model.patch(), [('urn:vcloud:vapp:3', PARENTS, None)])
+
+    def test_deleted_vapp_dropped(self):
+        self.model.notify(_notification(('vcloud:vapp', 'urn:vcloud:vapp:1'), ('vcloud:vdc', 'urn:vcloud:vdc:1')))
+        self.model.notify(_notification(('vcloud:vapp', 'urn:vcloud:vapp:1'), ('vcloud:vdc', 'urn:vcloud:vdc:1'),
+                                        'delete'))
+        self.assertEqual(self.model.patch(), [])
+        self.assertEqual(self.model.samples(), self.static + self.vapp2)
+
+    def test_patched_collection(self):
+        self.model.notify(_notification(('vcloud:vm', 'urn:vcloud:vm:1'), ('vcloud:vapp', 'urn:vcloud:vapp:1')))
+        self.model.patch()
+        changed = _samples('urn:vcloud:vapp:1', 8.0)
+        self.model.store('urn:vcloud:vapp:1', 'fp1-changed', changed, PARENTS, 'https://vcd/api/vApp/vapp-1')
+        samples = self.model.samples()
+        self.model.commit(samples)
+
+        self.assertEqual(samples, self.static + self.vapp2 + changed)
+        self.assertEqual(self.model.get('urn:vcloud:vapp:1', 'fp1-changed'), changed)
+        self.assertEqual(self.model.get('urn:vcloud:vapp:2', 'fp2'), self.vapp2)
+
+    def test_org_and_vdc_changes_make_it_stale(self):
+        for entity in (('vcloud:org', 'urn:vcloud:org:1'), ('vcloud:vdc', 'urn:vcloud:vdc:1')):
+            model = EntityModel()
+            model.notify(_notification(entity, ('vcloud:org', 'urn:vcloud:org:1')))
+            self.assertTrue(model.stale)
+            model.begin()
+            self.assertFalse(model.stale)
+
+    def test_parse_notification(self):
+        self.assertEqual(_parse_notification(NOTIFICATION.encode('utf-8')), {
+            'type': 'com/vmware/vcloud/event/vm/modify',
+            'success': True,
+            'entity': ('vcloud:vm', 'urn:vcloud:vm:1'),
+            'up': ('vcloud:vapp', 'urn:vcloud:vapp:1'),
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import unittest
+
+from vcd_exporter.vcd_exporter import (OPENMETRICS_CONTENT_TYPE, TEXT_CONTENT_TYPE, ExpositionWriter, GaugeFamily,
+                                       _accepted, _gzip_chunks, _merge_targets, _negotiate, _set_content_headers)
+
+
+def _render(families):
+    return b''.join(ExpositionWriter(families).chunks()).decode('utf-8')
+
+
+def _org_families(orgs):
+    family = GaugeFamily('vcd_org_is_enabled', 'Enabled status of Organization',
+                         labels=['org_name', 'org_full_name', 'org_id'])
+    for org_id, org_name in orgs:
+        family.add_metric((org_id, org_name), 1)
+    return [family]
+
+
+class MergeTargetsTest(unittest.TestCase):
+
+    def test_target_label_follows_values(self):
+        text = _render(_merge_targets([('a', _org_families([('urn:org:1', 'org1')]))]))
+        self.assertIn('vcd_org_is_enabled{org_full_name="org1",org_name="urn:org:1",vcd_target="a"} 1.0', text)
+
+    def test_empty_family_of_first_target(self):
+        text = _render(_merge_targets([('a', _org_families([])), ('b', _org_families([('urn:org:1', 'org1')]))]))
+        self.assertIn('vcd_org_is_enabled{org_full_name="org1",org_name="urn:org:1",vcd_target="b"} 1.0', text)
+        self.assertNotIn('org_id=', text)
+
+    def test_empty_family_of_every_target(self):
+        families = _merge_targets([('a', _org_families([])), ('b', _org_families([]))])
+        self.assertEqual(families[0].labels, ('org_name', 'org_full_name', 'org_id', 'vcd_target'))
+        self.assertEqual(families[0].samples, [])
+
+    def test_target_up(self):
+        text = _render(_merge_targets([('a', _org_families([])), ('b', None)]))
+        self.assertIn('vcd_target_up{vcd_target="a"} 1.0', text)
+        self.assertIn('vcd_target_up{vcd_target="b"} 0.0', text)
+
+
+class Request(object):
+
+    def __init__(self, accept=None, accept_encoding=None):
+        self.headers = {'Accept': accept, 'Accept-Encoding': accept_encoding}
+        self.responseHeaders = {}
+
+    def getHeader(self, name):
+        return self.headers.get(name)
+
+    def setHeader(self, name, value):
+        self.responseHeaders[name] = value
+
+
+class NegotiationTest(unittest.TestCase):
+
+    def test_accepted_weights(self):
+        self.assertEqual(_accepted(None), [])
+        self.assertEqual(_accepted('gzip, deflate;q=0.5, br;q=0'), ['gzip', 'deflate'])
+        for refused in ('q=0', 'q=0.000', 'q = 0', 'Q=0.0', 'q=-1', 'q=zero'):
+            self.assertEqual(_accepted('gzip;{}, identity'.format(refused)), ['identity'], refused)
+        self.assertEqual(_accepted('GZIP;q=0.001'), ['gzip'])
+
+    def test_openmetrics(self):
+        prometheus = 'application/openmetrics-text;version=1.0.0;q=0.5,text/plain;version=0.0.4;q=0.3,*/*;q=0.1'
+        self.assertEqual(_negotiate(Request(accept=prometheus)), (True, False))
+        self.assertEqual(_negotiate(Request(accept='text/plain;version=0.0.4')), (False, False))
+        self.assertEqual(_negotiate(Request(accept='application/openmetrics-text; q=0.0')), (False, False))
+        self.assertEqual(_negotiate(Request()), (False, False))
+
+    def test_gzip(self):
+        self.assertEqual(_negotiate(Request(accept_encoding='gzip')), (False, True))
+        self.assertEqual(_negotiate(Request(accept_encoding='deflate, gzip;q=0.8')), (False, True))
+        self.assertEqual(_negotiate(Request(accept_encoding='gzip; q=0')), (False, False))
+        self.assertEqual(_negotiate(Request(accept_encoding='identity')), (False, False))
+
+    def test_headers(self):
+        request = Request()
+        _set_content_headers(request, True, True)
+        self.assertEqual(request.responseHeaders, {'Content-Type': OPENMETRICS_CONTENT_TYPE,
+                                                   'Vary': 'Accept, Accept-Encoding', 'Content-Encoding': 'gzip'})
+        request = Request()
+        _set_content_headers(request, False, False)
+        self.assertEqual(request.responseHeaders['Content-Type'], TEXT_CONTENT_TYPE)
+        self.assertNotIn('Content-Encoding', request.responseHeaders)
+
+    def test_gzip_chunks(self):
+        families = _org_families([('urn:org:{}'.format(index), 'org{}'.format(index)) for index in range(100)])
+        chunks = list(ExpositionWriter(families, chunk_lines=10, openmetrics=True).chunks())
+        text = gzip.decompress(b''.join(_gzip_chunks(chunks)))
+        self.assertEqual(text, b''.join(chunks))
+        self.assertTrue(text.endswith(b'# EOF\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
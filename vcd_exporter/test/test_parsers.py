@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from lxml import objectify
+
+from vcd_exporter.vcd_exporter import (_parse_org_list, _parse_query_page, _parse_vapp, _parse_vdc, _vapp_summary,
+                                       _vdc_summary)
+
+VDC = b'''<?xml version="1.0" encoding="UTF-8"?>
+<Vdc xmlns="http://www.vmware.com/vcloud/v1.5" id="urn:vcloud:vdc:1" name="vdc1" status="1"
+     href="https://vcd/api/vdc/1" type="application/vnd.vmware.vcloud.vdc+xml">
+    <Link rel="up" href="https://vcd/api/org/1" type="application/vnd.vmware.vcloud.org+xml"/>
+    <Description>Test vDC</Description>
+    <AllocationModel>AllocationVApp</AllocationModel>
+    <ComputeCapacity>
+        <Cpu><Units>MHz</Units><Allocated>2000</Allocated><Limit>0</Limit><Reserved>0</Reserved><Used>500</Used></Cpu>
+        <Memory><Units>MB</Units><Allocated>4096</Allocated><Limit>0</Limit><Reserved>0</Reserved><Used>1024</Used>
+        </Memory>
+    </ComputeCapacity>
+    <ResourceEntities>
+        <ResourceEntity href="https://vcd/api/vApp/vapp-1" name="vapp1" type="application/vnd.vmware.vcloud.vApp+xml"/>
+        <ResourceEntity href="https://vcd/api/vAppTemplate/vappTemplate-1" name="template1"
+                        type="application/vnd.vmware.vcloud.vAppTemplate+xml"/>
+        <ResourceEntity href="https://vcd/api/vApp/vapp-2" name="vapp2" type="application/vnd.vmware.vcloud.vApp+xml"/>
+    </ResourceEntities>
+    <AvailableNetworks/>
+    <UsedNetworkCount>3</UsedNetworkCount>
+    <IsEnabled>true</IsEnabled>
+    <VCpuInMhz2>1000</VCpuInMhz2>
+</Vdc>
+'''
+
+EMPTY_VDC = b'''<?xml version="1.0" encoding="UTF-8"?>
+<Vdc xmlns="http://www.vmware.com/vcloud/v1.5" id="urn:vcloud:vdc:2" name="vdc2" href="https://vcd/api/vdc/2">
+    <AllocationModel>AllocationPool</AllocationModel>
+    <IsEnabled>false</IsEnabled>
+</Vdc>
+'''
+
+VAPP = b'''<?xml version="1.0" encoding="UTF-8"?>
+<VApp xmlns="http://www.vmware.com/vcloud/v1.5" xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1"
+      id="urn:vcloud:vapp:1" name="vapp1" deployed="true" status="4" href="https://vcd/api/vApp/vapp-1">
+    <Link rel="up" href="https://vcd/api/vdc/1"/>
+    <InMaintenanceMode>false</InMaintenanceMode>
+    <Children>
+        <Vm id="urn:vcloud:vm:1" name="vm1" deployed="true" status="4" href="https://vcd/api/vApp/vm-1">
+            <VmSpecSection Modified="false">
+                <OsType>ubuntu64Guest</OsType>
+                <NumCpus>2</NumCpus>
+                <NumCoresPerSocket>1</NumCoresPerSocket>
+                <MemoryResourceMb><Configured>2048</Configured></MemoryResourceMb>
+            </VmSpecSection>
+        </Vm>
+        <Vm id="urn:vcloud:vm:2" name="vm2" deployed="false" status="8" href="https://vcd/api/vApp/vm-2">
+            <VmSpecSection Modified="false">
+                <NumCpus>4</NumCpus>
+            </VmSpecSection>
+        </Vm>
+    </Children>
+</VApp>
+'''
+
+EMPTY_VAPP = b'''<?xml version="1.0" encoding="UTF-8"?>
+<VApp xmlns="http://www.vmware.com/vcloud/v1.5" id="urn:vcloud:vapp:2" name="vapp2" deployed="false" status="8"
+      href="https://vcd/api/vApp/vapp-2"/>
+'''
+
+QUERY_PAGE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<QueryResultRecords xmlns="http://www.vmware.com/vcloud/v1.5" name="adminVApp" page="1" pageSize="2" total="3">
+    <Link rel="nextPage" href="https://vcd/api/query?type=adminVApp&amp;page=2"/>
+    <AdminVAppRecord href="https://vcd/api/vApp/vapp-1" name="vapp1" status="POWERED_ON" isDeployed="true"/>
+    <AdminVAppRecord href="https://vcd/api/vApp/vapp-2" name="vapp2" status="POWERED_OFF" isDeployed="false"/>
+</QueryResultRecords>
+'''
+
+ORG_LIST = b'''<?xml version="1.0" encoding="UTF-8"?>
+<OrgList xmlns="http://www.vmware.com/vcloud/v1.5" href="https://vcd/api/org/">
+    <Org href="https://vcd/api/org/1" name="org1" type="application/vnd.vmware.vcloud.org+xml"/>
+    <Org href="https://vcd/api/org/2" name="org2" type="application/vnd.vmware.vcloud.org+xml"/>
+</OrgList>
+'''
+
+
+class ParsersTest(unittest.TestCase):
+
+    def test_vdc_same_as_objectified(self):
+        for document in (VDC, EMPTY_VDC):
+            self.assertEqual(_parse_vdc(document), _vdc_summary(objectify.fromstring(document)))
+
+    def test_vdc(self):
+        vdc = _parse_vdc(VDC)
+        self.assertEqual(vdc['is_enabled'], 'True')
+        self.assertEqual((vdc['cpu_allocated'], vdc['memory_allocated'], vdc['memory_used']), ('2000', '4096', '1024'))
+        self.assertEqual([vapp['name'] for vapp in vdc['vapps']], ['vapp1', 'vapp2'])
+
+    def test_vapp_same_as_objectified(self):
+        for document in (VAPP, EMPTY_VAPP):
+            self.assertEqual(_parse_vapp(document), _vapp_summary(objectify.fromstring(document)))
+
+    def test_vapp(self):
+        vapp = _parse_vapp(VAPP)
+        self.assertEqual(vapp['in_maintenance'], 'false')
+        self.assertEqual([(vm['name'], vm['cpus'], vm['memory_mb']) for vm in vapp['vms']],
+                         [('vm1', '2', '2048'), ('vm2', '4', None)])
+
+    def test_query_page(self):
+        page = _parse_query_page(QUERY_PAGE)
+        self.assertEqual(page['resultTotal'], 3)
+        self.assertEqual([record['name'] for record in page['values']], ['vapp1', 'vapp2'])
+        self.assertEqual(page['values'][0]['status'], 'POWERED_ON')
+
+    def test_org_list(self):
+        self.assertEqual(_parse_org_list(ORG_LIST), ['https://vcd/api/org/1', 'https://vcd/api/org/2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import marshal
+import unittest
+from unittest import mock
+
+from twisted.internet import defer
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+from vcd_exporter.vcd_exporter import CollectionProfile, DebugProfileResource, GaugeFamily
+
+
+class FakeVcd(object):
+
+    def __init__(self):
+        self.sessions = None
+
+    def configure(self, target):
+        return {'vcd_host': 'vcd'} if target == 'a' else 2
+
+    def request_shard(self, request):
+        return 0, 1
+
+
+def _request(token='secret', **args):
+    request = DummyRequest([b'debug', b'profile'])
+    request.args = dict((key.encode(), [value.encode()]) for key, value in args.items())
+    if token is not None:
+        request.requestHeaders.setRawHeaders(b'authorization', ['Bearer {}'.format(token).encode()])
+    return request
+
+
+def _families():
+    family = GaugeFamily('vcd_org_is_enabled', 'Enabled status of Organization', labels=['org_name'])
+    family.add_metric(('org1',), 1)
+    return [family]
+
+
+class DebugProfileResourceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = DebugProfileResource(FakeVcd(), 'secret')
+        self.collections = []
+        self.collect_target = mock.patch('vcd_exporter.vcd_exporter._collect_target', side_effect=self.collect).start()
+        mock.patch('vcd_exporter.vcd_exporter.log').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def collect(self, sessions, models, target, settings, shard, profile):
+        result = defer.Deferred()
+        self.collections.append((result, profile))
+        return result
+
+    def finish(self, index=0):
+        result, profile = self.collections[index]
+        profile.phase('org', 0.5, 0.125)
+        profile.phase('org', 0.25, 0.125)
+        result.callback(_families())
+
+    def body(self, request):
+        return b''.join(request.written).decode('utf-8')
+
+    def test_token_required(self):
+        for token in (None, 'wrong', 'secret-and-more'):
+            request = _request(token=token, target='a')
+            self.assertEqual(self.resource.render_GET(request), b'Debug token required')
+            self.assertEqual(request.responseCode, 403)
+        self.assertFalse(self.collect_target.called)
+
+    def test_invalid_parameters(self):
+        request = _request(target='a', sort='fastest')
+        self.assertEqual(self.resource.render_GET(request), b'Invalid sort: fastest')
+        self.assertEqual(request.responseCode, 400)
+        request = _request(target='a', top='many')
+        self.resource.render_GET(request)
+        self.assertEqual(request.responseCode, 400)
+        self.assertEqual(self.resource.render_GET(_request(target='b')), b'No Config found for: b')
+
+    def test_concurrent_profile_refused(self):
+        first = _request(target='a')
+        self.assertEqual(self.resource.render_GET(first), NOT_DONE_YET)
+        second = _request(target='a')
+        self.assertEqual(self.resource.render_GET(second), b'A profile is already running')
+        self.assertEqual(second.responseCode, 409)
+        self.assertEqual(len(self.collections), 1)
+
+        self.finish()
+        self.assertEqual(first.finished, 1)
+        self.assertEqual(self.resource.render_GET(_request(target='a')), NOT_DONE_YET)
+        self.finish(1)
+
+    def test_report(self):
+        request = _request(target='a', top='5')
+        self.resource.render_GET(request)
+        self.finish()
+
+        body = self.body(request)
+        self.assertTrue(body.startswith('Collection of a in '))
+        self.assertIn('vCD calls by phase, concurrent calls overlap', body)
+        self.assertIn('{:<12}{:>8}{:>12.3f}{:>12.3f}{:>12.3f}'.format('org', 2, 0.75, 0.5, 0.25), body)
+        self.assertIn('Memory traced: ', body)
+        self.assertIn('cProfile of the reactor and of the calls in threads, by cumulative', body)
+        self.assertEqual(request.responseHeaders.getRawHeaders(b'content-type'), [b'text/plain; charset=UTF-8'])
+        self.assertFalse(self.resource.profiling)
+
+    def test_pstats(self):
+        request = _request(target='a', format='pstats')
+        self.resource.render_GET(request)
+        self.finish()
+        self.assertIsInstance(marshal.loads(b''.join(request.written)), dict)
+        self.assertEqual(request.responseHeaders.getRawHeaders(b'content-type'), [b'application/octet-stream'])
+
+    def test_failed_collection(self):
+        request = _request(target='a')
+        self.resource.render_GET(request)
+        result, profile = self.collections[0]
+        result.errback(ValueError('Login failed'))
+
+        self.assertEqual(request.responseCode, 500)
+        self.assertEqual(self.body(request), 'Collection failed for: a')
+        self.assertIsNotNone(profile.duration)
+        self.assertFalse(self.resource.profiling)
+
+
+class CollectionProfileTest(unittest.TestCase):
+
+    def test_runcall(self):
+        profile = CollectionProfile()
+        profile.start()
+        self.assertEqual(profile.runcall(sorted, [2, 1]), [1, 2])
+        profile.stop()
+        self.assertIsNotNone(profile.duration)
+        self.assertIn('Collection of a in ', profile.report('a', 0.0, 0, top=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from twisted.internet import defer, error, task
+
+from vcd_exporter.vcd_exporter import CircuitOpenError, RequestScheduler
+
+
+class FakeRunner(object):
+    """
+    Runner whose calls stay pending until the test fires them
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, fn, *args):
+        result = defer.Deferred()
+        self.calls.append(result)
+        return result
+
+    def fail(self, index):
+        self.calls[index].errback(error.ConnectionRefusedError())
+
+    def succeed(self, index):
+        self.calls[index].callback(None)
+
+
+class RequestSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.runner = FakeRunner()
+
+    def scheduler(self, **kwargs):
+        kwargs.setdefault('max_retries', 0)
+        return RequestScheduler('test-scheduler', clock=self.clock, runner=self.runner, **kwargs)
+
+    def outcomes(self, deferreds):
+        """
+        Collect the outcome of each Deferred as it fires, the exception class of failures
+        """
+        outcomes = [None] * len(deferreds)
+
+        def record(outcome, index):
+            outcomes[index] = outcome.type if hasattr(outcome, 'type') else outcome
+
+        for index, result in enumerate(deferreds):
+            result.addBoth(record, index)
+        return outcomes
+
+    def test_breaker_opens_after_threshold(self):
+        scheduler = self.scheduler(breaker_threshold=3)
+        outcomes = self.outcomes([scheduler.run(None) for _ in range(3)])
+        self.runner.fail(0)
+        self.runner.fail(1)
+        self.assertIsNone(scheduler.opened)
+        self.runner.fail(2)
+
+        self.assertEqual(outcomes, [error.ConnectionRefusedError] * 3)
+        self.assertEqual(scheduler.opened, 0)
+
+    def test_breaker_rejects_while_open(self):
+        scheduler = self.scheduler(breaker_threshold=1, breaker_reset=30)
+        scheduler.run(None).addErrback(lambda _: None)
+        self.runner.fail(0)
+
+        self.clock.advance(29)
+        outcomes = self.outcomes([scheduler.run(None)])
+        self.assertEqual(outcomes, [CircuitOpenError])
+        self.assertEqual(len(self.runner.calls), 1)
+
+    def test_breaker_opening_rejects_waiting_requests(self):
+        scheduler = self.scheduler(max_requests=1, breaker_threshold=1)
+        outcomes = self.outcomes([scheduler.run(None), scheduler.run(None)])
+        self.runner.fail(0)
+
+        self.assertEqual(outcomes, [error.ConnectionRefusedError, CircuitOpenError])
+        self.assertEqual(len(self.runner.calls), 1)
+
+    def test_single_probe_after_reset(self):
+        scheduler = self.scheduler(breaker_threshold=1, breaker_reset=30)
+        scheduler.run(None).addErrback(lambda _: None)
+        self.runner.fail(0)
+
+        self.clock.advance(30)
+        outcomes = self.outcomes([scheduler.run(None), scheduler.run(None)])
+        self.assertEqual(len(self.runner.calls), 2)
+        self.assertEqual(outcomes, [None, CircuitOpenError])
+
+        self.runner.succeed(1)
+        self.assertIsNone(scheduler.opened)
+        outcomes = self.outcomes([scheduler.run(None)])
+        self.runner.succeed(2)
+        self.assertEqual(outcomes, [None])
+
+    def test_failed_probe_opens_again(self):
+        scheduler = self.scheduler(breaker_threshold=1, breaker_reset=30)
+        scheduler.run(None).addErrback(lambda _: None)
+        self.runner.fail(0)
+
+        self.clock.advance(30)
+        scheduler.run(None).addErrback(lambda _: None)
+        self.runner.fail(1)
+        self.assertEqual(scheduler.opened, 30)
+
+        self.clock.advance(29)
+        self.assertEqual(self.outcomes([scheduler.run(None)]), [CircuitOpenError])
+
+    def test_limit_halved_once_per_round_trip(self):
+        scheduler = self.scheduler(max_requests=4, breaker_threshold=10)
+        for _ in range(4):
+            scheduler.run(None).addErrback(lambda _: None)
+        self.clock.advance(1)
+
+        self.runner.fail(0)
+        self.assertEqual(scheduler.limit, 2)
+        # Sent before the decrease, it does not lower the limit again
+        self.runner.fail(1)
+        self.assertEqual(scheduler.limit, 2)
+
+        self.runner.succeed(2)
+        self.assertEqual(scheduler.limit, 2.5)
+        # Sent after the decrease, it does
+        scheduler.run(None).addErrback(lambda _: None)
+        self.clock.advance(1)
+        self.runner.fail(4)
+        self.assertEqual(scheduler.limit, 1.25)
+
+    def test_limit_bounds_requests_in_flight(self):
+        scheduler = self.scheduler(max_requests=2)
+        for _ in range(3):
+            scheduler.run(None)
+        self.assertEqual(len(self.runner.calls), 2)
+        self.runner.succeed(0)
+        self.assertEqual(len(self.runner.calls), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
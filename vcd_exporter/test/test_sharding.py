@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import uuid
+
+from vcd_exporter.vcd_exporter import MAX_SHARD_COUNT, VcdApplicationResource, VcdCollector, _shard_of
+
+ORGS = [str(uuid.UUID(int=index * 7919 + 1)) for index in range(200)]
+
+
+class Args(object):
+
+    def __init__(self, shard_count=1):
+        self.config_file = None
+        self.shard_index, self.shard_count = 0, shard_count
+        self.threads = 1
+
+
+class Request(object):
+
+    def __init__(self, **args):
+        self.args = dict((key.encode(), [str(value).encode()]) for key, value in args.items())
+
+
+def _assignments(count):
+    return dict((org, _shard_of('urn:vcloud:org:{}'.format(org), count)) for org in ORGS)
+
+
+def _collector(shard=(0, 1), partition=(0, 1)):
+    return VcdCollector('vcd', 'user', 'org', 'password', False, None, target='a', shard=shard, partition=partition)
+
+
+class ShardOfTest(unittest.TestCase):
+
+    def test_each_org_in_one_shard(self):
+        for count in (1, 2, 3, 5):
+            collectors = [_collector(shard=(index, count)) for index in range(count)]
+            for org in ORGS:
+                href = 'https://vcd/api/org/{}'.format(org)
+                self.assertEqual(sum(1 for collector in collectors if collector._in_shard(href)), 1)
+
+    def test_each_org_in_one_partition(self):
+        for org in ORGS:
+            href = 'https://vcd/api/org/{}'.format(org)
+            collectors = [_collector(shard=(1, 3), partition=(index, 4)) for index in range(4)]
+            self.assertLessEqual(sum(1 for collector in collectors if collector._in_shard(href)), 1)
+            self.assertEqual(any(collector._in_shard(href) for collector in collectors),
+                             _collector(shard=(1, 3))._in_shard(href))
+
+    def test_spread(self):
+        counts = [0] * 4
+        for shard in _assignments(4).values():
+            counts[shard] += 1
+        self.assertTrue(all(count > len(ORGS) // 8 for count in counts), counts)
+
+    def test_stable_when_shards_added(self):
+        for count in range(1, 6):
+            before, after = _assignments(count), _assignments(count + 1)
+            moved = [org for org in ORGS if before[org] != after[org]]
+            self.assertTrue(moved)
+            # Only orgs of the new shard move, the others stay where they were
+            self.assertTrue(all(after[org] == count for org in moved))
+
+    def test_stable_when_orgs_change(self):
+        everything = _assignments(3)
+        some = dict((org, _shard_of('urn:vcloud:org:{}'.format(org), 3)) for org in ORGS[::3])
+        self.assertTrue(all(everything[org] == shard for org, shard in some.items()))
+
+
+class RequestShardTest(unittest.TestCase):
+
+    def test_command_line_shard(self):
+        vcd = VcdApplicationResource(Args(shard_count=1))
+        self.assertEqual(vcd.request_shard(Request()), (0, 1))
+        self.assertEqual(vcd.request_shard(Request(shard_index=2, shard_count=3)), (2, 3))
+
+    def test_invalid(self):
+        vcd = VcdApplicationResource(Args())
+        for args in ({'shard_index': 3, 'shard_count': 3}, {'shard_count': 0}, {'shard_index': 'a'}):
+            with self.assertRaises(ValueError):
+                vcd.request_shard(Request(**args))
+
+    def test_count_capped(self):
+        vcd = VcdApplicationResource(Args())
+        self.assertEqual(vcd.request_shard(Request(shard_count=MAX_SHARD_COUNT)), (0, MAX_SHARD_COUNT))
+        with self.assertRaises(ValueError):
+            vcd.request_shard(Request(shard_index=1, shard_count=MAX_SHARD_COUNT + 1))
+
+        # Every shard of the command line count can be asked for
+        vcd = VcdApplicationResource(Args(shard_count=MAX_SHARD_COUNT * 2))
+        self.assertEqual(vcd.request_shard(Request(shard_index=5, shard_count=MAX_SHARD_COUNT * 2)),
+                         (5, MAX_SHARD_COUNT * 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import unittest
+
+from vcd_exporter.vcd_exporter import EntityModel, GaugeFamily, StateStore
+
+
+class StateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = StateStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        parents = ('urn:vcloud:vdc:1', 'vdc1', 'urn:vcloud:org:1', 'org1', 'true')
+        vapp_labels = ('urn:vcloud:vapp:1', 'vapp1', 'true', '4') + parents
+        samples = [('vcd_vdc_vapp_status', vapp_labels, 4.0), ('vcd_vdc_vapp_in_maintenance', vapp_labels, 0.0)]
+
+        model = EntityModel()
+        model.begin()
+        model.origin = 'digest'
+        model.store('urn:vcloud:vapp:1', (('name', 'vapp1'), ('status', '4'), ('vms', ())), samples, parents,
+                    'https://vcd/api/vApp/vapp-1')
+        model.commit(samples)
+
+        status = GaugeFamily('vcd_vdc_vapp_status', 'Status of vApp', ['vapp_id', 'vapp_name'])
+        status.add_metric(vapp_labels, 4)
+        empty = GaugeFamily('vcd_org_is_enabled', 'Enabled status of Organization', ['org_name'])
+
+        self.store._write('vcd/a', (1, 3), 1234.5, [status, empty],
+                          (model.entities, model.checkpoint, model.synced, model.origin))
+        state = self.store.load()[('vcd/a', (1, 3))]
+
+        self.assertEqual(state['timestamp'], 1234.5)
+        self.assertEqual([(family.name, family.documentation, family.labels, family.samples)
+                          for family in state['families']],
+                         [(family.name, family.documentation, family.labels, family.samples)
+                          for family in (status, empty)])
+
+        restored = state['model']
+        self.assertEqual(restored.entities, model.entities)
+        self.assertEqual((restored.checkpoint, restored.synced, restored.origin),
+                         (model.checkpoint, model.synced, model.origin))
+        # Label tuples stay shared once restored
+        restored_samples = restored.entities['urn:vcloud:vapp:1']['samples']
+        self.assertIs(restored_samples[0][1], restored_samples[1][1])
+        self.assertIs(restored_samples[0][1], state['families'][0].samples[0][0])
+
+    def test_without_model(self):
+        self.store._write('default', (0, 1), 1.0, [], None)
+        self.assertIsNone(self.store.load()[('default', (0, 1))]['model'])
+
+    def test_unreadable_file_skipped(self):
+        with open(self.store.path('default', (0, 1)), 'wb') as handle:
+            handle.write(b'not a state')
+        self.assertEqual(self.store.load(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from unittest import mock
+
+from twisted.internet import defer, task
+
+from vcd_exporter.vcd_exporter import GaugeFamily, UsageCollector
+
+USAGE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<CurrentUsage xmlns="http://www.vmware.com/vcloud/v1.5">
+    <Metric name="cpu.usage.average" unit="PERCENT" value="12.5"/>
+    <Metric name="disk.used.latest" unit="KILOBYTE" value="2"/>
+</CurrentUsage>
+"""
+
+
+class FakeClient(object):
+
+    def get_api_uri(self):
+        return 'https://vcd/api'
+
+
+class FakeScheduler(object):
+
+    def prioritized(self, priority, runner=None):
+        def run(fn, *args):
+            return (runner or defer.maybeDeferred)(fn, *args)
+        return run
+
+
+class FakeConnection(object):
+    """
+    Connection whose vCD GET requests stay pending until the test fires them
+    """
+
+    def __init__(self):
+        self.vcd_client = FakeClient()
+        self.agent = object()
+        self.scheduler = FakeScheduler()
+        self.requests = []
+
+    def get(self, href):
+        result = defer.Deferred()
+        self.requests.append((href, result))
+        return result
+
+    def run_in_thread(self, fn, *args):
+        return defer.maybeDeferred(fn, *args)
+
+
+class FakeSessions(object):
+
+    def __init__(self):
+        self.vcd_connection = FakeConnection()
+        self.error = None
+        self.calls = 0
+
+    def connection(self, target, settings):
+        self.calls += 1
+        if self.error is not None:
+            return defer.fail(self.error)
+        return defer.succeed(self.vcd_connection)
+
+
+def _vm_status(count):
+    family = GaugeFamily('vcd_vdc_vapp_vm_status', 'Status of VM', labels=['vm_id', 'vm_name'])
+    for index in range(count):
+        family.add_metric(('urn:vcloud:vm:{}'.format(index), 'vm-{}'.format(index)), 4)
+    return family
+
+
+class UsageCollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sessions = FakeSessions()
+        self.log = mock.patch('vcd_exporter.vcd_exporter.log').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def collector(self, vms, **settings):
+        collector = UsageCollector('a', settings, self.sessions)
+        collector.loop.clock = task.Clock()
+        collector.vms = [labels for labels, _ in _vm_status(vms).samples]
+        collector.labels = ('vm_id', 'vm_name')
+        self.addCleanup(collector.stop)
+        return collector
+
+    def families(self, collector):
+        return {family.name: family.samples for family in collector.families}
+
+    def test_requests_bounded(self):
+        collector = self.collector(5, max_usage_requests=2)
+        done = collector.refresh()
+        requests = self.sessions.vcd_connection.requests
+        self.assertEqual([href for href, _ in requests],
+                         ['https://vcd/api/vApp/vm-0/metrics/current', 'https://vcd/api/vApp/vm-1/metrics/current'])
+
+        requests[0][1].callback(USAGE)
+        self.assertEqual(len(requests), 3)
+        for index in range(1, 5):
+            self.assertEqual(sum(1 for _, result in requests if not result.called), 2 if index < 4 else 1)
+            requests[index][1].callback(USAGE)
+        self.assertTrue(done.called)
+        self.assertEqual(len(collector.families), 3)
+
+    def test_families(self):
+        collector = self.collector(2)
+        collector.refresh()
+        for _, result in self.sessions.vcd_connection.requests:
+            result.callback(USAGE)
+
+        families = self.families(collector)
+        self.assertEqual(families['vcd_vdc_vapp_vm_cpu_usage_average_percent'][1],
+                         (('urn:vcloud:vm:1', 'vm-1'), 12.5))
+        self.assertEqual(families['vcd_vdc_vapp_vm_disk_used_latest_bytes'][0],
+                         (('urn:vcloud:vm:0', 'vm-0'), 2048.0))
+        self.assertEqual(len(families['vcd_vm_usage_timestamp_seconds']), 1)
+        self.assertEqual(collector.families[0].labels, ('vm_id', 'vm_name'))
+
+    def test_vm_error(self):
+        collector = self.collector(2)
+        done = collector.refresh()
+        requests = self.sessions.vcd_connection.requests
+        requests[0][1].errback(ValueError('Not found'))
+        requests[1][1].callback(USAGE)
+
+        self.assertTrue(done.called)
+        families = self.families(collector)
+        self.assertEqual([labels for labels, _ in families['vcd_vdc_vapp_vm_cpu_usage_average_percent']],
+                         [('urn:vcloud:vm:1', 'vm-1')])
+
+    def test_previous_families_kept(self):
+        collector = self.collector(1)
+        collector.refresh()
+        self.sessions.vcd_connection.requests[0][1].callback(USAGE)
+        families = collector.families
+
+        self.sessions.error = ValueError('Login failed')
+        done = collector.refresh()
+        self.assertTrue(done.called)
+        self.assertIs(collector.families, families)
+
+    def test_single_flight(self):
+        collector = self.collector(1)
+        first = collector.refresh()
+        second = collector.refresh()
+        self.assertEqual(self.sessions.calls, 1)
+        self.assertEqual(len(self.sessions.vcd_connection.requests), 1)
+
+        self.sessions.vcd_connection.requests[0][1].callback(USAGE)
+        self.assertTrue(first.called and second.called)
+        collector.refresh()
+        self.assertEqual(self.sessions.calls, 2)
+
+    def test_update(self):
+        collector = self.collector(0, usage_interval=60)
+        collector.update([_vm_status(2)])
+        self.assertTrue(collector.loop.running)
+        self.assertEqual(len(self.sessions.vcd_connection.requests), 2)
+        for _, result in self.sessions.vcd_connection.requests:
+            result.callback(USAGE)
+
+        collector.update([_vm_status(3)])
+        self.assertEqual(len(self.sessions.vcd_connection.requests), 2)
+        collector.loop.clock.advance(60)
+        self.assertEqual(len(self.sessions.vcd_connection.requests), 5)
+
+        collector.stop()
+        self.assertFalse(collector.loop.running)
+
+
+if __name__ == '__main__':
+    unittest.main()
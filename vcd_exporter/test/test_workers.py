@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from vcd_exporter.vcd_exporter import (CIRCUIT_OPEN, VCD_CONCURRENCY, VCD_REQUEST_DURATION, VCD_REQUESTS,
+                                       WORKER_METRICS, WorkerPool, _metric_values, _partition_settings,
+                                       _worker_metrics)
+
+
+def _index(metric):
+    return [metric for metric, _ in WORKER_METRICS].index(metric)
+
+
+class WorkerMetricsTest(unittest.TestCase):
+
+    def test_counter_increments(self):
+        sent = {}
+        VCD_REQUESTS.labels('worker-counter', 'GET', '/api/org', '200').inc(3)
+        changes = [change for change in _worker_metrics(sent) if change[1][0] == 'worker-counter']
+        self.assertEqual(changes, [(_index(VCD_REQUESTS), ('worker-counter', 'GET', '/api/org', '200'), (3.0,))])
+
+        VCD_REQUESTS.labels('worker-counter', 'GET', '/api/org', '200').inc(2)
+        changes = [change for change in _worker_metrics(sent) if change[1][0] == 'worker-counter']
+        self.assertEqual(changes, [(_index(VCD_REQUESTS), ('worker-counter', 'GET', '/api/org', '200'), (2.0,))])
+
+        changes = [change for change in _worker_metrics(sent) if change[1][0] == 'worker-counter']
+        self.assertEqual(changes, [])
+
+    def test_histogram_added_to_exporter(self):
+        labels = ('worker-histogram', '/api/org')
+        buckets = (1.0, 2.0) + (0.0,) * (len(VCD_REQUEST_DURATION._upper_bounds) - 2)
+        changes = [(_index(VCD_REQUEST_DURATION), labels, buckets + (0.02,))]
+        before = _metric_values(VCD_REQUEST_DURATION).get(labels)
+        WorkerPool(1)._add_metrics(0, changes)
+
+        after = _metric_values(VCD_REQUEST_DURATION)[labels]
+        self.assertIsNone(before)
+        self.assertEqual(after[:2], (1.0, 2.0))
+        self.assertAlmostEqual(after[-1], 0.02)
+
+    def test_gauges_merged_across_workers(self):
+        pool = WorkerPool(2)
+        concurrency, circuit = _index(VCD_CONCURRENCY), _index(CIRCUIT_OPEN)
+        pool._add_metrics(0, [(concurrency, ('worker-gauge',), (4.0,)), (circuit, ('worker-gauge',), (0.0,))])
+        pool._add_metrics(1, [(concurrency, ('worker-gauge',), (3.0,)), (circuit, ('worker-gauge',), (1.0,))])
+        self.assertEqual(_metric_values(VCD_CONCURRENCY)[('worker-gauge',)], (7.0,))
+        self.assertEqual(_metric_values(CIRCUIT_OPEN)[('worker-gauge',)], (1.0,))
+
+        # A restarted worker starts with no gauges
+        pool._add_metrics(1, [])
+        self.assertEqual(_metric_values(VCD_CONCURRENCY)[('worker-gauge',)], (4.0,))
+        self.assertEqual(_metric_values(CIRCUIT_OPEN)[('worker-gauge',)], (0.0,))
+
+        pool._add_metrics(0, [])
+        self.assertNotIn(('worker-gauge',), _metric_values(VCD_CONCURRENCY))
+
+
+class PartitionSettingsTest(unittest.TestCase):
+
+    def test_limits_split(self):
+        settings = {'max_requests': 16, 'rate_limit': 10, 'rate_burst': 5, 'vcd_host': 'vcd'}
+        self.assertEqual(_partition_settings(settings, 4),
+                         {'max_requests': 4, 'rate_limit': 2.5, 'rate_burst': 1, 'vcd_host': 'vcd'})
+        self.assertEqual(settings['max_requests'], 16)
+
+    def test_limits_kept_at_one(self):
+        self.assertEqual(_partition_settings({'max_requests': 2}, 4), {'max_requests': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,30 +2,297 @@
 # -*- python -*-
 # -*- coding: utf-8 -*-
 
+import cProfile
 import datetime
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
+import marshal
+import math
+import multiprocessing
+import pstats
+import random
+import re
 import pytz
+import signal
+import threading
+import time
+import tracemalloc
 import yaml
 import textwrap
+import zlib
+from urllib.parse import quote, urlparse, parse_qs
 from argparse import ArgumentParser
 
 # Twisted
-from twisted.internet import reactor, endpoints, defer  # , threads # Leaves room for improvement
+from twisted.internet import reactor, endpoints, defer, error, task, threads
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
+from zope.interface import implementer
+from twisted.internet.interfaces import IPullProducer
 from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.resource import Resource
+from twisted.web.client import (Agent, ContentDecoderAgent, GzipDecoder, HTTPConnectionPool, ResponseFailed,
+                                ResponseNeverReceived, RequestTransmissionFailed, readBody)
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IPolicyForHTTPS
 
 # Prometheus
+from prometheus_client import Counter, Gauge, Histogram
 from prometheus_client.core import GaugeMetricFamily
-from prometheus_client.registry import CollectorRegistry
+from prometheus_client.registry import REGISTRY
 from prometheus_client.exposition import generate_latest
+from prometheus_client.openmetrics.exposition import CONTENT_TYPE_LATEST as OPENMETRICS_CONTENT_TYPE
+from prometheus_client.openmetrics.exposition import generate_latest as generate_openmetrics
+from prometheus_client.utils import floatToGoString
 
 # vCD
 from pyvcloud.vcd.client import *
 from pyvcloud.vcd.org import *
 from pyvcloud.vcd.vapp import *
 
+# vCD notifications, optional
+try:
+    import pika
+    from pika.adapters.twisted_connection import TwistedProtocolConnection
+except ImportError:
+    pika = None
+
 # Ignore SSL warnings
 requests.packages.urllib3.disable_warnings()
 
+# Default limits of concurrent vCD requests, overall and per level of the org/vDC/vApp walk
+MAX_REQUESTS = 16
+MAX_LEVEL_REQUESTS = {
+    'org': 4,
+    'vdc': 8,
+    'vapp': 16,
+}
+
+# Levels of the org/vDC/vApp/VM walk that can be collected, and the metric_list groups they fill
+LEVELS = ('org', 'vdc', 'vapp', 'vm')
+LEVEL_FAMILIES = {
+    'org': 'org',
+    'vdc': 'vdc',
+    'vapp': 'vapp_resources',
+    'vm': 'vm_resources',
+}
+
+# Records per page asked from the vCD query service
+QUERY_PAGE_SIZE = 128
+
+# Orgs per vApp or VM query when only some orgs are collected, bounds the length of the query filter
+QUERY_FILTER_ORGS = 25
+
+# Largest shard_count a scrape may ask for, each shard of a target keeps its own entity model and collection
+MAX_SHARD_COUNT = 16
+
+# Seconds after which incremental collection drops its entity model and fetches everything again
+RESYNC_INTERVAL = 3600
+
+# Seconds subtracted from the task window of incremental collection to allow for clock skew with vCD
+TASK_CLOCK_SKEW = 60
+
+# Exposition lines rendered per chunk written to a response
+CHUNK_LINES = 2048
+
+# Content type of the Prometheus text format, OpenMetrics uses the one of prometheus_client
+TEXT_CONTENT_TYPE = 'text/plain; charset=UTF-8'
+
+# zlib level of gzip encoded responses
+GZIP_LEVEL = 6
+
+# Priority of the requests of each level of the walk, lower first, cheap orgs and vDCs go before vApps
+LEVEL_PRIORITY = {
+    'org': 0,
+    'vdc': 1,
+    'vapp': 2,
+}
+
+# Seconds kept from a scrape deadline to render and send the response, at most half of it
+DEADLINE_MARGIN = 0.5
+
+# Defaults of the scheduler of the vCD requests of a target, see RequestScheduler
+SCHEDULER_SETTINGS = {
+    'rate_limit': 0,         # requests per second, 0 for no limit
+    'rate_burst': 0,         # requests allowed at once by the rate limit, 0 for max_requests
+    'min_requests': 1,       # floor of the adaptive concurrency limit
+    'latency_target': 0,     # seconds above which a response lowers the concurrency limit, 0 to only react to errors
+    'max_retries': 3,        # retries of a request failing with a transient error
+    'retry_backoff': 0.5,    # seconds of the first retry backoff, doubled on each retry and jittered
+    'breaker_threshold': 5,  # consecutive requests failing all their retries opening the circuit breaker
+    'breaker_reset': 30,     # seconds the circuit breaker stays open before letting a trial request through
+}
+
+# Upper bound of the retry backoff in seconds
+MAX_RETRY_BACKOFF = 30
+
+# HTTP status codes of vCD answers worth retrying later, vCD cells answer 503 when overloaded
+RETRY_STATUS = (429, 502, 503, 504)
+
+# Parsers of vDC, vApp and query responses, iterparse only keeps the fields the metrics need
+XML_PARSERS = ('iterparse', 'objectify')
+
+# HTTP clients of the vCD requests, agent sends them from the reactor instead of one thread each
+HTTP_CLIENTS = ('requests', 'agent')
+
+# Fields of a vDC and of the VMs of a vApp read by the iterparse parsers, by element path below the entity
+VDC_FIELDS = {
+    ('IsEnabled',): 'is_enabled',
+    ('AllocationModel',): 'allocation_model',
+    ('ComputeCapacity', 'Cpu', 'Allocated'): 'cpu_allocated',
+    ('ComputeCapacity', 'Memory', 'Allocated'): 'memory_allocated',
+    ('ComputeCapacity', 'Memory', 'Used'): 'memory_used',
+    ('VCpuInMhz2',): 'vcpu_in_mhz',
+    ('UsedNetworkCount',): 'used_network_count',
+}
+VM_FIELDS = {
+    ('VmSpecSection', 'NumCpus'): 'cpus',
+    ('VmSpecSection', 'MemoryResourceMb', 'Configured'): 'memory_mb',
+}
+
+# Seconds a collection worker process may take for one job before it is considered hung and restarted
+WORKER_TIMEOUT = 600
+
+# Defaults of the notification consumer of a section, see NotificationConsumer
+NOTIFICATION_SETTINGS = {
+    'url': None,                   # AMQP URL of the broker vCD publishes its notifications to
+    'exchange': 'systemExchange',  # exchange vCD publishes its notifications to
+    'queue': '',                   # durable queue to consume, a temporary queue of the exporter when empty
+}
+
+# Routing keys of the notifications of the entities collected, vCD appends the event type to them
+NOTIFICATION_KEYS = (
+    '#.com.vmware.vcloud.event.org.#',
+    '#.com.vmware.vcloud.event.vdc.#',
+    '#.com.vmware.vcloud.event.vapp.#',
+    '#.com.vmware.vcloud.event.vm.#',
+)
+
+# Seconds between attempts to connect to the notification broker of a section
+NOTIFICATION_RETRY = 10
+
+# Seconds after which a target kept up to date by notifications is collected in full again
+RECONCILE_INTERVAL = 900
+
+# Seconds between refreshes of the VM usage metrics of a target, and vCD requests in flight for them
+USAGE_INTERVAL = 300
+MAX_USAGE_REQUESTS = 4
+
+# Priority of the usage metrics requests in the scheduler of a session, after every level of the walk
+USAGE_PRIORITY = 3
+
+# Units of the vCD VM metrics, with the suffix of their family name and the factor to that unit
+USAGE_UNITS = {
+    'PERCENT': ('_percent', 1),
+    'MEGAHERTZ': ('_mhz', 1),
+    'KILOBYTE': ('_bytes', 1024),
+    'KILOBYTES_PER_SECOND': ('_bytes_per_second', 1024),
+}
+
+# Frames kept by tracemalloc for each allocation while /debug/profile runs, allocations are reported by the
+# line making them, and lines of the report sections
+PROFILE_FRAMES = 1
+PROFILE_TOP = 30
+
+# Version of the state files written to --state-dir, files of another version are ignored
+STATE_VERSION = 2
+
+# Numeric codes of the vApp/VM states reported by name in query records
+VCD_STATUS = {
+    'FAILED_CREATION': -1,
+    'UNRESOLVED': 0,
+    'RESOLVED': 1,
+    'DEPLOYED': 2,
+    'SUSPENDED': 3,
+    'POWERED_ON': 4,
+    'WAITING_FOR_INPUT': 5,
+    'UNKNOWN': 6,
+    'UNRECOGNIZED': 7,
+    'POWERED_OFF': 8,
+    'INCONSISTENT_STATE': 9,
+    'MIXED': 10
+}
+
+# Ids in vCD urls, replaced so the endpoint label of the API metrics stays bounded
+VCD_ID = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+
+# Self-instrumentation, served on /metrics
+COLLECTION_DURATION = Histogram(
+    'vcd_exporter_collection_duration_seconds',
+    'Duration of the collections of a target',
+    ['target'],
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, float('inf')))
+PHASE_DURATION = Histogram(
+    'vcd_exporter_phase_duration_seconds',
+    'Duration of the vCD calls of a target for one org, vDC, vApp or VM query',
+    ['target', 'phase'])
+PROCESSING_DURATION = Histogram(
+    'vcd_exporter_processing_duration_seconds',
+    'Part of a vCD call not spent waiting on HTTP, mostly XML parsing and building samples',
+    ['target', 'phase'])
+COLLECTION_ERRORS = Counter(
+    'vcd_exporter_collection_errors',
+    'Orgs, vDCs, vApps, VMs or queries that could not be collected',
+    ['target', 'level'])
+SERIES = Gauge(
+    'vcd_exporter_series',
+    'Series emitted per family by the last collection of a target',
+    ['target', 'family'])
+VCD_REQUESTS = Counter(
+    'vcd_exporter_vcd_requests',
+    'vCD API requests by endpoint and status code',
+    ['target', 'method', 'endpoint', 'code'])
+VCD_REQUEST_DURATION = Histogram(
+    'vcd_exporter_vcd_request_duration_seconds',
+    'Latency of vCD API requests until their body is read',
+    ['target', 'endpoint'])
+VCD_RESPONSE_BYTES = Counter(
+    'vcd_exporter_vcd_response_bytes',
+    'Bytes of vCD API response bodies',
+    ['target', 'endpoint'])
+VCD_RETRIES = Counter(
+    'vcd_exporter_vcd_retries',
+    'vCD API requests retried after a transient error',
+    ['target'])
+VCD_REJECTED = Counter(
+    'vcd_exporter_vcd_rejected',
+    'vCD API requests failed without being sent because the circuit breaker was open',
+    ['target'])
+VCD_CONCURRENCY = Gauge(
+    'vcd_exporter_vcd_concurrency_limit',
+    'Adaptive limit of vCD API requests in flight',
+    ['target'])
+CIRCUIT_OPEN = Gauge(
+    'vcd_exporter_circuit_open',
+    'Whether the circuit breaker toward vCD is open',
+    ['target'])
+WORKER_RESTARTS = Counter(
+    'vcd_exporter_worker_restarts',
+    'Collection worker processes restarted after they crashed or hung',
+    ['reason'])
+
+# Metrics of the collections run in worker processes, sent to the exporter process with each result. Counters and
+# histograms are added up, the gauges of the partitions of a target are merged with the given function. The
+# collection duration and series of a target are recorded by the exporter process itself.
+WORKER_METRICS = (
+    (PHASE_DURATION, None),
+    (PROCESSING_DURATION, None),
+    (COLLECTION_ERRORS, None),
+    (VCD_REQUESTS, None),
+    (VCD_REQUEST_DURATION, None),
+    (VCD_RESPONSE_BYTES, None),
+    (VCD_RETRIES, None),
+    (VCD_REJECTED, None),
+    (VCD_CONCURRENCY, sum),
+    (CIRCUIT_OPEN, max),
+)
+
+# HTTP time of the vCD calls of the current worker thread, to tell it from processing time
+_http_time = threading.local()
+
 
 def log(data, *args):
     """
@@ -34,470 +301,2968 @@ def log(data, *args):
     print("[{0}] {1}".format(datetime.utcnow().replace(tzinfo=pytz.utc), data % args))
 
 
-class ListCollector(object):
+def _href_id(href):
     """
-    Class for returning full list of collected metrics
+    Return the uuid at the end of a vCD href, e.g. .../vApp/vapp-<uuid>
     """
+    tail = href.rstrip('/').rsplit('/', 1)[-1]
+    for prefix in ('vapp-', 'vm-'):
+        if tail.startswith(prefix):
+            return tail[len(prefix):]
+    return tail
 
-    def __init__(self, metrics):
-        self.metrics = list(metrics)
 
-    def collect(self):
-        return self.metrics
+def _query_status(status):
+    return VCD_STATUS.get(status, VCD_STATUS['UNKNOWN'])
 
 
-class VcdApplicationResource(Resource):
+def _query_bool(value):
+    return 1 if str(value).lower() == 'true' else 0
+
+
+def _xml_bool(text):
     """
-    Class for Vac Exporter Application configuration
+    Label value of an xsd:boolean, as lxml objectify renders it
     """
+    return str(bool(_query_bool(text)))
 
-    def __init__(self, args):
-        Resource.__init__(self)
-        self.config = {}
-        self.section = ''
-        self.args = args
 
-    def configure(self, section):
-        """
-        Configure connection to Vac
-        :param section: section in the config file
-        """
-        if self.args.config_file:
-            with open(self.args.config_file) as handle:
-                self.config = yaml.safe_load(handle)
-                try:
-                    self.config.get(section)
-                except Exception as err:
-                    log("Unable to find section: {}".format(err))
-                    return defer.logError(err)
+def _child_text(element, *path):
+    """
+    Text of a descendant of an objectified element, None when it is missing
+    """
+    for name in path:
+        element = getattr(element, name, None)
+        if element is None:
+            return None
+    return element.text
 
-        else:
-            """
-            Set configuration from OS environement variables
-            """
-            self.config = {
-                'default': {
-                    'vcd_user': os.environ.get('VCD_USER'),
-                    'vcd_org': os.environ.get('VCD_ORG'),
-                    'vcd_password': os.environ.get('VCD_PASSWORD'),
-                    'ignore_ssl': os.environ.get('VCD_IGNORE_SSL', False),
-                }
-            }
-            for key in os.environ.keys():
-                if key == 'VCD_USER':
-                    continue
-                if not key.startswith('VCD_') or not key.endswith('_USER'):
-                    continue
 
-                section = key.split('_', 1)[1].rsplit('_', 1)[0]
+def _vdc_summary(resource):
+    """
+    Fields of an objectified vDC the metrics need
+    """
+    vdc = {
+        'id': resource.get('id'),
+        'name': resource.get('name'),
+        'href': resource.get('href'),
+        'vapps': [],
+    }
+    for path, key in VDC_FIELDS.items():
+        vdc[key] = _child_text(resource, *path)
+    vdc['is_enabled'] = _xml_bool(vdc['is_enabled'])
+
+    # Same as vdc.list_resources(EntityType.VAPP) but keeping the href of each vApp
+    if hasattr(resource, 'ResourceEntities') and hasattr(resource.ResourceEntities, 'ResourceEntity'):
+        for entity in resource.ResourceEntities.ResourceEntity:
+            if entity.get('type') == EntityType.VAPP.value:
+                vdc['vapps'].append({'name': entity.get('name'), 'type': entity.get('type'),
+                                     'href': entity.get('href')})
+    return vdc
+
+
+def _vapp_summary(resource):
+    """
+    Fields of an objectified vApp and its VMs the metrics need
+    """
+    vapp = {
+        'id': resource.get('id'),
+        'name': resource.get('name'),
+        'deployed': resource.get('deployed'),
+        'status': resource.get('status'),
+        'in_maintenance': _child_text(resource, 'InMaintenanceMode'),
+        'vms': [],
+    }
+    if hasattr(resource, 'Children') and hasattr(resource.Children, 'Vm'):
+        for vm in resource.Children.Vm:
+            summary = {key: vm.get(key) for key in ('id', 'name', 'deployed', 'status')}
+            for path, key in VM_FIELDS.items():
+                summary[key] = _child_text(vm, *path)
+            vapp['vms'].append(summary)
+    return vapp
+
+
+def _iterparse(content):
+    """
+    Walk an XML document, yielding each start and end event with the path of local names
+    from the root, elements are cleared once their end was handled so memory stays flat
+    """
+    path = []
+    for event, element in etree.iterparse(io.BytesIO(content), events=('start', 'end')):
+        if event == 'start':
+            path.append(etree.QName(element).localname)
+            yield event, element, tuple(path)
+            continue
+
+        yield event, element, tuple(path)
+        path.pop()
+        if len(path) in (1, 2):
+            # Drop the handled children of the entity and of its direct children
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+def _parse_vdc(content):
+    """
+    Fields of a vDC document the metrics need, same as _vdc_summary()
+    """
+    vdc = {key: None for key in VDC_FIELDS.values()}
+    vdc['vapps'] = []
+    for event, element, path in _iterparse(content):
+        if event == 'start':
+            if len(path) == 1:
+                vdc.update(id=element.get('id'), name=element.get('name'), href=element.get('href'))
+            elif path[1:] == ('ResourceEntities', 'ResourceEntity') and element.get('type') == EntityType.VAPP.value:
+                vdc['vapps'].append({'name': element.get('name'), 'type': element.get('type'),
+                                     'href': element.get('href')})
+        elif path[1:] in VDC_FIELDS:
+            vdc[VDC_FIELDS[path[1:]]] = element.text
+    vdc['is_enabled'] = _xml_bool(vdc['is_enabled'])
+    return vdc
+
+
+def _parse_vapp(content):
+    """
+    Fields of a vApp document and its VMs the metrics need, same as _vapp_summary()
+    """
+    vapp = {'in_maintenance': None, 'vms': []}
+    for event, element, path in _iterparse(content):
+        if event == 'start':
+            if len(path) == 1:
+                vapp.update({key: element.get(key) for key in ('id', 'name', 'deployed', 'status')})
+            elif path[1:] == ('Children', 'Vm'):
+                vm = {key: element.get(key) for key in ('id', 'name', 'deployed', 'status')}
+                vm.update({key: None for key in VM_FIELDS.values()})
+                vapp['vms'].append(vm)
+        elif path[1:] == ('InMaintenanceMode',):
+            vapp['in_maintenance'] = element.text
+        elif path[1:3] == ('Children', 'Vm') and path[3:] in VM_FIELDS:
+            vapp['vms'][-1][VM_FIELDS[path[3:]]] = element.text
+    return vapp
+
+
+def _parse_org_list(content):
+    """
+    Hrefs of the orgs of an OrgList document
+    """
+    return [element.get('href') for event, element, path in _iterparse(content)
+            if event == 'start' and path[1:] == ('Org',)]
 
-                self.config[section.lower()] = {
-                    'vcd_user': os.environ.get('VCD_{}_USER'.format(section)),
-                    'vcd_org': os.environ.get('VCD_{}_ORG'.format(section)),
-                    'vcd_password': os.environ.get('VCD_{}_PASSWORD'.format(section)),
-                    'ignore_ssl': os.environ.get('VCD_{}_IGNORE_SSL'.format(section), False),
-                }
 
-        # Set section for context
-        if section == 'default':
-            self.section = 'default'
-        else:
-            try:
-                if self.config.get(section):
-                    self.section = section
-                else:
-                    raise Exception("Unable to find section: {}".format(section))
-            except Exception as err:
-                log("Section not valid, error: {}".format(err))
-                return 2
+def _parse_query_page(content):
+    """
+    Records of a query page as dicts of their attributes, in the shape of the result of a paged
+    pyvcloud typed query
+    """
+    result = {'values': []}
+    for event, element, path in _iterparse(content):
+        if event == 'start':
+            if len(path) == 1:
+                result['resultTotal'] = int(element.get('total'))
+        elif len(path) == 2 and path[1] != 'Link':
+            result['values'].append(dict(element.attrib))
+    return result
 
-        # Open vCD User context
-        with VcdConnection(self.config[self.section].get('vcd_user'), self.config[self.section].get('vcd_org'),
-                           self.config[self.section].get('vcd_password'), self.config[self.section].get('vcd_host'),
-                           self.config[self.section].get('ignore_ssl')
-                           ) as vcd:
-            conn = vcd.connection()
 
-            def onError(err):
-                log("Error connecting to vCD endpoint: {}".format(err))
-                pass
+def _get_raw(client, uri):
+    """
+    GET a vCD resource without parsing it, failures raise the same exceptions as pyvcloud
+    :return: body of the response
+    """
+    response = client._do_request_prim('GET', uri, client._session)
+    if response.status_code == requests.codes.ok:
+        return response.content
 
-            conn.addErrback(onError)
+    client._response_code_to_exception(
+        response.status_code, client._get_response_request_id(response),
+        objectify.fromstring(response.content) if response.content else None)
 
-            def onSuccess(connection):
-                self.vcd_user = self.config[self.section].get('vcd_user')
-                self.vcd_org = self.config[self.section].get('vcd_org')
-                self.vcd_password = self.config[self.section].get('vcd_password')
-                self.vcd_host = self.config[self.section].get('vcd_host')
-                self.ignore_ssl = self.config[self.section].get('ignore_ssl')
-                self.vcd_client = connection
-                log("Configuration complete for: {}".format(self.config[self.section].get('vcd_host')))
 
-            conn.addCallback(onSuccess)
+def _transient(err):
+    """
+    Whether a vCD call failed in a way worth retrying later: a timeout, a dropped connection or
+    an overloaded vCD
+    """
+    if isinstance(err, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(err, (error.ConnectError, error.ConnectionLost, ResponseFailed, ResponseNeverReceived,
+                        RequestTransmissionFailed)):
+        return True
+    return isinstance(err, VcdResponseException) and err.status_code in RETRY_STATUS
 
-        return NOT_DONE_YET
 
-    def render_GET(self, request):
-        """
-        Render data from collector
-        """
-        if b'target' in request.args:
-            result = self.configure(request.args[b'target'][0].decode("utf-8"))
-            if result == 2:
-                return "No Config found for: {}".format(request.args[b'target'][0].decode("utf-8")).encode()
-            else:
-                collector = VcdCollector(
-                    request.args[b'target'][0].decode("utf-8"),
-                    self.vcd_user,
-                    self.vcd_org,
-                    self.vcd_password,
-                    self.ignore_ssl,
-                    self.vcd_client
-                )
-        else:
-            self.configure("default")
-            collector = VcdCollector(
-                self.vcd_host,
-                self.vcd_user,
-                self.vcd_org,
-                self.vcd_password,
-                self.ignore_ssl,
-                self.vcd_client
-            )
+def _levels(settings):
+    """
+    Collected levels of a section, in walk order
+    """
+    levels = settings.get('collect_levels') or LEVELS
+    return [level for level in LEVELS if level in levels]
 
-        metrics = collector.collect()
 
-        def onError(err):
-            log("Collection Error: {}".format(err))
+def _completeness_family(ratios):
+    """
+    Family of the share of each level a scrape collected
+    """
+    family = GaugeFamily(
+        'vcd_scrape_completeness',
+        'Share of the entities of each level in the scrape, below 1 when it was cut short by its deadline',
+        labels=['level'])
+    for level, ratio in ratios.items():
+        family.add_metric((level,), ratio)
+    return family
+
 
-        metrics.addErrback(onError)
+def _parse_notification(content):
+    """
+    Read a vCD notification
+    :return: dict of the event type, whether the operation succeeded, and the type and URN of
+             the entity and of its parent
+    """
+    root = etree.fromstring(content)
+    notification = {'type': root.get('type') or '', 'success': True, 'entity': (None, None), 'up': (None, None)}
+    for element in root.iter('{*}EntityLink', '{*}OperationSuccess'):
+        if etree.QName(element).localname == 'OperationSuccess':
+            notification['success'] = bool(_query_bool((element.text or '').strip()))
+        elif element.get('rel') in ('entity', 'up'):
+            notification[element.get('rel')] = (element.get('type'), element.get('id'))
+    return notification
 
-        def onSuccess(metric_list):
-            registry = CollectorRegistry()
-            registry.register(ListCollector(metric_list))
-            output = generate_latest(registry)
 
-            request.setHeader("Content-Type", "text/plain; charset=UTF-8")
-            request.setResponseCode(200)
-            request.write(output)
-            request.finish()
+def _parse_usage(content):
+    """
+    Read the CurrentUsage document of a VM
+    :return: list of tuples of the name, unit and value of each metric
+    """
+    metrics = []
+    for event, element, path in _iterparse(content):
+        if event == 'start' and path[1:] == ('Metric',):
+            metrics.append((element.get('name'), element.get('unit'), element.get('value')))
+    return metrics
 
-        metrics.addCallback(onSuccess)
 
-        return NOT_DONE_YET
+def _usage_family_name(metric, unit):
+    """
+    Name of the family of a vCD VM metric, e.g. disk.used.latest in KILOBYTE is vcd_vdc_vapp_vm_disk_used_latest_bytes
+    """
+    suffix, _ = USAGE_UNITS.get(unit, ('', 1))
+    return 'vcd_vdc_vapp_vm_{}{}'.format(re.sub(r'[^a-zA-Z0-9_]', '_', metric), suffix)
 
 
-class VcdCollector:
+def _restored_family(timestamp):
     """
-    Class for vCD collector
+    Gauge marking output restored from the state directory, with the time it was collected at
     """
+    family = GaugeFamily(
+        'vcd_scrape_restored_timestamp_seconds',
+        'Unix time of the collection of a previous run of the exporter, served until a new one is done')
+    family.add_metric((), timestamp)
+    return family
 
-    def __init__(self, vcd_host, vcd_user, vcd_org, vcd_password, ignore_ssl, vcd_client):
-        self.vcd_host = vcd_host
-        self.vcd_user = vcd_user
-        self.vcd_org = vcd_org
-        self.vcd_password = vcd_password
-        self.ignore_ssl = ignore_ssl
-        self.vcd_client = vcd_client
-        self.vdc_resources = None
 
-    def collect(self):
-        metric_list = dict()
-        metric_list['org'] = {
-            'vcd_org_is_enabled': GaugeMetricFamily(
-                'vcd_org_is_enabled',
-                json.dumps({
-                    "Description": "Enabled status of Organization",
-                    "Enabled": 1,
-                    "Disabled": 0
-                }),
-                labels=['org_name', 'org_full_name', 'org_id'])
-        }
-        metric_list['vdc'] = {
-            'vcd_vdc_cpu_allocated': GaugeMetricFamily(
-                'vcd_vdc_cpu_allocated',
-                'CPU allocated to vdc',
-                labels=['vdc_id', 'vdc_name', 'org_id', 'org_name', 'vdc_is_enabled', 'allocation_model']),
-            'vcd_vdc_mhz_to_vcpu': GaugeMetricFamily(
-                'vcd_vdc_mhz_to_vcpu',
-                'Mhz to vCPU ratio of vdc',
-                labels=['vdc_id', 'vdc_name', 'org_id', 'org_name', 'vdc_is_enabled', 'allocation_model']),
-            'vcd_vdc_memory_allocated': GaugeMetricFamily(
-                'vcd_vdc_memory_allocated',
-                'Memory allocated to vdc',
-                labels=['vdc_id', 'vdc_name', 'org_id', 'org_name', 'vdc_is_enabled', 'allocation_model']),
-            'vcd_vdc_memory_used_bytes': GaugeMetricFamily(
-                'vcd_vdc_memory_used_bytes',
-                'Memory used by vdc in bytes',
-                labels=['vdc_id', 'vdc_name', 'org_id', 'org_name', 'vdc_is_enabled', 'allocation_model']),
-            'vcd_vdc_used_network_count': GaugeMetricFamily(
-                'vcd_vdc_used_network_count',
-                'Number of networks used by vdc',
-                labels=['vdc_id', 'vdc_name', 'org_id', 'org_name', 'vdc_is_enabled', 'allocation_model']),
-        }
+def _settings_digest(settings):
+    """
+    Digest of the settings of a section, an entity model is only restored for the same settings
+    """
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
 
-        """
-        {
-            "Description": "Status of vApp",
-            "Status": {
-                "FAILED_CREATION": -1,
-                "UNRESOLVED": 0,
-                "RESOLVED": 1,
-                "DEPLOYED": 2,
-                "SUSPENDED": 3,
-                "POWERED_ON": 4,
-                "WAITING_FOR_INPUT": 5,
-                "UNKNOWN": 6,
-                "UNRECOGNIZED": 7,
-                "POWERED_OFF": 8,
-                "INCONSISTENT_STATE": 9,
-                "MIXED": 10
-            }
-        }
-        """
 
-        metric_list['vapp_resources'] = {
-            'vcd_vdc_vapp_status': GaugeMetricFamily(
-                'vcd_vdc_vapp_status',
-                'Status of vApp',
-                labels=['vapp_id', 'vapp_name', 'vapp_deployed', 'vapp_status', 'vdc_id', 'vdc_name',
-                        'org_id', 'org_name', 'vdc_is_enabled']
-            ),
-            'vcd_vdc_vapp_in_maintenance': GaugeMetricFamily(
-                'vcd_vdc_vapp_in_maintenance',
-                'Status of maintenance mode of given vApp',
-                labels=['vapp_id', 'vapp_name', 'vapp_deployed', 'vdc_id', 'vdc_name',
-                        'org_id', 'org_name', 'vdc_is_enabled'])
-        }
+def _tuples(value):
+    """
+    Turn the lists of a decoded JSON value back into the tuples they were encoded from
+    """
+    if isinstance(value, list):
+        return tuple(_tuples(item) for item in value)
+    return value
 
-        """
-        {
-            "Description": 'Status of VM',
-            "States": {
-                "FAILED_CREATION": -1,
-                "UNRESOLVED": 0,
-                "RESOLVED": 1,
-                "DEPLOYED": 2,
-                "SUSPENDED": 3,
-                "POWERED_ON": 4,
-                "WAITING_FOR_INPUT": 5,
-                "UNKNOWN": 6,
-                "UNRECOGNIZED": 7,
-                "POWERED_OFF": 8,
-                "INCONSISTENT_STATE": 9,
-                "MIXED": 10
-            }
-        }
-        """
 
-        metric_list['vm_resources'] = {
-            'vcd_vdc_vapp_vm_status': GaugeMetricFamily(
-                'vcd_vdc_vapp_vm_status',
-                'Status of VM',
-                labels=['vm_id', 'vm_name', 'vm_deployed', 'vm_status', 'vm_os_type', 'vapp_id',
-                        'vapp_name', 'vapp_deployed', 'vdc_id', 'vdc_name', 'org_id', 'org_name',
-                        'vdc_is_enabled']
-            ),
-            'vcd_vdc_vapp_vm_vcpu': GaugeMetricFamily(
-                'vcd_vdc_vapp_vm_vcpu',
-                'vCPU count of vm in given vApp of vdc',
-                labels=['vm_id', 'vm_name', 'vm_deployed', 'vm_status', 'vm_os_type', 'vapp_id',
-                        'vapp_name', 'vapp_deployed', 'vdc_id', 'vdc_name', 'org_id', 'org_name',
-                        'vdc_is_enabled']
-            ),
-            'vcd_vdc_vapp_vm_allocated_memory_mb': GaugeMetricFamily(
-                'vcd_vdc_vapp_vm_allocated_memory_mb',
-                'Memory allocated to VM of given vApp of vdc',
-                labels=['vm_id', 'vm_name', 'vm_deployed', 'vm_status', 'vm_os_type', 'vapp_id',
-                        'vapp_name', 'vapp_deployed', 'vdc_id', 'vdc_name', 'org_id', 'org_name',
-                        'vdc_is_enabled'])
-        }
+def _merge_targets(outputs):
+    """
+    Merge the families of several targets into one family per name with a vcd_target label, and
+    tell which targets could be collected
+    :param outputs: list of each target and its list of GaugeFamily, None when it could not be collected
+    :return: list of GaugeFamily
+    """
+    merged = {}
+    up = GaugeFamily('vcd_target_up', 'Whether the target could be collected', labels=['vcd_target'])
+    for target, families in outputs:
+        up.add_metric((target,), families is not None)
+        # Label tuples shared by families stay shared once extended
+        extended = {}
+        for family in families or []:
+            into = merged.get(family.name)
+            if into is None:
+                into = merged[family.name] = GaugeFamily(family.name, family.documentation, family.labels)
+            for labels, value in family.samples:
+                target_labels = extended.get(id(labels))
+                if target_labels is None:
+                    # Names and values are rendered pairwise up to the shorter of them, vcd_target goes right after
+                    width = min(len(family.labels), len(labels))
+                    target_labels = extended[id(labels)] = labels[:width] + (target,)
+                into.samples.append((target_labels, value))
+    for family in merged.values():
+        # Name vcd_target where the samples put it, a family may be empty for the first targets
+        width = len(family.samples[0][0]) - 1 if family.samples else len(family.labels)
+        family.labels = family.labels[:width] + ('vcd_target',)
+    return list(merged.values()) + [up]
+
+
+def _deadline(request, settings):
+    """
+    Seconds a scrape may wait for its collection, from the scrape timeout Prometheus sends or
+    the scrape_timeout of the section, whichever is shorter
+    :return: seconds, or None to wait for the whole collection
+    """
+    timeouts = []
+    header = request.getHeader('X-Prometheus-Scrape-Timeout-Seconds')
+    if header:
+        try:
+            timeouts.append(float(header))
+        except ValueError:
+            log("Invalid scrape timeout header ignored: {}".format(header))
+    if settings.get('scrape_timeout'):
+        timeouts.append(float(settings['scrape_timeout']))
+    if not timeouts:
+        return None
 
-        metrics = {}
-        for key in metric_list.keys():
-            metrics.update(metric_list[key])
+    timeout = min(timeouts)
+    return timeout - min(DEADLINE_MARGIN, timeout / 2)
 
-        self._vcd_orgs_collect(metrics)
 
-        return defer.succeed(list(metrics.values()))
+def _shard_of(urn, count):
+    """
+    Rendezvous hash of an entity URN onto one of count shards, an entity only ever moves when the
+    number of shards changes, and then only to or from the shards that were added or removed
+    """
+    return max(range(count), key=lambda index: hashlib.sha256('{}:{}'.format(index, urn).encode('utf-8')).digest())
 
-    def _vcd_orgs_collect(self, metrics):
-        start = datetime.utcnow()
-        try:
-            orgs = self.vcd_client.get_org_list()
-            for org in orgs:
-                org = Org(self.vcd_client, resource=org)
-                org_labels = [str(org.resource.attrib['id']), str(org.get_name())]
 
-                self.vdcs = self._vcd_vdc_resources_collect(org)
+def _shard(index, count):
+    """
+    Validate a shard
+    :return: tuple of the shard index and count
+    """
+    index, count = int(index), int(count)
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("Shard index must be in [0, {}), got: {}".format(count, index))
+    return index, count
 
-                def onError(err):
-                    log("Unable to gather vDC: {}".format(err))
 
-                self.vdcs.addErrback(onError)
+def _partition_settings(settings, count):
+    """
+    Settings of a target for one of count worker partitions, each gets its share of the request and
+    rate limits of the target so that vCD sees the same load as from a single process
+    """
+    settings = dict(settings)
+    settings['max_requests'] = max(int(settings.get('max_requests', MAX_REQUESTS)) // count, 1)
+    if settings.get('rate_limit'):
+        settings['rate_limit'] = float(settings['rate_limit']) / count
+    if settings.get('rate_burst'):
+        settings['rate_burst'] = max(int(settings['rate_burst']) // count, 1)
+    return settings
 
-                def onSuccess(resources):
-                    self.vdcs = resources
 
-                self.vdcs.addCallback(onSuccess)
+def _metric_values(metric):
+    """
+    Current values of each label set of a metric: the count of each bucket and the sum of a
+    histogram, else its value
+    """
+    values = {}
+    for labels, child in list(metric._metrics.items()):
+        if isinstance(metric, Histogram):
+            values[labels] = tuple(bucket.get() for bucket in child._buckets) + (child._sum.get(),)
+        else:
+            values[labels] = (child._value.get(),)
+    return values
+
 
-                if not self.vdcs:
-                    log("Org has no vDC: {}".format(str(org.get_name())))
+def _worker_metrics(sent):
+    """
+    Changes of the WORKER_METRICS of a worker process since the last call: the increments of
+    counters and histograms, and the current value of gauges
+    :param sent: dict of the values already sent, updated
+    :return: list of (index in WORKER_METRICS, label values, values) tuples
+    """
+    changes = []
+    for index, (metric, merge) in enumerate(WORKER_METRICS):
+        for labels, values in _metric_values(metric).items():
+            if merge is None:
+                last = sent.get((index, labels))
+                sent[(index, labels)] = values
+                if last is not None:
+                    values = tuple(value - previous for value, previous in zip(values, last))
+                if not any(values):
                     continue
-                else:
-                    metrics['vcd_org_is_enabled'].add_metric(org_labels, org.update_org()['IsEnabled'])
+            changes.append((index, labels, values))
+    return changes
 
-                try:
-                    for vdc_resource in self.vdcs:
-                        vdc = VDC(self.vcd_client, resource=org.get_vdc(vdc_resource['name']))
-                        vdc_labels = [vdc.resource.attrib['id'],
-                                      vdc.name,
-                                      org.resource.attrib['id'],
-                                      str(org.get_name()),
-                                      str(vdc.resource.IsEnabled),
-                                      str(vdc.resource.AllocationModel.text)]
-                        compute_capacity = vdc.resource.ComputeCapacity
-
-                        metrics['vcd_vdc_cpu_allocated'].add_metric(vdc_labels, compute_capacity.Cpu.Allocated)
-                        metrics['vcd_vdc_mhz_to_vcpu'].add_metric(vdc_labels, vdc.resource.VCpuInMhz2)
-                        metrics['vcd_vdc_memory_allocated'].add_metric(vdc_labels, compute_capacity.Memory.Allocated)
-                        metrics['vcd_vdc_memory_used_bytes'].add_metric(
-                            vdc_labels,
-                            compute_capacity.Memory.Used)  # Need to normalize
-                        metrics['vcd_vdc_used_network_count'].add_metric(vdc_labels, vdc.resource.UsedNetworkCount)
-
-                        self.vapps = self._vcd_vdc_vapp_resources_collect(vdc)
-
-                        def onError(err):
-                            log("Unable to Gather vApp Resources: {}".format(err))
-
-                        self.vapps.addErrback(onError)
-
-                        def onSuccess(resources):
-                            self.vapps = resources
-
-                        self.vapps.addCallback(onSuccess)
-
-                        try:
-                            for vapp_resource in self.vapps:
-                                vapp = VApp(self.vcd_client, resource=vdc.get_vapp(vapp_resource['name']))
-                                vapp_labels = [
-                                    vapp.resource.attrib['id'],
-                                    vapp.resource.attrib['name'],
-                                    vapp.resource.attrib['deployed'],
-                                    vapp.resource.attrib['status'],
-                                    vdc.resource.attrib['id'],
-                                    vdc.name,
-                                    org.resource.attrib['id'],
-                                    str(org.get_name()),
-                                    str(vdc.resource.IsEnabled)
-                                ]
-                                metrics['vcd_vdc_vapp_status'].add_metric(vapp_labels, vapp.resource.attrib['status'])
-                                metrics['vcd_vdc_vapp_in_maintenance'].add_metric(vapp_labels,
-                                                                                  vapp.resource.InMaintenanceMode)
-
-                                self.vms = self._vcd_vdc_vapp_vm_resources_collect(vapp)
-
-                                def onError(err):
-                                    log("Unable to Gather vApp Resources: {}".format(err))
-
-                                self.vms.addErrback(onError)
-
-                                def onSuccess(resources):
-                                    self.vms = resources
-
-                                self.vms.addCallback(onSuccess)
-
-                                try:
-                                    for vm in self.vms:
-                                        vm_labels = [
-                                            vm.attrib['id'],
-                                            vm.attrib['name'],
-                                            vm.attrib['deployed'],
-                                            vm.attrib['status'],
-                                            vapp.resource.attrib['id'],
-                                            vapp.resource.attrib['name'],
-                                            vapp.resource.attrib['deployed'],
-                                            vdc.resource.attrib['id'],
-                                            vdc.name,
-                                            org.resource.attrib['id'],
-                                            str(org.get_name()),
-                                            str(vdc.resource.IsEnabled)
-                                        ]
-                                        vm_spec = vm.VmSpecSection
-                                        metrics['vcd_vdc_vapp_vm_status'].add_metric(vm_labels,
-                                                                                     vm.attrib['status'])
-
-                                        metrics['vcd_vdc_vapp_vm_vcpu'].add_metric(vm_labels, vm_spec.NumCpus)
-                                        metrics['vcd_vdc_vapp_vm_allocated_memory_mb'].add_metric(
-                                            vm_labels,
-                                            vm_spec.MemoryResourceMb.Configured)
-                                except Exception as err:
-                                    log("Unable to poll VM: {}".format(err))
-                                    pass
-                        except Exception as err:
-                            log("Unable to poll vApp: {}".format(err))
-                            pass
-                except Exception as err:
-                    log("Unable to poll vDC: {}".format(err))
-                    pass
-        except Exception as err:
-            log("Unable to poll vOrg: {}".format(err))
-            pass
 
-        log("Finished All vOrg Metrics Collection: ({})".format(datetime.utcnow() - start))
-        self.vcd_client.logout()
+def _endpoint(url):
+    """
+    Name the vCD endpoint of a request url, e.g. /api/vApp/vapp-{id} or /api/query?type=adminVM
+    """
+    parsed = urlparse(url)
+    endpoint = VCD_ID.sub('{id}', parsed.path)
+    query_type = parse_qs(parsed.query).get('type')
+    if query_type:
+        endpoint += '?type={}'.format(query_type[0])
+    return endpoint
 
-        return list(metrics.values())
 
-    @staticmethod
-    def _vcd_vdc_resources_collect(org):
-        vdc_resources = org.list_vdcs()
-        return defer.succeed(vdc_resources)
+def _accepted(header):
+    """
+    Return the media types or codings of an Accept or Accept-Encoding header with a weight above 0,
+    an entry whose q parameter is not a number is left out as well
+    """
+    accepted = []
+    for part in (header or '').split(','):
+        params = [param.strip() for param in part.split(';')]
+        if not params[0]:
+            continue
+        weight = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    weight = float(value.strip())
+                except ValueError:
+                    weight = 0.0
+        if weight > 0:
+            accepted.append(params[0].lower())
+    return accepted
 
-    @staticmethod
-    def _vcd_vdc_vapp_resources_collect(vdc):
-        vapp_resources = vdc.list_resources(EntityType.VAPP)
-        return defer.succeed(vapp_resources)
 
-    @staticmethod
-    def _vcd_vdc_vapp_vm_resources_collect(vapp):
-        vm_resources = vapp.get_all_vms()
-        return defer.succeed(vm_resources)
+def _negotiate(request):
+    """
+    Pick the exposition format and compression of a response from the request headers
+    :return: tuple of openmetrics and gzip flags
+    """
+    openmetrics = 'application/openmetrics-text' in _accepted(request.getHeader('Accept'))
+    gzip = 'gzip' in _accepted(request.getHeader('Accept-Encoding'))
+    return openmetrics, gzip
 
 
-class HealthzResource(Resource):
+def _gzip_chunks(chunks):
     """
-    Class for exporter healthz
+    Compress a stream of chunks into one gzip member
     """
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
 
-    def render_GET(self, request):
-        request.setHeader("Content-Type", "text/plain; charset=UTF-8")
-        request.setResponseCode(200)
-        log("Healthz")
-        return 'Server is UP'.encode()
 
+def _set_content_headers(request, openmetrics, gzip):
+    request.setHeader("Content-Type", OPENMETRICS_CONTENT_TYPE if openmetrics else TEXT_CONTENT_TYPE)
+    request.setHeader("Vary", "Accept, Accept-Encoding")
+    if gzip:
+        request.setHeader("Content-Encoding", "gzip")
 
-class MetricsResource(Resource):
+
+class GaugeFamily(object):
     """
-    Class for exporter metrics
+    Class for a gauge family keeping each sample as its label values tuple and a float, the
+    tuple is shared by the families of the same entity
     """
 
-    def render_GET(self, request):
-        request.setHeader("Content-Type", "text/plain; charset=UTF-8")
-        request.setResponseCode(200)
-        log("Metrics")
-        return generate_latest()
+    def __init__(self, name, documentation, labels=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels or ())
+        self.samples = []
 
+    def add_metric(self, labels, value):
+        self.samples.append((labels, float(value)))
 
-class VcdConnection:
+
+class ExpositionWriter(object):
     """
-    Class for vCD connection context
+    Class for rendering gauge families in the Prometheus text format a chunk at a time, each
+    label value is escaped once and each label tuple is rendered once for all its families
     """
 
-    def __str__(self):
-        return str(self.vcd_client)
-
+    def __init__(self, families, chunk_lines=CHUNK_LINES, openmetrics=False):
+        self.families = families
+        self.chunk_lines = chunk_lines
+        self.openmetrics = openmetrics
+        self.escaped = {}
+        self.orders = {}
+        self.rendered = {}
+
+    def escape(self, value):
+        escaped = self.escaped.get(value)
+        if escaped is None:
+            escaped = value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+            self.escaped[value] = escaped
+        return escaped
+
+    def label_string(self, names, labels):
+        """
+        Render a label set like prometheus_client does: names and values zipped, sorted by name
+        """
+        key = (names, id(labels))
+        rendered = self.rendered.get(key)
+        if rendered is not None:
+            return rendered
+
+        count = min(len(names), len(labels))
+        order = self.orders.get((names, count))
+        if order is None:
+            order = self.orders[(names, count)] = sorted(range(count), key=names.__getitem__)
+
+        if order:
+            rendered = '{' + ','.join(['{}="{}"'.format(names[i], self.escape(labels[i])) for i in order]) + '}'
+        else:
+            rendered = ''
+        self.rendered[key] = rendered
+        return rendered
+
+    def chunks(self):
+        """
+        Yield the exposition as UTF-8 chunks of at most chunk_lines samples, family by family,
+        in the Prometheus text format or in OpenMetrics
+        """
+        for family in self.families:
+            documentation = family.documentation.replace('\\', r'\\').replace('\n', r'\n')
+            if self.openmetrics:
+                documentation = documentation.replace('"', r'\"')
+            lines = [
+                '# HELP {} {}\n'.format(family.name, documentation),
+                '# TYPE {} gauge\n'.format(family.name)
+            ]
+            for labels, value in family.samples:
+                lines.append('{}{} {}\n'.format(family.name, self.label_string(family.labels, labels),
+                                                floatToGoString(value)))
+                if len(lines) >= self.chunk_lines:
+                    yield ''.join(lines).encode('utf-8')
+                    lines = []
+            yield ''.join(lines).encode('utf-8')
+        if self.openmetrics:
+            yield b'# EOF\n'
+
+    def render(self):
+        return b''.join(self.chunks())
+
+
+@implementer(IPullProducer)
+class ExpositionProducer(object):
+    """
+    Class for streaming exposition chunks to a request as fast as the client reads them
+    """
+
+    def __init__(self, request, chunks):
+        self.request = request
+        self.chunks = iter(chunks)
+
+    def start(self):
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.request.unregisterProducer()
+            self.request.finish()
+            return
+        self.request.write(chunk)
+
+    def stopProducing(self):
+        self.chunks = iter(())
+
+
+class EntityModel(object):
+    """
+    Class for the entities of a section kept between incremental collections, keyed by URN
+    """
+
+    def __init__(self):
+        self.entities = {}
+        self.pending = {}
+        self.checkpoint = None
+        self.synced = None
+        self.source = None
+        self.origin = None
+        self.static = []
+        self.parents = {}
+        self.changes = {}
+        self.deleted = set()
+        self.stale = False
+
+    def clear(self):
+        self.entities = {}
+        self.static = []
+        self.checkpoint = None
+        self.synced = None
+
+    def age(self):
+        """
+        Seconds since the last full resync
+        """
+        if self.synced is None:
+            return float('inf')
+        return time.time() - self.synced
+
+    def begin(self):
+        """
+        Start a collection, the entities it does not see are dropped when it is committed
+        :return: start time of the previous collection, or None after a resync
+        """
+        since, self.checkpoint = self.checkpoint, time.time()
+        if self.synced is None:
+            self.synced = self.checkpoint
+        # The collection sees every change notified until now
+        self.pending = {}
+        self.parents = {}
+        self.changes = {}
+        self.deleted = set()
+        self.stale = False
+        return since
+
+    def patch(self):
+        """
+        Start a collection of the changes notified since the previous one, the entities it does
+        not fetch again are kept
+        :return: list of the URN, parent labels and href, if known, of the vApps to fetch again
+        """
+        changes, self.changes = self.changes, {}
+        self.pending = {urn: entity for urn, entity in self.entities.items() if urn not in self.deleted}
+        self.deleted = set()
+
+        vapps = []
+        for urn, parent in changes.items():
+            entity = self.pending.get(urn)
+            if entity is not None:
+                vapps.append((urn, entity['parents'], entity['href']))
+            elif parent in self.parents:
+                # Created in a vDC of the model, vApps of other vDCs belong to other shards or are filtered out
+                vapps.append((urn, self.parents[parent], None))
+        return vapps
+
+    def notify(self, notification):
+        """
+        Apply a vCD notification: vApps, and the vApps of VMs, are fetched again by the next
+        collection, deleted vApps are dropped, and changes to orgs and vDCs need a full collection
+        """
+        entity_type, urn = notification['entity']
+        parent_type, parent = notification['up']
+        if entity_type in ('vcloud:org', 'vcloud:vdc'):
+            self.stale = True
+        elif entity_type == 'vcloud:vm':
+            if parent_type == 'vcloud:vapp':
+                self.changes.setdefault(parent, None)
+            else:
+                self.stale = True
+        elif entity_type == 'vcloud:vapp':
+            if notification['success'] and notification['type'].endswith('/delete'):
+                self.deleted.add(urn)
+                self.changes.pop(urn, None)
+            else:
+                self.changes[urn] = parent if parent_type == 'vcloud:vdc' else self.changes.get(urn)
+
+    def get(self, urn, fingerprint):
+        """
+        Get the samples of an entity if its fingerprint did not change
+        """
+        entity = self.entities.get(urn)
+        if fingerprint is None or entity is None or entity['fingerprint'] != fingerprint:
+            return None
+        return entity['samples']
+
+    def store(self, urn, fingerprint, samples, parents=None, href=None):
+        self.pending[urn] = {'fingerprint': fingerprint, 'samples': samples, 'parents': parents, 'href': href}
+
+    def commit(self, samples):
+        """
+        End a collection, the entities are ordered like their samples in its output and the
+        samples of no entity are kept for the collections of notified changes
+        """
+        owners = {}
+        for urn, entity in self.pending.items():
+            for sample in entity['samples']:
+                owners[id(sample)] = urn
+
+        static, entities = [], {}
+        for sample in samples:
+            urn = owners.get(id(sample))
+            if urn is None:
+                static.append(sample)
+            elif urn not in entities:
+                entities[urn] = self.pending[urn]
+        for urn, entity in self.pending.items():
+            entities.setdefault(urn, entity)
+
+        self.static, self.entities, self.pending = static, entities, {}
+
+    def samples(self):
+        """
+        Samples of the collection being made from notified changes
+        """
+        return self.static + [sample for entity in self.pending.values() for sample in entity['samples']]
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised for vCD requests not sent because the circuit breaker of their target is open
+    """
+
+
+class RequestScheduler(object):
+    """
+    Class for pacing the vCD requests of a target: a token bucket bounds their rate, an AIMD
+    limit adapts their concurrency to errors and latency, transient failures are retried with
+    jittered exponential backoff, and a circuit breaker stops calling a vCD that keeps failing.
+    Every call it runs must be an idempotent read.
+    """
+
+    def __init__(self, target, max_requests=MAX_REQUESTS, rate_limit=0, rate_burst=0, min_requests=1,
+                 latency_target=0, max_retries=3, retry_backoff=0.5, breaker_threshold=5, breaker_reset=30,
+                 clock=reactor, runner=threads.deferToThread):
+        self.target = target
+        self.max_requests = max(int(max_requests), 1)
+        self.min_requests = min(max(int(min_requests), 1), self.max_requests)
+        self.rate = float(rate_limit)
+        self.burst = float(rate_burst or self.max_requests)
+        self.latency_target = float(latency_target)
+        self.max_retries = int(max_retries)
+        self.retry_backoff = float(retry_backoff)
+        self.breaker_threshold = int(breaker_threshold)
+        self.breaker_reset = float(breaker_reset)
+        self.clock = clock
+        self.runner = runner
+
+        self.limit = float(self.max_requests)
+        self.active = 0
+        self.queue = []
+        self.sequence = itertools.count()
+        self.tokens = self.burst
+        self.refilled = clock.seconds()
+        self.wakeup = None
+        self.decreased = 0.0
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        VCD_CONCURRENCY.labels(target).set(self.limit)
+        CIRCUIT_OPEN.labels(target).set(0)
+
+    def run(self, fn, *args):
+        """
+        Run a blocking call in the thread pool once the rate and concurrency limits allow it
+        :return: Deferred firing with the result of the call
+        """
+        return self.submit(0, fn, *args)
+
+    def submit(self, priority, fn, *args, runner=None):
+        """
+        Same as run(), waiting calls of a lower priority value are sent first
+        :param runner: function running the call and returning a Deferred, defaults to the one of the
+                       scheduler, defer.maybeDeferred runs a non-blocking call in the reactor
+        """
+        result = defer.Deferred()
+        self._submit(result, fn, args, 0, priority, runner)
+        return result
+
+    def prioritized(self, priority, runner=None):
+        """
+        Get a function running calls like run() with the given priority
+        """
+        def run(fn, *args):
+            return self.submit(priority, fn, *args, runner=runner)
+        return run
+
+    def _submit(self, result, fn, args, attempt, priority=0, runner=None):
+        if self.opened is not None:
+            if self.probing or self.clock.seconds() - self.opened < self.breaker_reset:
+                VCD_REJECTED.labels(self.target).inc()
+                result.errback(failure.Failure(CircuitOpenError(
+                    "Circuit breaker open for: {}".format(self.target))))
+                return
+            # Half open, a single trial request decides whether vCD is back
+            self.probing = True
+
+        heapq.heappush(self.queue, (priority, next(self.sequence), result, fn, args, attempt, runner))
+        self._dispatch()
+
+    def _take_token(self):
+        """
+        Take a token of the bucket
+        :return: 0 when one was taken, else the seconds until the next one
+        """
+        if not self.rate:
+            return 0
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def _wake(self):
+        self.wakeup = None
+        self._dispatch()
+
+    def _dispatch(self):
+        if self.wakeup is not None:
+            # Waiting for a token, the wakeup dispatches
+            return
+
+        while self.queue and self.active < int(self.limit):
+            wait = self._take_token()
+            if wait:
+                self.wakeup = self.clock.callLater(wait, self._wake)
+                return
+
+            priority, _, result, fn, args, attempt, runner = heapq.heappop(self.queue)
+            self.active += 1
+            call = (runner or self.runner)(fn, *args)
+            call.addBoth(self._done, self.clock.seconds(), result, fn, args, attempt, priority, runner)
+
+    def _done(self, outcome, started, result, fn, args, attempt, priority, runner):
+        self.active -= 1
+        now = self.clock.seconds()
+
+        if isinstance(outcome, failure.Failure) and _transient(outcome.value):
+            self._decrease(started)
+            if attempt < self.max_retries and self.opened is None:
+                VCD_RETRIES.labels(self.target).inc()
+                delay = random.uniform(0, min(MAX_RETRY_BACKOFF, self.retry_backoff * 2 ** attempt))
+                self.clock.callLater(delay, self._submit, result, fn, args, attempt + 1, priority, runner)
+            else:
+                # Only requests that failed all their attempts count toward opening the breaker
+                self._failed(now)
+                result.errback(outcome)
+        else:
+            # Other errors, such as a vApp deleted meanwhile, are answers of a healthy vCD
+            self._succeeded()
+            if self.latency_target and now - started > self.latency_target:
+                self._decrease(started)
+            else:
+                self._increase()
+            if isinstance(outcome, failure.Failure):
+                result.errback(outcome)
+            else:
+                result.callback(outcome)
+
+        self._dispatch()
+
+    def _increase(self):
+        self.limit = min(self.max_requests, self.limit + 1.0 / self.limit)
+        VCD_CONCURRENCY.labels(self.target).set(int(self.limit))
+
+    def _decrease(self, started):
+        # Only requests sent after the last decrease reflect it, so the limit is halved once per round trip
+        if started < self.decreased:
+            return
+        self.decreased = self.clock.seconds()
+        self.limit = max(self.min_requests, self.limit / 2)
+        VCD_CONCURRENCY.labels(self.target).set(int(self.limit))
+
+    def _failed(self, now):
+        self.failures += 1
+        if self.probing or (self.opened is None and self.failures >= self.breaker_threshold):
+            if self.opened is None:
+                log("Circuit breaker open for {} after {} failures".format(self.target, self.failures))
+            self.opened = now
+            self.probing = False
+            CIRCUIT_OPEN.labels(self.target).set(1)
+
+            # Requests still waiting are not sent either
+            while self.queue:
+                result = heapq.heappop(self.queue)[2]
+                VCD_REJECTED.labels(self.target).inc()
+                result.errback(failure.Failure(CircuitOpenError(
+                    "Circuit breaker open for: {}".format(self.target))))
+
+    def _succeeded(self):
+        self.failures = 0
+        if self.opened is not None:
+            log("Circuit breaker closed for: {}".format(self.target))
+            self.opened = None
+            self.probing = False
+            CIRCUIT_OPEN.labels(self.target).set(0)
+
+
+class PrioritySemaphore(object):
+    """
+    Class for a DeferredSemaphore whose waiters are released by priority, lower values first
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    def run(self, priority, fn, *args):
+        """
+        Run fn once a token is free, it returns a Deferred and holds the token until it fires
+        """
+        acquired = defer.Deferred()
+        if self.tokens > 0:
+            self.tokens -= 1
+            acquired.callback(None)
+        else:
+            heapq.heappush(self.waiting, (priority, next(self.sequence), acquired))
+
+        def onAcquired(_):
+            return defer.maybeDeferred(fn, *args).addBoth(self._release)
+
+        return acquired.addCallback(onAcquired)
+
+    def _release(self, result):
+        if self.waiting:
+            heapq.heappop(self.waiting)[2].callback(None)
+        else:
+            self.tokens += 1
+        return result
+
+
+class SingleFlight(object):
+    """
+    Class for sharing one in-flight call between concurrent callers of the same key
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    def run(self, key, fn, *args):
+        """
+        Call fn unless a call for key is already running, every caller gets its own
+        Deferred firing with the shared result
+        :return: Deferred firing with the result or the failure of the shared call
+        """
+        waiter = defer.Deferred()
+        if key in self.calls:
+            self.calls[key].append(waiter)
+            return waiter
+        self.calls[key] = [waiter]
+
+        def onDone(result):
+            for caller in self.calls.pop(key):
+                if isinstance(result, failure.Failure):
+                    caller.errback(result)
+                else:
+                    caller.callback(result)
+
+        defer.maybeDeferred(fn, *args).addBoth(onDone)
+        return waiter
+
+
+def _http_client(section, settings):
+    """
+    HTTP client the vCD requests of a section are sent with
+    :return: tuple of the client, and why the configured one is ignored or None
+    """
+    http_client = settings.get('http_client', HTTP_CLIENTS[0])
+    if http_client not in HTTP_CLIENTS:
+        return HTTP_CLIENTS[0], "Unknown HTTP client ignored for {}: {}".format(section, http_client)
+    if http_client == 'agent' and settings.get('xml_parser') == 'objectify':
+        return HTTP_CLIENTS[0], "HTTP agent ignored for {}, it only reads with the iterparse parser".format(section)
+    return http_client, None
+
+
+def _filters(section, settings):
+    """
+    Compiled include and exclude regexes of the org and vDC names of a section
+    :return: tuple of the dict of the include and exclude regex of each level, and why the
+             patterns that are not valid regexes are ignored
+    """
+    filters, warnings = {}, []
+    for level in ('org', 'vdc'):
+        patterns = []
+        for setting in ('include_{}s'.format(level), 'exclude_{}s'.format(level)):
+            pattern = settings.get(setting)
+            try:
+                patterns.append(re.compile(pattern) if pattern else None)
+            except (re.error, TypeError) as err:
+                patterns.append(None)
+                warnings.append("Invalid {} regex ignored for {}: {!r} ({})".format(setting, section, pattern, err))
+        filters[level] = tuple(patterns)
+    return filters, warnings
+
+
+def _collect_target(sessions, models, target, settings, shard=(0, 1), partition=(0, 1), running=None,
+                    notifications=None, profile=None):
+    """
+    Collect the orgs of a shard, and of a partition of it, of a target
+    :param sessions: VcdSessionManager of the process
+    :param models: dict of the EntityModel of each target and shard of the process
+    :param running: dict the VcdCollector is kept in by target and shard while it runs
+    :param notifications: NotificationConsumer keeping the entity model of the target up to date
+    :param profile: CollectionProfile recording the collection
+    :return: Deferred firing with the list of GaugeFamily
+    """
+    # Reuse the vCD User context of the section
+    result = sessions.connection(target, settings)
+
+    def onError(err):
+        log("Error connecting to vCD endpoint: {}".format(err))
+        return err
+
+    result.addErrback(onError)
+
+    def onConnected(vcd_connection):
+        entity_model = None
+        if settings.get('collection_backend') == 'incremental':
+            # A new session means new settings, possibly another tenant, so start over, unless the
+            # model was restored from the state directory for the same settings
+            entity_model = models.setdefault((target, shard), EntityModel())
+            if entity_model.source is not vcd_connection:
+                origin = _settings_digest(settings)
+                if entity_model.source is not None or entity_model.origin != origin:
+                    entity_model.clear()
+                entity_model.source = vcd_connection
+                entity_model.origin = origin
+
+        levels = settings.get('collect_levels') or LEVELS
+        for level in set(levels) - set(LEVELS):
+            log("Unknown collection level ignored for {}: {}".format(target, level))
+
+        xml_parser = settings.get('xml_parser', XML_PARSERS[0])
+        if xml_parser not in XML_PARSERS:
+            log("Unknown XML parser ignored for {}: {}".format(target, xml_parser))
+            xml_parser = XML_PARSERS[0]
+
+        # Compiled again from the cache of re, bad patterns were logged when the config was loaded
+        filters = _filters(target, settings)[0]
+
+        collector = VcdCollector(
+            target if target != 'default' else settings.get('vcd_host'),
+            settings.get('vcd_user'),
+            settings.get('vcd_org'),
+            settings.get('vcd_password'),
+            settings.get('ignore_ssl'),
+            vcd_connection.vcd_client,
+            max_requests=settings.get('max_requests', MAX_REQUESTS),
+            level_requests={level: settings.get('max_{}_requests'.format(level), limit)
+                            for level, limit in MAX_LEVEL_REQUESTS.items()},
+            collection_backend=settings.get('collection_backend', 'object'),
+            query_page_size=settings.get('query_page_size', QUERY_PAGE_SIZE),
+            vcd_connection=vcd_connection,
+            entity_model=entity_model,
+            resync_interval=float(settings.get('resync_interval', RESYNC_INTERVAL)),
+            target=target,
+            levels=levels,
+            filters=filters,
+            shard=shard,
+            partition=partition,
+            xml_parser=xml_parser,
+            notifications=notifications,
+            reconcile_interval=float(settings.get('reconcile_interval', RECONCILE_INTERVAL)),
+            profile=profile
+        )
+        if running is None:
+            return collector.collect()
+
+        running[(target, shard)] = collector
+
+        def onDone(result):
+            if running.get((target, shard)) is collector:
+                del running[(target, shard)]
+            return result
+
+        return collector.collect().addBoth(onDone)
+
+    result.addCallback(onConnected)
+
+    return result
+
+
+class VcdApplicationResource(Resource):
+    """
+    Class for Vac Exporter Application configuration
+    """
+
+    def __init__(self, args, clock=reactor):
+        Resource.__init__(self)
+        self.config = {}
+        self.args = args
+        self.clock = clock
+        self.shard = _shard(args.shard_index, args.shard_count)
+        self.snapshots = {}
+        self.models = {}
+        self.running = {}
+        self.unserved = {}
+        self.restored = {}
+        self.consumers = {}
+        self.usage = {}
+        # Settings of a section already warned about, by section and setting
+        self.warned = set()
+        self.collections = SingleFlight()
+        self.refreshing = SingleFlight()
+        self.schedules = {}
+        # Background collection only runs once start_schedules() was called
+        self.scheduling = False
+        self.sessions = VcdSessionManager()
+        self.config_mtime = None
+        self.workers = None
+        if getattr(args, 'workers', 0):
+            self.workers = WorkerPool(args.workers, getattr(args, 'worker_timeout', WORKER_TIMEOUT), args.threads)
+        self.state = None
+        if getattr(args, 'state_dir', None):
+            self.state = StateStore(args.state_dir)
+
+    def load_config(self):
+        """
+        Load the sections from the config file or the OS environment, the file is only
+        parsed again when its mtime changed or after reload_config()
+        """
+        if self.args.config_file:
+            mtime = os.stat(self.args.config_file).st_mtime
+            if self.config and mtime == self.config_mtime:
+                return self.config
+
+            with open(self.args.config_file) as handle:
+                self.config = yaml.safe_load(handle) or {}
+            self.config_mtime = mtime
+            self.warned = set()
+            for section, settings in self.config.items():
+                for warning in _filters(section, settings or {})[1]:
+                    log(warning)
+
+        elif self.config:
+            return self.config
+
+        else:
+            """
+            Set configuration from OS environement variables
+            """
+            self.config = {}
+            # Only VCD_<NAME>_* sections may be set, /vcd/all would report an empty default section as down
+            if os.environ.get('VCD_USER') or os.environ.get('VCD_HOST'):
+                self.config['default'] = {
+                    'vcd_host': os.environ.get('VCD_HOST'),
+                    'vcd_user': os.environ.get('VCD_USER'),
+                    'vcd_org': os.environ.get('VCD_ORG'),
+                    'vcd_password': os.environ.get('VCD_PASSWORD'),
+                    'ignore_ssl': os.environ.get('VCD_IGNORE_SSL', False),
+                }
+            for key in os.environ.keys():
+                if key == 'VCD_USER':
+                    continue
+                if not key.startswith('VCD_') or not key.endswith('_USER'):
+                    continue
+
+                section = key.split('_', 1)[1].rsplit('_', 1)[0]
+
+                self.config[section.lower()] = {
+                    'vcd_host': os.environ.get('VCD_{}_HOST'.format(section)),
+                    'vcd_user': os.environ.get('VCD_{}_USER'.format(section)),
+                    'vcd_org': os.environ.get('VCD_{}_ORG'.format(section)),
+                    'vcd_password': os.environ.get('VCD_{}_PASSWORD'.format(section)),
+                    'ignore_ssl': os.environ.get('VCD_{}_IGNORE_SSL'.format(section), False),
+                }
+
+        # Sessions of sections that are gone are logged out, changed ones log in again on next use
+        for section in list(self.sessions.connections):
+            if section not in self.config:
+                self.sessions.close(section)
+        for target, shard in list(self.models):
+            if target not in self.config:
+                del self.models[(target, shard)]
+        for section in list(self.consumers):
+            if section not in self.config:
+                self.consumers.pop(section).stop()
+        for target, shard in list(self.usage):
+            if target not in self.config:
+                self.usage.pop((target, shard)).stop()
+        for target, shard in list(self.restored):
+            if target not in self.config:
+                del self.restored[(target, shard)]
+        if self.scheduling:
+            self.sync_schedules()
+
+        return self.config
+
+    def reload_config(self):
+        """
+        Parse the config again and resync the background schedules
+        """
+        log("Reloading configuration")
+        self.config = {}
+        self.start_schedules()
+
+    def warn_once(self, section, setting, message):
+        """
+        Log a problem with a setting of a section once per configuration, the settings are shared
+        by every collection and are not changed
+        """
+        if (section, setting) not in self.warned:
+            self.warned.add((section, setting))
+            log(message)
+
+    def configure(self, section):
+        """
+        Get the settings of a section, nothing is kept on the resource so concurrent
+        targets each work on their own settings and connection
+        :param section: section in the config file
+        :return: settings of the section, or 2 when it is not configured
+        """
+        try:
+            self.load_config()
+        except Exception as err:
+            log("Unable to load configuration: {}".format(err))
+            return 2
+
+        try:
+            if self.config.get(section):
+                return self.config[section]
+            raise Exception("Unable to find section: {}".format(section))
+        except Exception as err:
+            log("Section not valid, error: {}".format(err))
+            return 2
+
+    def collect(self, target, shard=None):
+        """
+        Run one collection of a target and render it, concurrent requests for the same
+        target and shard share one collection and get the same output
+        :param target: section in the config file
+        :param shard: tuple of shard index and count, defaults to the one of the command line
+        :return: Deferred firing with the list of GaugeFamily, or 2 when the section is unknown
+        """
+        settings = self.configure(target)
+        if settings == 2:
+            return settings
+
+        shard = shard or self.shard
+        return self.collections.run((target, shard), self._collect, target, settings, shard)
+
+    def _collect(self, target, settings, shard):
+        """
+        Collect the orgs of a shard of a target with the session of its section, in the
+        worker processes when there are some
+        """
+        warning = _http_client(target, settings)[1]
+        if warning is not None:
+            self.warn_once(target, 'http_client', warning)
+
+        if self.workers is not None:
+            result = self.workers.collect(target, settings, shard)
+        else:
+            result = _collect_target(self.sessions, self.models, target, settings, shard, running=self.running,
+                                     notifications=self.notifications(target, settings))
+
+        def onSuccess(families):
+            usage = self.usage_metrics(target, settings, shard)
+            if usage is not None:
+                usage.update(families)
+                families = families + usage.families
+            families = families + [_completeness_family({level: 1.0 for level in _levels(settings)})]
+            self.restored.pop((target, shard), None)
+            if self.state is not None:
+                model = None
+                if settings.get('collection_backend') == 'incremental':
+                    model = self.models.get((target, shard))
+                self.state.save(target, shard, families, model)
+            return families
+
+        return result.addCallback(onSuccess)
+
+    def notifications(self, target, settings):
+        """
+        Get the notification consumer of a section, started on first use and started again when
+        its settings changed
+        :return: NotificationConsumer, or None when the section is not kept up to date by notifications
+        """
+        config = settings.get('notifications')
+        consumer = self.consumers.get(target)
+        if consumer is not None and consumer.settings != dict(NOTIFICATION_SETTINGS, **(config or {})):
+            self.consumers.pop(target).stop()
+            consumer = None
+        if consumer is not None or not config:
+            return consumer
+
+        if settings.get('collection_backend') != 'incremental':
+            self.warn_once(target, 'notifications',
+                           "Notifications ignored for {}, they only apply to the incremental backend".format(target))
+            return None
+        if pika is None:
+            self.warn_once(target, 'notifications',
+                           "Notifications ignored for {}, pika is not installed".format(target))
+            return None
+
+        consumer = self.consumers[target] = NotificationConsumer(target, config, self.models)
+        consumer.start()
+        return consumer
+
+    def usage_metrics(self, target, settings, shard):
+        """
+        Get the VM usage collector of a target and shard, created again when its settings changed
+        :return: UsageCollector, or None when the section does not collect usage metrics
+        """
+        usage = self.usage.get((target, shard))
+        if usage is not None and (not settings.get('usage_metrics') or
+                                  usage.key != UsageCollector.settings_key(settings)):
+            self.usage.pop((target, shard)).stop()
+            usage = None
+        if usage is not None:
+            # Same session as the collections, whose credentials may have changed
+            usage.settings = settings
+            return usage
+        if not settings.get('usage_metrics'):
+            return None
+
+        if 'vm' not in _levels(settings):
+            self.warn_once(target, 'usage_metrics',
+                           "Usage metrics ignored for {}, the vm level is not collected".format(target))
+            return None
+
+        usage = self.usage[(target, shard)] = UsageCollector(target, settings, self.sessions)
+        return usage
+
+    def restore(self):
+        """
+        Load the collections and entity models saved by a previous run, a collection is served
+        as stale until the first collection of its target and shard replaces it
+        """
+        if self.state is None:
+            return
+
+        try:
+            self.load_config()
+        except Exception as err:
+            log("Unable to load configuration: {}".format(err))
+            return
+
+        for (target, shard), state in self.state.load().items():
+            if target not in self.config:
+                continue
+            families = state['families'] + [_restored_family(state['timestamp'])]
+            self.restored[(target, shard)] = Snapshot(families, timestamp=state['timestamp'], restored=True)
+            # Worker processes keep their own entity models
+            if state['model'] is not None and self.workers is None:
+                self.models[(target, shard)] = state['model']
+            log("Restored the collection of {} from {}".format(target, time.ctime(state['timestamp'])))
+
+    def within(self, result, target, settings, shard, seconds):
+        """
+        Wait at most some seconds for a collection, the collection goes on when the time is up
+        and its result is served by the next scrape that runs out of time as well
+        :return: Deferred firing with the collected families, the last complete collection not
+                 served yet, or the families collected so far
+        """
+        key = (target, shard)
+        answer = defer.Deferred()
+
+        def onDeadline():
+            families = self.unserved.pop(key, None)
+            if families is not None:
+                log("Scrape deadline reached, serving the previous collection of: {}".format(target))
+            elif key in self.restored:
+                log("Scrape deadline reached, serving the restored collection of: {}".format(target))
+                families = self.restored[key].families
+            elif key in self.running:
+                log("Scrape deadline reached, serving a partial collection of: {}".format(target))
+                collector = self.running[key]
+                families = collector.partial_families() + [_completeness_family(collector.completeness())]
+            else:
+                log("Scrape deadline reached, nothing collected yet for: {}".format(target))
+                families = [_completeness_family({level: 0.0 for level in _levels(settings)})]
+            answer.callback(families)
+
+        timer = self.clock.callLater(seconds, onDeadline)
+
+        def onSuccess(families):
+            if timer.active():
+                timer.cancel()
+                self.unserved.pop(key, None)
+                answer.callback(families)
+            else:
+                self.unserved[key] = families
+
+        def onError(err):
+            if timer.active():
+                timer.cancel()
+                answer.errback(err)
+            else:
+                log("Collection failed after its scrape was answered: {}".format(err))
+
+        result.addCallbacks(onSuccess, onError)
+
+        return answer
+
+    def start_schedules(self):
+        """
+        Start background collection of every section with a collect_interval, the schedules are
+        synced again each time the config is parsed again
+        """
+        self.scheduling = True
+        try:
+            self.load_config()
+        except Exception as err:
+            log("Unable to load configuration: {}".format(err))
+            return
+
+        self.sync_schedules()
+
+    def sync_schedules(self):
+        """
+        Stop the background collection of sections that are gone or lost their collect_interval,
+        start it again when the interval changed and start it for new sections
+        """
+        for section, schedule in list(self.schedules.items()):
+            settings = self.config.get(section) or {}
+            interval = settings.get('collect_interval')
+            if interval and float(interval) == schedule['interval']:
+                schedule['max_staleness'] = float(settings.get('max_staleness', 3 * float(interval)))
+                continue
+
+            if schedule['loop'].running:
+                schedule['loop'].stop()
+            del self.schedules[section]
+            if not interval:
+                # Not served anymore, a later schedule starts over
+                self.snapshots.pop(section, None)
+                log("Background collection stopped for: {}".format(section))
+
+        for section, settings in self.config.items():
+            interval = (settings or {}).get('collect_interval')
+            if not interval or section in self.schedules:
+                continue
+
+            self.schedules[section] = {
+                'interval': float(interval),
+                'max_staleness': float(settings.get('max_staleness', 3 * float(interval))),
+                'loop': task.LoopingCall(self.refresh, section)
+            }
+            self.schedules[section]['loop'].start(float(interval), now=True)
+            log("Background collection every {}s for: {}".format(interval, section))
+
+    def refresh(self, section):
+        """
+        Collect a section in the background and cache the rendered output, concurrent
+        refreshes of the same section share one collection
+        :return: Deferred firing with the latest Snapshot, or None if there is none
+        """
+        return self.refreshing.run(section, self._refresh, section)
+
+    def _refresh(self, section):
+        result = self.collect(section)
+        if result == 2:
+            result = defer.fail(Exception("No Config found for: {}".format(section)))
+
+        def onSuccess(families):
+            self.snapshots[section] = Snapshot(families)
+
+        result.addCallback(onSuccess)
+
+        def onError(err):
+            log("Background collection failed for {}: {}".format(section, err))
+            if section in self.snapshots:
+                self.snapshots[section].failures += 1
+
+        result.addErrback(onError)
+
+        def onDone(_):
+            return self.snapshots.get(section)
+
+        result.addCallback(onDone)
+
+        return result
+
+    def snapshot(self, target):
+        """
+        Serve the cached output of a background section, stale output is served while it is
+        refreshed unless it is older than max_staleness
+        :return: Deferred firing with the Snapshot to serve
+        """
+        schedule = self.schedules[target]
+        cached = self.snapshots.get(target)
+        if cached is None and (target, self.shard) in self.restored:
+            cached = self.snapshots[target] = self.restored[(target, self.shard)]
+
+        # A restored snapshot is served whatever its age until the first collection is done
+        if cached is not None and (cached.restored or cached.age() <= schedule['max_staleness']):
+            if cached.restored or cached.age() > schedule['interval']:
+                self.refresh(target)
+            return defer.succeed(cached)
+
+        result = self.refresh(target)
+
+        def onRefreshed(refreshed):
+            if refreshed is None or refreshed.age() > schedule['max_staleness']:
+                raise Exception("No snapshot within max staleness for: {}".format(target))
+            return refreshed
+
+        return result.addCallback(onRefreshed)
+
+    def request_shard(self, request):
+        """
+        Shard asked for by the shard_index and shard_count parameters of a request
+        :return: tuple of shard index and count, the command line one when they are not given
+        :raises ValueError: when they are not a valid shard or more than MAX_SHARD_COUNT shards
+        """
+        if b'shard_index' in request.args or b'shard_count' in request.args:
+            shard = _shard(request.args.get(b'shard_index', [b'0'])[0],
+                           request.args.get(b'shard_count', [b'1'])[0])
+            if shard[1] > MAX_SHARD_COUNT and shard[1] != self.shard[1]:
+                raise ValueError("Shard count must be at most {}, got: {}".format(MAX_SHARD_COUNT, shard[1]))
+            return shard
+        return self.shard
+
+    def serve(self, target, shard, request):
+        """
+        Get the output of a target for a scrape
+        :return: Deferred firing with a Snapshot or a list of GaugeFamily, or 2 when the section is unknown
+        """
+        # Background collections are of the command line shard, other shards are collected on demand
+        if target in self.schedules and shard == self.shard:
+            return self.snapshot(target)
+
+        result = self.collect(target, shard)
+        if result != 2:
+            # Answer with what is there when the collection outlasts the scrape timeout
+            settings = self.configure(target)
+            deadline = _deadline(request, settings)
+            if deadline is not None:
+                result = self.within(result, target, settings, shard, deadline)
+        return result
+
+    def render_GET(self, request):
+        """
+        Render data from collector
+        """
+        if b'target' in request.args:
+            target = request.args[b'target'][0].decode("utf-8")
+        else:
+            target = 'default'
+
+        try:
+            shard = self.request_shard(request)
+        except ValueError as err:
+            request.setResponseCode(400)
+            return "Invalid shard: {}".format(err).encode()
+
+        result = self.serve(target, shard, request)
+        if result == 2:
+            return "No Config found for: {}".format(target).encode()
+
+        openmetrics, gzip = _negotiate(request)
+
+        def onSuccess(output):
+            _set_content_headers(request, openmetrics, gzip)
+            request.setResponseCode(200)
+            if isinstance(output, Snapshot):
+                request.write(output.encode(openmetrics, gzip))
+                request.finish()
+                return
+
+            # Fresh collections are streamed family by family instead of rendered whole
+            chunks = ExpositionWriter(output, openmetrics=openmetrics).chunks()
+            if gzip:
+                chunks = _gzip_chunks(chunks)
+            ExpositionProducer(request, chunks).start()
+
+        result.addCallback(onSuccess)
+
+        def onError(err):
+            log("Collection Error: {}".format(err))
+            request.setHeader("Content-Type", "text/plain; charset=UTF-8")
+            request.setResponseCode(500)
+            request.write("Collection failed for: {}".format(target).encode())
+            request.finish()
+
+        result.addErrback(onError)
+
+        return NOT_DONE_YET
+
+
+class VcdAllResource(Resource):
+    """
+    Class for collecting every configured section at once, each as a target of its own, and
+    rendering them together with a vcd_target label
+    """
+    isLeaf = True
+
+    def __init__(self, vcd):
+        Resource.__init__(self)
+        self.vcd = vcd
+
+    def render_GET(self, request):
+        try:
+            config = self.vcd.load_config()
+        except Exception as err:
+            log("Unable to load configuration: {}".format(err))
+            request.setResponseCode(500)
+            return "Unable to load configuration".encode()
+
+        try:
+            shard = self.vcd.request_shard(request)
+        except ValueError as err:
+            request.setResponseCode(400)
+            return "Invalid shard: {}".format(err).encode()
+
+        # Targets are collected concurrently, one failing or running late does not hold up the others
+        results = []
+        for target in sorted(section for section, settings in config.items() if settings):
+            result = self.vcd.serve(target, shard, request)
+            if result == 2:
+                continue
+
+            def onSuccess(output, target=target):
+                return target, output.families if isinstance(output, Snapshot) else output
+
+            def onError(err, target=target):
+                log("Collection Error for {}: {}".format(target, err))
+                return target, None
+
+            results.append(result.addCallbacks(onSuccess, onError))
+
+        openmetrics, gzip = _negotiate(request)
+
+        def onCollected(outputs):
+            _set_content_headers(request, openmetrics, gzip)
+            request.setResponseCode(200)
+            chunks = ExpositionWriter(_merge_targets(outputs), openmetrics=openmetrics).chunks()
+            if gzip:
+                chunks = _gzip_chunks(chunks)
+            ExpositionProducer(request, chunks).start()
+
+        defer.gatherResults(results).addCallback(onCollected)
+
+        return NOT_DONE_YET
+
+
+class Snapshot:
+    """
+    Class for the families of a background collection and their rendered encodings
+    """
+
+    def __init__(self, families, timestamp=None, restored=False):
+        self.families = families
+        self.encodings = {}
+        self.timestamp = timestamp or time.time()
+        self.restored = restored
+        self.failures = 0
+
+    def age(self):
+        return time.time() - self.timestamp
+
+    def encode(self, openmetrics=False, gzip=False):
+        """
+        Render the snapshot in a format, each format and compression is only rendered once
+        """
+        key = (openmetrics, gzip)
+        if key not in self.encodings:
+            if gzip:
+                self.encodings[key] = b''.join(_gzip_chunks([self.encode(openmetrics)]))
+            else:
+                self.encodings[key] = ExpositionWriter(self.families, openmetrics=openmetrics).render()
+        return self.encodings[key]
+
+
+class SnapshotCollector(object):
+    """
+    Class for exposing the age of cached background collections
+    """
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    def collect(self):
+        age = GaugeMetricFamily(
+            'vcd_exporter_snapshot_age_seconds',
+            'Seconds since the cached collection of the target was taken',
+            labels=['target'])
+        last_success = GaugeMetricFamily(
+            'vcd_exporter_snapshot_last_success_timestamp_seconds',
+            'Unix time of the last successful background collection of the target',
+            labels=['target'])
+        failures = GaugeMetricFamily(
+            'vcd_exporter_snapshot_failed_refreshes',
+            'Background collections that failed since the last successful one',
+            labels=['target'])
+
+        for target, snapshot in sorted(self.resource.snapshots.items()):
+            age.add_metric([target], snapshot.age())
+            last_success.add_metric([target], snapshot.timestamp)
+            failures.add_metric([target], snapshot.failures)
+
+        return [age, last_success, failures]
+
+
+class StateStore(object):
+    """
+    Class for the state files of the last successful collection of each target and shard, and
+    of its entity model, kept in a directory for a restarted exporter to serve and resume from
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.writing = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, target, shard):
+        return os.path.join(self.directory, '{}.{}-{}.state'.format(quote(target, safe=''), *shard))
+
+    def save(self, target, shard, families, model=None):
+        """
+        Write the state of a target and shard in the thread pool, skipped while the previous
+        write of the same state file is not done
+        :return: Deferred firing when the file is written
+        """
+        key = (target, shard)
+        if key in self.writing:
+            return defer.succeed(None)
+        self.writing.add(key)
+
+        # Committed entities are replaced and never changed, so they can be encoded outside the reactor
+        entities = None
+        if model is not None and model.checkpoint is not None:
+            entities = (model.entities, model.checkpoint, model.synced, model.origin)
+
+        result = threads.deferToThread(self._write, target, shard, time.time(), families, entities)
+
+        def onError(err):
+            log("Unable to save the state of {}: {}".format(target, err))
+
+        def onDone(_):
+            self.writing.discard(key)
+
+        return result.addErrback(onError).addBoth(onDone)
+
+    def _write(self, target, shard, timestamp, families, entities):
+        """
+        Encode a state as zlib compressed JSON in which each label tuple is stored once, runs in the thread pool
+        """
+        labels, indexes = [], {}
+
+        def index(values):
+            found = indexes.get(values)
+            if found is None:
+                found = indexes[values] = len(labels)
+                labels.append(values)
+            return found
+
+        state = {
+            'version': STATE_VERSION,
+            'target': target,
+            'shard': list(shard),
+            'timestamp': timestamp,
+            'families': [[family.name, family.documentation, family.labels,
+                          [[index(values), value] for values, value in family.samples]]
+                         for family in families],
+            'model': None,
+        }
+        if entities is not None:
+            entities, checkpoint, synced, origin = entities
+            state['model'] = {
+                'checkpoint': checkpoint,
+                'synced': synced,
+                'origin': origin,
+                'entities': [[urn, entity['fingerprint'],
+                              [[name, index(values), value] for name, values, value in entity['samples']],
+                              index(entity['parents']) if entity.get('parents') is not None else None,
+                              entity.get('href')]
+                             for urn, entity in entities.items()],
+            }
+        state['labels'] = labels
+
+        path = self.path(target, shard)
+        with open(path + '.tmp', 'wb') as handle:
+            handle.write(zlib.compress(json.dumps(state, separators=(',', ':')).encode('utf-8'), GZIP_LEVEL))
+        os.replace(path + '.tmp', path)
+
+    def load(self):
+        """
+        Read every state file of the directory, unreadable files and files of another version are skipped
+        :return: dict of the timestamp, list of GaugeFamily and EntityModel or None by target and shard
+        """
+        states = {}
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.state'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), 'rb') as handle:
+                    state = json.loads(zlib.decompress(handle.read()).decode('utf-8'))
+                if state.get('version') != STATE_VERSION:
+                    raise Exception("version {} is not {}".format(state.get('version'), STATE_VERSION))
+                states[(state['target'], tuple(state['shard']))] = self._decode(state)
+            except Exception as err:
+                log("Unable to restore state file {}: {}".format(name, err))
+        return states
+
+    @staticmethod
+    def _decode(state):
+        # Label tuples are rebuilt once and shared by the families and entities using them
+        labels = [tuple(values) for values in state['labels']]
+
+        families = []
+        for name, documentation, names, samples in state['families']:
+            family = GaugeFamily(name, documentation, names)
+            family.samples = [(labels[index], value) for index, value in samples]
+            families.append(family)
+
+        model = None
+        if state['model'] is not None:
+            model = EntityModel()
+            model.checkpoint = state['model']['checkpoint']
+            model.synced = state['model']['synced']
+            model.origin = state['model']['origin']
+            model.entities = {
+                urn: {'fingerprint': _tuples(fingerprint),
+                      'samples': [(name, labels[index], value) for name, index, value in samples],
+                      'parents': labels[parents] if parents is not None else None,
+                      'href': href}
+                for urn, fingerprint, samples, parents, href in state['model']['entities']
+            }
+
+        return {'timestamp': state['timestamp'], 'families': families, 'model': model}
+
+
+class VcdCollector:
+    """
+    Class for vCD collector
+    """
+
+    def __init__(self, vcd_host, vcd_user, vcd_org, vcd_password, ignore_ssl, vcd_client,
+                 max_requests=MAX_REQUESTS, level_requests=None, collection_backend='object',
+                 query_page_size=QUERY_PAGE_SIZE, vcd_connection=None, entity_model=None,
+                 resync_interval=RESYNC_INTERVAL, target=None, levels=LEVELS, filters=None, shard=(0, 1),
+                 partition=(0, 1), xml_parser=XML_PARSERS[0], notifications=None,
+                 reconcile_interval=RECONCILE_INTERVAL, profile=None):
+        self.vcd_host = vcd_host
+        self.target = target or vcd_host
+        self.vcd_user = vcd_user
+        self.vcd_org = vcd_org
+        self.vcd_password = vcd_password
+        self.ignore_ssl = ignore_ssl
+        self.vcd_client = vcd_client
+        self.vdc_resources = None
+        self.collection_backend = collection_backend
+        self.query_page_size = query_page_size
+        self.vcd_connection = vcd_connection
+        self.entity_model = entity_model
+        self.resync_interval = resync_interval
+        self.notifications = notifications
+        self.reconcile_interval = reconcile_interval
+        self.vapp_fingerprints = None
+        self.vapp_changes = set()
+        self.levels = set(levels)
+        self.filters = filters or {}
+        self.shard = shard
+        self.partition = partition
+        self.xml_parser = xml_parser
+        # Requests sent from the reactor by the HTTP agent of the session, when it has one
+        self.agent = getattr(vcd_connection, 'agent', None) if xml_parser == 'iterparse' else None
+        self.profile = profile
+        self.finished = False
+        # Entities collected and listed per level, and the samples collected so far
+        self.progress = {'org': [0, None], 'vdc': [0, 0], 'vapp': [0, 0]}
+        self.partial = []
+
+        # Bound the number of vCD requests in flight, overall and for each level of the walk
+        self.requests = PrioritySemaphore(max_requests)
+        self.level_requests = {
+            level: defer.DeferredSemaphore((level_requests or {}).get(level, limit))
+            for level, limit in MAX_LEVEL_REQUESTS.items()
+        }
+
+    def _families(self):
+        """
+        Empty families of the collected levels
+        :return: dict of the GaugeFamily by metric name
+        """
+        metric_list = dict()
+        metric_list['org'] = {
+            'vcd_org_is_enabled': GaugeFamily(
+                'vcd_org_is_enabled',
+                json.dumps({
+                    "Description": "Enabled status of Organization",
+                    "Enabled": 1,
+                    "Disabled": 0
+                }),
+                labels=['org_name', 'org_full_name', 'org_id'])
+        }
+        metric_list['vdc'] = {
+            'vcd_vdc_cpu_allocated': GaugeFamily(
+                'vcd_vdc_cpu_allocated',
+                'CPU allocated to vdc',
+                labels=['vdc_id', 'vdc_name', 'org_id', 'org_name', 'vdc_is_enabled', 'allocation_model']),
+            'vcd_vdc_mhz_to_vcpu': GaugeFamily(
+                'vcd_vdc_mhz_to_vcpu',
+                'Mhz to vCPU ratio of vdc',
+                labels=['vdc_id', 'vdc_name', 'org_id', 'org_name', 'vdc_is_enabled', 'allocation_model']),
+            'vcd_vdc_memory_allocated': GaugeFamily(
+                'vcd_vdc_memory_allocated',
+                'Memory allocated to vdc',
+                labels=['vdc_id', 'vdc_name', 'org_id', 'org_name', 'vdc_is_enabled', 'allocation_model']),
+            'vcd_vdc_memory_used_bytes': GaugeFamily(
+                'vcd_vdc_memory_used_bytes',
+                'Memory used by vdc in bytes',
+                labels=['vdc_id', 'vdc_name', 'org_id', 'org_name', 'vdc_is_enabled', 'allocation_model']),
+            'vcd_vdc_used_network_count': GaugeFamily(
+                'vcd_vdc_used_network_count',
+                'Number of networks used by vdc',
+                labels=['vdc_id', 'vdc_name', 'org_id', 'org_name', 'vdc_is_enabled', 'allocation_model']),
+        }
+
+        """
+        {
+            "Description": "Status of vApp",
+            "Status": {
+                "FAILED_CREATION": -1,
+                "UNRESOLVED": 0,
+                "RESOLVED": 1,
+                "DEPLOYED": 2,
+                "SUSPENDED": 3,
+                "POWERED_ON": 4,
+                "WAITING_FOR_INPUT": 5,
+                "UNKNOWN": 6,
+                "UNRECOGNIZED": 7,
+                "POWERED_OFF": 8,
+                "INCONSISTENT_STATE": 9,
+                "MIXED": 10
+            }
+        }
+        """
+
+        metric_list['vapp_resources'] = {
+            'vcd_vdc_vapp_status': GaugeFamily(
+                'vcd_vdc_vapp_status',
+                'Status of vApp',
+                labels=['vapp_id', 'vapp_name', 'vapp_deployed', 'vapp_status', 'vdc_id', 'vdc_name',
+                        'org_id', 'org_name', 'vdc_is_enabled']
+            ),
+            'vcd_vdc_vapp_in_maintenance': GaugeFamily(
+                'vcd_vdc_vapp_in_maintenance',
+                'Status of maintenance mode of given vApp',
+                labels=['vapp_id', 'vapp_name', 'vapp_deployed', 'vdc_id', 'vdc_name',
+                        'org_id', 'org_name', 'vdc_is_enabled'])
+        }
+
+        """
+        {
+            "Description": 'Status of VM',
+            "States": {
+                "FAILED_CREATION": -1,
+                "UNRESOLVED": 0,
+                "RESOLVED": 1,
+                "DEPLOYED": 2,
+                "SUSPENDED": 3,
+                "POWERED_ON": 4,
+                "WAITING_FOR_INPUT": 5,
+                "UNKNOWN": 6,
+                "UNRECOGNIZED": 7,
+                "POWERED_OFF": 8,
+                "INCONSISTENT_STATE": 9,
+                "MIXED": 10
+            }
+        }
+        """
+
+        metric_list['vm_resources'] = {
+            'vcd_vdc_vapp_vm_status': GaugeFamily(
+                'vcd_vdc_vapp_vm_status',
+                'Status of VM',
+                labels=['vm_id', 'vm_name', 'vm_deployed', 'vm_status', 'vm_os_type', 'vapp_id',
+                        'vapp_name', 'vapp_deployed', 'vdc_id', 'vdc_name', 'org_id', 'org_name',
+                        'vdc_is_enabled']
+            ),
+            'vcd_vdc_vapp_vm_vcpu': GaugeFamily(
+                'vcd_vdc_vapp_vm_vcpu',
+                'vCPU count of vm in given vApp of vdc',
+                labels=['vm_id', 'vm_name', 'vm_deployed', 'vm_status', 'vm_os_type', 'vapp_id',
+                        'vapp_name', 'vapp_deployed', 'vdc_id', 'vdc_name', 'org_id', 'org_name',
+                        'vdc_is_enabled']
+            ),
+            'vcd_vdc_vapp_vm_allocated_memory_mb': GaugeFamily(
+                'vcd_vdc_vapp_vm_allocated_memory_mb',
+                'Memory allocated to VM of given vApp of vdc',
+                labels=['vm_id', 'vm_name', 'vm_deployed', 'vm_status', 'vm_os_type', 'vapp_id',
+                        'vapp_name', 'vapp_deployed', 'vdc_id', 'vdc_name', 'org_id', 'org_name',
+                        'vdc_is_enabled'])
+        }
+
+        metrics = {}
+        for level in LEVELS:
+            if level in self.levels:
+                metrics.update(metric_list[LEVEL_FAMILIES[level]])
+        return metrics
+
+    def collect(self):
+        metrics = self._families()
+
+        start = datetime.utcnow()
+        if self.collection_backend == 'query':
+            samples = self._vcd_query_collect()
+        elif self.collection_backend == 'incremental' and self.entity_model is not None:
+            samples = self._vcd_incremental_collect()
+        else:
+            samples = self._vcd_orgs_collect()
+
+        def onCollected(samples):
+            # Samples are merged in traversal order so the output is deterministic
+            for name, labels, value in samples:
+                metrics[name].add_metric(labels, value)
+
+            for name, family in metrics.items():
+                SERIES.labels(self.target, name).set(len(family.samples))
+
+            duration = datetime.utcnow() - start
+            COLLECTION_DURATION.labels(self.target).observe(duration.total_seconds())
+            log("Finished All vOrg Metrics Collection: ({})".format(duration))
+            self.finished = True
+            return list(metrics.values())
+
+        samples.addCallback(onCollected)
+
+        return samples
+
+    def partial_families(self):
+        """
+        Families of the entities collected so far, for a scrape that cannot wait for the whole collection
+        """
+        metrics = self._families()
+        for name, labels, value in list(self.partial):
+            metrics[name].add_metric(labels, value)
+        return list(metrics.values())
+
+    def completeness(self):
+        """
+        Share of the entities of each collected level collected so far, a level whose parents
+        are not all collected yet only counts for the share of them that is
+        :return: dict of the share by level
+        """
+        ratios = {}
+        share = 1.0 if self.finished or self.progress['org'][1] is not None else 0.0
+        for level in ('org', 'vdc', 'vapp'):
+            done, total = self.progress[level]
+            if self.finished:
+                share = 1.0
+            elif total:
+                share *= float(done) / total
+            elif share < 1.0:
+                share = 0.0
+            ratios[level] = share
+        ratios['vm'] = ratios['vapp']
+        return {level: ratios[level] for level in LEVELS if level in self.levels}
+
+    def _progress(self, level, done=0, listed=0, samples=None):
+        """
+        Account for entities of a level listed or collected, and keep the samples of the collected ones
+        """
+        if self.progress[level][1] is None:
+            self.progress[level][1] = 0
+        self.progress[level][0] += done
+        self.progress[level][1] += listed
+        if samples:
+            self.partial.extend(samples)
+
+    def _selected(self, level, name):
+        """
+        Whether an org or vDC name passes the include and exclude regexes of its level
+        """
+        include, exclude = self.filters.get(level, (None, None))
+        if include is not None and not include.search(name):
+            return False
+        return exclude is None or not exclude.search(name)
+
+    def _in_shard(self, org_href):
+        """
+        Whether an org belongs to the shard and the worker partition collected, orgs are spread
+        over both by their URN
+        """
+        urn = 'urn:vcloud:org:{}'.format(_href_id(org_href))
+        index, count = self.shard
+        if count > 1 and _shard_of(urn, count) != index:
+            return False
+        index, count = self.partition
+        return count == 1 or _shard_of('partition:{}'.format(urn), count) == index
+
+    def _narrowed(self):
+        """
+        Whether only some orgs are collected, by the shard, the worker partition or the org filters
+        """
+        return self.shard[1] > 1 or self.partition[1] > 1 or self.filters.get('org', (None, None)) != (None, None)
+
+    def _selected_org_hrefs(self, org_records):
+        """
+        Hrefs of the orgs collected among organization query records
+        """
+        return [org_record.get('href') for org_record in org_records
+                if self._in_shard(org_record.get('href')) and self._selected('org', org_record.get('name'))]
+
+    def _vcd_org_query(self, query_type, fields, org_hrefs, qfilter=None, phase=None):
+        """
+        Run a vApp level query for some orgs only, QUERY_FILTER_ORGS orgs at a time
+        :param org_hrefs: hrefs of the orgs, None for every org
+        """
+        if org_hrefs is None:
+            return self._vcd_query('vapp', query_type, fields, qfilter=qfilter, phase=phase)
+
+        queries = []
+        for start in range(0, len(org_hrefs), QUERY_FILTER_ORGS):
+            orgs = '({})'.format(','.join(['org=={}'.format(href)
+                                           for href in org_hrefs[start:start + QUERY_FILTER_ORGS]]))
+            queries.append(self._vcd_query('vapp', query_type, fields,
+                                           qfilter='{};{}'.format(qfilter, orgs) if qfilter else orgs, phase=phase))
+        return self._gather(queries)
+
+    def _collects(self, *levels):
+        """
+        Whether any of the levels is collected
+        """
+        return any(level in self.levels for level in levels)
+
+    def _request(self, level, fn, *args, phase=None):
+        """
+        Run a blocking vCD call in the thread pool within the global and per-level request limits
+        :param level: traversal level the call belongs to
+        :param phase: phase the call is timed as, defaults to the level
+        """
+        priority = LEVEL_PRIORITY[level]
+        run = threads.deferToThread
+        if self.vcd_connection is not None:
+            # Re-authenticate transparently when the persistent session has expired, and pace
+            # the requests with the scheduler of the session
+            fn, args = self.vcd_connection.call, (fn,) + args
+            run = self.vcd_connection.scheduler.prioritized(priority)
+        return self.level_requests[level].run(self.requests.run, priority, run, self._timed, phase or level, fn, *args)
+
+    def _in_thread(self, fn, *args):
+        """
+        Run blocking work in the threads of the vCD connection of the target, or in the reactor ones
+        """
+        if self.profile is not None:
+            fn, args = self.profile.runcall, (fn,) + args
+        if self.vcd_connection is not None:
+            return self.vcd_connection.run_in_thread(fn, *args)
+        return threads.deferToThread(fn, *args)
+
+    def _timed(self, phase, fn, *args):
+        """
+        Run a vCD call and record its duration, and the part of it not spent on HTTP, runs in the thread pool
+        """
+        _http_time.seconds = 0.0
+        start = time.time()
+        try:
+            if self.profile is not None:
+                return self.profile.runcall(fn, *args)
+            return fn(*args)
+        finally:
+            duration = time.time() - start
+            processing = max(duration - _http_time.seconds, 0.0)
+            PHASE_DURATION.labels(self.target, phase).observe(duration)
+            PROCESSING_DURATION.labels(self.target, phase).observe(processing)
+            if self.profile is not None:
+                self.profile.phase(phase, duration, processing)
+
+    def _vcd_fetch(self, level, href, parse, summary=None, phase=None):
+        """
+        Fetch and read a vCD resource within the request limits, from the reactor with the HTTP agent
+        of the session when it has one, else in the thread pool
+        :param parse: parser of the raw document, used with the iterparse parser
+        :param summary: reader of the objectified document, used with the objectify parser
+        """
+        if self.agent is None:
+            return self._request(level, self._vcd_resource, href, parse, summary, phase=phase)
+
+        priority = LEVEL_PRIORITY[level]
+        run = self.vcd_connection.scheduler.prioritized(priority, runner=defer.maybeDeferred)
+        return self.level_requests[level].run(self.requests.run, priority, run, self._timed_get, phase or level,
+                                              href, parse)
+
+    def _timed_get(self, phase, href, parse):
+        """
+        GET a vCD resource with the HTTP agent and read it in the thread pool, recording the same
+        durations as _timed()
+        """
+        start = time.time()
+        result = self.vcd_connection.get(href)
+        return result.addCallback(lambda body: self._in_thread(self._timed_parse, phase, start, parse, body))
+
+    def _timed_parse(self, phase, start, parse, body):
+        """
+        Read a document fetched by _timed_get(), runs in the thread pool
+        """
+        parsing = time.time()
+        try:
+            return parse(body)
+        finally:
+            duration, processing = time.time() - start, time.time() - parsing
+            PHASE_DURATION.labels(self.target, phase).observe(duration)
+            PROCESSING_DURATION.labels(self.target, phase).observe(processing)
+            if self.profile is not None:
+                self.profile.phase(phase, duration, processing)
+
+    @staticmethod
+    def _gather(deferreds):
+        """
+        Merge the samples of concurrently collected children, keeping their original order
+        """
+        def onGathered(results):
+            return [sample for samples in results for sample in samples]
+
+        return defer.gatherResults(deferreds).addCallback(onGathered)
+
+    def _vcd_orgs_collect(self):
+        if self.agent is not None:
+            orgs = self._vcd_org_list()
+        else:
+            orgs = self._request('org', self.vcd_client.get_org_list)
+
+        def onSuccess(org_resources):
+            org_resources = [org_resource for org_resource in org_resources
+                             if self._in_shard(org_resource.get('href'))
+                             and self._selected('org', org_resource.get('name'))]
+            self._progress('org', listed=len(org_resources))
+            return self._gather([self._vcd_org_collect(org_resource) for org_resource in org_resources])
+
+        orgs.addCallback(onSuccess)
+
+        def onError(err):
+            log("Unable to poll vOrg: {}".format(err))
+            COLLECTION_ERRORS.labels(self.target, 'org').inc()
+            return []
+
+        orgs.addErrback(onError)
+
+        return orgs
+
+    def _vcd_org_list(self):
+        """
+        Same as vcd_client.get_org_list() with the HTTP agent, the orgs are fetched concurrently
+        """
+        hrefs = self._vcd_fetch('org', '{}/org'.format(self.vcd_client.get_api_uri()), _parse_org_list)
+
+        def onListed(org_hrefs):
+            return defer.gatherResults([self._vcd_fetch('org', href, objectify.fromstring) for href in org_hrefs])
+
+        return hrefs.addCallback(onListed)
+
+    def _vcd_org_collect(self, org_resource):
+        org = Org(self.vcd_client, resource=org_resource)
+        org_labels = (str(org.resource.attrib['id']), str(org.get_name()))
+
+        if self.agent is not None:
+            # The API version of the session lists the vDCs from the links of the org, only the
+            # admin org is fetched
+            vdcs = self._vcd_fetch('org', org.href_admin, objectify.fromstring)
+            vdcs.addCallback(lambda admin_org: (org.list_vdcs(), admin_org['IsEnabled']))
+        else:
+            vdcs = self._request('org', self._vcd_vdc_resources_collect, org)
+
+        def onSuccess(resources):
+            vdc_resources, is_enabled = resources
+            if not vdc_resources:
+                log("Org has no vDC: {}".format(str(org.get_name())))
+                self._progress('org', done=1)
+                return []
+
+            samples = []
+            if 'org' in self.levels:
+                samples.append(('vcd_org_is_enabled', org_labels, float(is_enabled)))
+            if not self._collects('vdc', 'vapp', 'vm'):
+                self._progress('org', done=1, samples=samples)
+                return samples
+
+            vdc_resources = [vdc_resource for vdc_resource in vdc_resources
+                             if self._selected('vdc', vdc_resource['name'])]
+            self._progress('vdc', listed=len(vdc_resources))
+            self._progress('org', done=1, samples=samples)
+            children = self._gather([self._vcd_vdc_collect(org, vdc_resource) for vdc_resource in vdc_resources])
+            return children.addCallback(lambda child_samples: samples + child_samples)
+
+        vdcs.addCallback(onSuccess)
+
+        def onError(err):
+            log("Unable to gather vDC: {}".format(err))
+            COLLECTION_ERRORS.labels(self.target, 'org').inc()
+            self._progress('org', done=1)
+            return []
+
+        vdcs.addErrback(onError)
+
+        return vdcs
+
+    def _vcd_vdc_collect(self, org, vdc_resource):
+        vdc = self._vcd_fetch('vdc', get_non_admin_href(vdc_resource['href']), _parse_vdc, _vdc_summary)
+        vdc.addCallback(self._vcd_vdc_samples_collect, org)
+
+        def onSuccess(resources):
+            vdc, samples, vapp_resources = resources
+            # Labels inherited from the vDC and org are built once and shared by its vApps and VMs
+            parent_labels = (
+                vdc['id'],
+                vdc['name'],
+                org.resource.attrib['id'],
+                str(org.get_name()),
+                vdc['is_enabled']
+            )
+            if self.entity_model is not None:
+                self.entity_model.parents[vdc['id']] = parent_labels
+            self._progress('vapp', listed=len(vapp_resources))
+            self._progress('vdc', done=1, samples=samples)
+            children = self._gather([self._vcd_vapp_collect(parent_labels, vapp_resource)
+                                     for vapp_resource in vapp_resources])
+            return children.addCallback(lambda child_samples: samples + child_samples)
+
+        vdc.addCallback(onSuccess)
+
+        def onError(err):
+            log("Unable to poll vDC: {}".format(err))
+            COLLECTION_ERRORS.labels(self.target, 'vdc').inc()
+            self._progress('vdc', done=1)
+            return []
+
+        vdc.addErrback(onError)
+
+        return vdc
+
+    def _vcd_vapp_collect(self, parent_labels, vapp_resource):
+        urn, fingerprint = self._vcd_vapp_fingerprint(parent_labels, vapp_resource)
+        if self.entity_model is not None:
+            samples = self.entity_model.get(urn, fingerprint)
+            if samples is not None:
+                self.entity_model.store(urn, fingerprint, samples, parent_labels, vapp_resource['href'])
+                self._progress('vapp', done=1, samples=samples)
+                return defer.succeed(samples)
+
+        # The href listed by the vDC saves the query vdc.get_vapp() runs to look the vApp up by name
+        vapp = self._vcd_fetch('vapp', vapp_resource['href'], _parse_vapp, _vapp_summary)
+        vapp.addCallback(self._vcd_vapp_samples_collect, parent_labels)
+
+        def onSuccess(samples):
+            if self.entity_model is not None:
+                self.entity_model.store(urn, fingerprint, samples, parent_labels, vapp_resource['href'])
+            self._progress('vapp', done=1, samples=samples)
+            return samples
+
+        vapp.addCallback(onSuccess)
+
+        def onError(err):
+            log("Unable to poll vApp: {}".format(err))
+            COLLECTION_ERRORS.labels(self.target, 'vapp').inc()
+            self._progress('vapp', done=1)
+            if self.entity_model is not None:
+                # Keep collecting in full until the vApp is collected again
+                self.entity_model.stale = True
+            return []
+
+        vapp.addErrback(onError)
+
+        return vapp
+
+    def _vcd_vapp_fingerprint(self, parent_labels, vapp_resource):
+        """
+        Fingerprint a vApp from its query records and the labels it inherits, None when it
+        has to be fetched anyway
+        """
+        vapp_uuid = _href_id(vapp_resource.get('href') or '')
+        urn = 'urn:vcloud:vapp:{}'.format(vapp_uuid)
+        if self.vapp_fingerprints is None or vapp_uuid in self.vapp_changes:
+            return urn, None
+
+        records = self.vapp_fingerprints.get(vapp_uuid)
+        if records is None:
+            return urn, None
+
+        return urn, (records, vapp_resource['name']) + parent_labels
+
+    def _vcd_incremental_collect(self):
+        """
+        Walk orgs and vDCs as usual but only fetch the vApps whose query records changed, or
+        which had a task, since the previous collection, the others come from the entity model
+        """
+        if not self._collects('vapp', 'vm'):
+            return self._vcd_orgs_collect()
+
+        model = self.entity_model
+        if model.age() > self.resync_interval:
+            if model.synced is not None:
+                log("Full resync of the entity model for: {}".format(self.vcd_host))
+            model.clear()
+        if self._notified():
+            return self._vcd_notified_collect()
+        since = model.begin()
+
+        admin = self.vcd_client.is_sysadmin()
+
+        def query(org_hrefs):
+            return defer.gatherResults([
+                self._vcd_org_query((ResourceType.ADMIN_VAPP if admin else ResourceType.VAPP).value,
+                                    'name,vdc,status,isDeployed,isInMaintenanceMode', org_hrefs),
+                self._vcd_org_query((ResourceType.ADMIN_VM if admin else ResourceType.VM).value,
+                                    'name,container,status,isDeployed,numberOfCpus,memoryMB', org_hrefs,
+                                    qfilter='isVAppTemplate==false', phase='vm')
+                if 'vm' in self.levels else defer.succeed([]),
+                self._vcd_tasks(admin, since) if since is not None else defer.succeed([]),
+            ])
+
+        if admin and self._narrowed():
+            # The admin queries span every org, only the collected ones are asked for
+            changes = self._vcd_query('org', ResourceType.ORGANIZATION.value, 'name')
+            changes.addCallback(lambda org_records: query(self._selected_org_hrefs(org_records)))
+        else:
+            changes = query(None)
+
+        def onChanges(records):
+            vapp_records, vm_records, task_records = records
+            self.vapp_fingerprints, self.vapp_changes = self._vcd_vapp_changes(
+                vapp_records, vm_records, task_records)
+
+        def onError(err):
+            log("Unable to query vCD changes, fetching every vApp: {}".format(err))
+            COLLECTION_ERRORS.labels(self.target, 'query').inc()
+
+        changes.addCallbacks(onChanges, onError)
+        changes.addCallback(lambda _: self._vcd_orgs_collect())
+
+        def onCollected(samples):
+            model.commit(samples)
+            return samples
+
+        changes.addCallback(onCollected)
+
+        return changes
+
+    def _notified(self):
+        """
+        Whether vCD notified every change since the last full collection of the entity model,
+        which is then not older than the reconcile interval
+        """
+        model = self.entity_model
+        subscribed = self.notifications.subscribed if self.notifications is not None else None
+        return (subscribed is not None and model.checkpoint is not None and subscribed <= model.checkpoint
+                and not model.stale and time.time() - model.checkpoint < self.reconcile_interval)
+
+    def _vcd_notified_collect(self):
+        """
+        Build the collection from the entity model and only fetch the vApps vCD notified
+        changes of since the previous collection
+        """
+        model = self.entity_model
+        vapps = model.patch()
+
+        fetched = set(urn for urn, _, _ in vapps)
+        self._progress('org')
+        self._progress('vdc', samples=model.static)
+        self._progress('vapp', listed=len(vapps), samples=[
+            sample for urn, entity in model.pending.items() if urn not in fetched for sample in entity['samples']])
+
+        api_uri = self.vcd_client.get_api_uri()
+        collected = self._gather([
+            self._vcd_vapp_collect(parent_labels, {
+                'href': href or '{}/vApp/vapp-{}'.format(api_uri, urn.rsplit(':', 1)[-1])
+            })
+            for urn, parent_labels, href in vapps
+        ])
+
+        def onCollected(_):
+            samples = model.samples()
+            model.commit(samples)
+            return samples
+
+        collected.addCallback(onCollected)
+
+        return collected
+
+    def _vcd_tasks(self, admin, since):
+        """
+        Query the tasks that ended since the given time
+        """
+        qfilter = 'endDate=ge={}'.format(
+            quote(time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(since - TASK_CLOCK_SKEW))))
+        return self._vcd_query('vapp', (ResourceType.ADMIN_TASK if admin else ResourceType.TASK).value,
+                               'name,object,endDate', qfilter=qfilter)
+
+    @staticmethod
+    def _vcd_vapp_changes(vapp_records, vm_records, task_records):
+        """
+        Fingerprint every vApp with its VMs, and find the vApps touched by tasks
+        :return: fingerprints by vApp uuid, and the set of vApp uuids to fetch anyway
+        """
+        vms_by_vapp = {}
+        vm_vapps = {}
+        for vm_record in vm_records:
+            vapp_uuid = _href_id(vm_record.get('container'))
+            vm_vapps[_href_id(vm_record.get('href'))] = vapp_uuid
+            vms_by_vapp.setdefault(vapp_uuid, []).append(tuple(sorted(vm_record.items())))
+
+        fingerprints = {}
+        for vapp_record in vapp_records:
+            vapp_uuid = _href_id(vapp_record.get('href'))
+            fingerprints[vapp_uuid] = (tuple(sorted(vapp_record.items())),
+                                       tuple(sorted(vms_by_vapp.get(vapp_uuid, []))))
+
+        changes = set()
+        for task_record in task_records:
+            object_uuid = _href_id(task_record.get('object') or '')
+            changes.add(vm_vapps.get(object_uuid, object_uuid))
+
+        return fingerprints, changes
+
+    def _vcd_resource(self, href, parse, summary):
+        """
+        Fetch a vDC, a vApp or a query page and keep only the fields the metrics need, runs in the thread pool
+        :param parse: parser of the raw document, used with the iterparse parser
+        :param summary: reader of the objectified document, used with the objectify parser
+        """
+        if self.xml_parser == 'objectify':
+            return summary(self.vcd_client.get_resource(href))
+        return parse(_get_raw(self.vcd_client, href))
+
+    def _vcd_vdc_samples_collect(self, vdc, org):
+        """
+        Build the samples of a fetched vDC
+        """
+        samples = []
+        if 'vdc' in self.levels:
+            samples = self._vcd_vdc_samples(vdc, org.resource.attrib['id'], str(org.get_name()))
+
+        vapp_resources = []
+        if self._collects('vapp', 'vm'):
+            vapp_resources = vdc['vapps']
+
+        return vdc, samples, vapp_resources
+
+    @staticmethod
+    def _vcd_vdc_samples(vdc, org_id, org_name):
+        vdc_labels = (vdc['id'],
+                      vdc['name'],
+                      org_id,
+                      org_name,
+                      vdc['is_enabled'],
+                      str(vdc['allocation_model']))
+
+        return [
+            ('vcd_vdc_cpu_allocated', vdc_labels, float(vdc['cpu_allocated'])),
+            ('vcd_vdc_mhz_to_vcpu', vdc_labels, float(vdc['vcpu_in_mhz'])),
+            ('vcd_vdc_memory_allocated', vdc_labels, float(vdc['memory_allocated'])),
+            ('vcd_vdc_memory_used_bytes', vdc_labels, float(vdc['memory_used'])),  # Need to normalize
+            ('vcd_vdc_used_network_count', vdc_labels, float(vdc['used_network_count'])),
+        ]
+
+    def _vcd_vapp_samples_collect(self, vapp, parent_labels):
+        """
+        Build the samples of a fetched vApp and its VMs
+        :param parent_labels: labels inherited from the vDC and org
+        """
+        vapp_labels = (
+            vapp['id'],
+            vapp['name'],
+            vapp['deployed'],
+            vapp['status'],
+        ) + parent_labels
+        samples = []
+        if 'vapp' in self.levels:
+            samples.append(('vcd_vdc_vapp_status', vapp_labels, float(vapp['status'])))
+            samples.append(('vcd_vdc_vapp_in_maintenance', vapp_labels, float(_query_bool(vapp['in_maintenance']))))
+        if 'vm' not in self.levels:
+            return samples
+
+        try:
+            vm_parent_labels = vapp_labels[:3] + parent_labels
+            for vm in vapp['vms']:
+                vm_labels = (
+                    vm['id'],
+                    vm['name'],
+                    vm['deployed'],
+                    vm['status'],
+                ) + vm_parent_labels
+                samples.append(('vcd_vdc_vapp_vm_status', vm_labels, float(vm['status'])))
+                samples.append(('vcd_vdc_vapp_vm_vcpu', vm_labels, float(vm['cpus'])))
+                samples.append(('vcd_vdc_vapp_vm_allocated_memory_mb', vm_labels, float(vm['memory_mb'])))
+        except Exception as err:
+            log("Unable to poll VM: {}".format(err))
+            COLLECTION_ERRORS.labels(self.target, 'vm').inc()
+
+        return samples
+
+    def _vcd_query(self, level, query_type, fields, qfilter=None, phase=None):
+        """
+        Run a paged typed query, the pages after the first one are fetched concurrently
+        :param level: traversal level the query requests belong to
+        :param phase: phase the query requests are timed as, defaults to the level
+        """
+        def page(number):
+            query = self.vcd_client.get_typed_query(
+                query_type,
+                query_result_format=QueryResultFormat.RECORDS,
+                page=number,
+                page_size=self.query_page_size,
+                qfilter=qfilter,
+                sort_asc='name',
+                fields=fields
+            )
+            if self.xml_parser == 'objectify':
+                return self._request(level, query.execute, phase=phase)
+
+            # Same uri as execute(), from the query links pyvcloud read at login, records are read as
+            # dicts of their attributes
+            query_href = query._find_query_uri(query._query_result_format)
+            if query_href is None:
+                return defer.fail(OperationNotSupportedException('Unable to execute query.'))
+            return self._vcd_fetch(level, query._build_query_uri(
+                query_href, number, self.query_page_size, query._filter, query._include_links, fields=query.fields),
+                _parse_query_page, phase=phase)
+
+        first = page(1)
+
+        def onFirstPage(result):
+            # vCD may cap the page size below what was asked for, count pages from what came back
+            page_size = max(len(result['values']), 1)
+            pages = [page(number) for number in range(2, int(math.ceil(result['resultTotal'] / float(page_size))) + 1)]
+
+            def onPages(results):
+                return [record for page_result in [result] + results for record in page_result['values']]
+
+            return defer.gatherResults(pages).addCallback(onPages)
+
+        first.addCallback(onFirstPage)
+
+        return first
+
+    def _vcd_query_collect(self):
+        """
+        Collect from a handful of paged query-service list calls instead of walking every object
+        """
+        admin = self.vcd_client.is_sysadmin()
+        parents = [
+            self._vcd_query('org', ResourceType.ORGANIZATION.value, 'name,isEnabled'),
+            self._vcd_query('vdc', (ResourceType.ADMIN_ORG_VDC if admin else ResourceType.ORG_VDC).value,
+                            'name,org'),
+        ]
+
+        def query(org_hrefs):
+            return [
+                self._vcd_org_query((ResourceType.ADMIN_VAPP if admin else ResourceType.VAPP).value,
+                                    'name,vdc,status,isDeployed,isInMaintenanceMode', org_hrefs)
+                if self._collects('vapp', 'vm') else defer.succeed([]),
+                self._vcd_org_query((ResourceType.ADMIN_VM if admin else ResourceType.VM).value,
+                                    'name,container,status,isDeployed,numberOfCpus,memoryMB', org_hrefs,
+                                    qfilter='isVAppTemplate==false', phase='vm')
+                if 'vm' in self.levels else defer.succeed([]),
+            ]
+
+        if admin and self._narrowed():
+            # The admin queries span every org, the vApps and VMs are only asked for the collected orgs
+            def onParents(records):
+                entities = defer.gatherResults(query(self._selected_org_hrefs(records[0])))
+                return entities.addCallback(lambda entity_records: records + entity_records)
+
+            queries = defer.gatherResults(parents, consumeErrors=True).addCallback(onParents)
+        else:
+            queries = defer.gatherResults(parents + query(None))
+
+        def onRecords(records):
+            org_records, vdc_records, vapp_records, vm_records = records
+
+            # Orgs without any vDC are skipped whatever the vDC filters let through
+            orgs_with_vdcs = set(_href_id(vdc_record.get('org')) for vdc_record in vdc_records)
+
+            org_records = [org_record for org_record in org_records if self._in_shard(org_record.get('href'))
+                           and self._selected('org', org_record.get('name'))]
+            selected_orgs = set(_href_id(org_record.get('href')) for org_record in org_records)
+            vdc_records = [vdc_record for vdc_record in vdc_records
+                           if _href_id(vdc_record.get('org')) in selected_orgs
+                           and self._selected('vdc', vdc_record.get('name'))]
+            if not self._collects('vdc', 'vapp', 'vm'):
+                vdc_records = []
+
+            # VCpuInMhz2 and UsedNetworkCount are not exposed by the vDC query, vDCs are still
+            # fetched one by one but they are few compared to vApps and VMs
+            vdcs = defer.gatherResults([
+                self._vcd_fetch('vdc', get_non_admin_href(vdc_record.get('href')), _parse_vdc, _vdc_summary)
+                for vdc_record in vdc_records
+            ])
+            vdcs.addCallback(lambda vdc_list: self._in_thread(
+                self._vcd_query_samples, org_records, orgs_with_vdcs, vdc_records, vdc_list, vapp_records, vm_records))
+
+            return vdcs
+
+        queries.addCallback(onRecords)
+
+        def onError(err):
+            log("Unable to query vCD: {}".format(err))
+            COLLECTION_ERRORS.labels(self.target, 'query').inc()
+            return []
+
+        queries.addErrback(onError)
+
+        return queries
+
+    def _vcd_query_samples(self, org_records, orgs_with_vdcs, vdc_records, vdc_list, vapp_records, vm_records):
+        """
+        Build samples from query records in org/vDC/vApp/VM order, runs in the thread pool
+        """
+        vdcs_by_org = {}
+        for vdc_record, vdc in zip(vdc_records, vdc_list):
+            vdcs_by_org.setdefault(_href_id(vdc_record.get('org')), []).append(vdc)
+
+        vapps_by_vdc = {}
+        for vapp_record in vapp_records:
+            vapps_by_vdc.setdefault(_href_id(vapp_record.get('vdc')), []).append(vapp_record)
+
+        vms_by_vapp = {}
+        for vm_record in vm_records:
+            vms_by_vapp.setdefault(_href_id(vm_record.get('container')), []).append(vm_record)
+
+        samples = []
+        for org_record in org_records:
+            org_uuid = _href_id(org_record.get('href'))
+            if org_uuid not in orgs_with_vdcs:
+                log("Org has no vDC: {}".format(org_record.get('name')))
+                continue
+
+            org_id = 'urn:vcloud:org:{}'.format(org_uuid)
+            org_name = org_record.get('name')
+            if 'org' in self.levels:
+                samples.append(('vcd_org_is_enabled', (org_id, org_name), _query_bool(org_record.get('isEnabled'))))
+
+            for vdc in vdcs_by_org.get(org_uuid, []):
+                if 'vdc' in self.levels:
+                    samples.extend(self._vcd_vdc_samples(vdc, org_id, org_name))
+                parent_labels = (vdc['id'], vdc['name'], org_id, org_name, vdc['is_enabled'])
+
+                for vapp_record in vapps_by_vdc.get(_href_id(vdc['href']), []):
+                    vapp_uuid = _href_id(vapp_record.get('href'))
+                    vapp_labels = (
+                        'urn:vcloud:vapp:{}'.format(vapp_uuid),
+                        vapp_record.get('name'),
+                        vapp_record.get('isDeployed'),
+                        str(_query_status(vapp_record.get('status'))),
+                    ) + parent_labels
+                    if 'vapp' in self.levels:
+                        samples.append(('vcd_vdc_vapp_status', vapp_labels,
+                                        _query_status(vapp_record.get('status'))))
+                        samples.append(('vcd_vdc_vapp_in_maintenance', vapp_labels,
+                                        _query_bool(vapp_record.get('isInMaintenanceMode'))))
+
+                    vm_parent_labels = vapp_labels[:3] + parent_labels
+                    for vm_record in vms_by_vapp.get(vapp_uuid, []):
+                        vm_labels = (
+                            'urn:vcloud:vm:{}'.format(_href_id(vm_record.get('href'))),
+                            vm_record.get('name'),
+                            vm_record.get('isDeployed'),
+                            str(_query_status(vm_record.get('status'))),
+                        ) + vm_parent_labels
+                        samples.append(('vcd_vdc_vapp_vm_status', vm_labels, _query_status(vm_record.get('status'))))
+                        samples.append(('vcd_vdc_vapp_vm_vcpu', vm_labels, float(vm_record.get('numberOfCpus'))))
+                        samples.append(('vcd_vdc_vapp_vm_allocated_memory_mb', vm_labels,
+                                        float(vm_record.get('memoryMB'))))
+
+        return samples
+
+    @staticmethod
+    def _vcd_vdc_resources_collect(org):
+        return org.list_vdcs(), org.update_org()['IsEnabled']
+
+
+class HealthzResource(Resource):
+    """
+    Class for exporter healthz
+    """
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; charset=UTF-8")
+        request.setResponseCode(200)
+        log("Healthz")
+        return 'Server is UP'.encode()
+
+
+class MetricsResource(Resource):
+    """
+    Class for exporter metrics
+    """
+
+    def render_GET(self, request):
+        openmetrics, gzip = _negotiate(request)
+        output = generate_openmetrics(REGISTRY) if openmetrics else generate_latest(REGISTRY)
+        if gzip:
+            output = b''.join(_gzip_chunks([output]))
+        _set_content_headers(request, openmetrics, gzip)
+        request.setResponseCode(200)
+        log("Metrics")
+        return output
+
+
+class CollectionProfile(object):
+    """
+    Class for profiling one collection: cProfile of the reactor thread and of the calls the
+    collection runs in other threads, the memory tracemalloc sees it allocate, and the wall time
+    of its vCD calls by phase
+    """
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.profilers = []
+        self.phases = {}
+        self.lock = threading.Lock()
+        self.tracing = False
+        self.started = None
+        self.duration = None
+        self.baseline = None
+        self.snapshot = None
+        self.memory = None
+
+    def start(self):
+        # Memory traced before the profile, if any, is left out by comparing with a first snapshot
+        self.tracing = not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start(PROFILE_FRAMES)
+        self.baseline = tracemalloc.take_snapshot()
+        self.started = time.time()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        self.duration = time.time() - self.started
+        self.memory = tracemalloc.get_traced_memory()
+        self.snapshot = tracemalloc.take_snapshot()
+        if self.tracing:
+            tracemalloc.stop()
+
+    def runcall(self, fn, *args):
+        """
+        Run a call of the collection in another thread under a profiler of its own
+        """
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # From Python 3.12 a single profiler runs at a time, the call only shows in the phases
+            return fn(*args)
+        try:
+            return fn(*args)
+        finally:
+            profiler.disable()
+            with self.lock:
+                self.profilers.append(profiler)
+
+    def phase(self, phase, duration, processing):
+        """
+        Record a vCD call of a phase, processing is the part of its duration not spent on HTTP
+        """
+        with self.lock:
+            calls = self.phases.setdefault(phase, [0, 0.0, 0.0])
+            calls[0] += 1
+            calls[1] += duration
+            calls[2] += processing
+
+    def stats(self, sort='cumulative'):
+        return pstats.Stats(self.profiler, *self.profilers).sort_stats(sort)
+
+    def report(self, target, render, size, top=PROFILE_TOP, sort='cumulative'):
+        """
+        Render the profile as text
+        :param render: seconds the output took to render
+        :param size: bytes of the rendered output
+        """
+        lines = [
+            "Collection of {} in {:.3f}s, rendered in {:.3f}s to {} bytes".format(target, self.duration, render, size),
+            "",
+            "vCD calls by phase, concurrent calls overlap",
+            "{:<12}{:>8}{:>12}{:>12}{:>12}".format('phase', 'calls', 'seconds', 'http', 'processing'),
+        ]
+        for phase, (calls, seconds, processing) in sorted(self.phases.items()):
+            lines.append("{:<12}{:>8}{:>12.3f}{:>12.3f}{:>12.3f}".format(
+                phase, calls, seconds, seconds - processing, processing))
+
+        current, peak = self.memory
+        lines.extend([
+            "",
+            "Memory traced: {:.1f} MiB at the end, {:.1f} MiB at the peak".format(
+                current / 2.0 ** 20, peak / 2.0 ** 20),
+            "Top allocations held at the end, by line",
+        ])
+        snapshot = self.snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        lines.extend(str(stat) for stat in snapshot.compare_to(self.baseline, 'lineno')[:top])
+
+        stream = io.StringIO()
+        stats = self.stats(sort)
+        stats.stream = stream
+        stats.print_stats(top)
+        lines.extend(["", "cProfile of the reactor and of the calls in threads, by {}".format(sort), stream.getvalue()])
+        return "\n".join(lines)
+
+
+class DebugProfileResource(Resource):
+    """
+    Class for profiling one collection of a target on demand, guarded by the --debug-token
+    """
+    isLeaf = True
+
+    def __init__(self, vcd, token):
+        Resource.__init__(self)
+        self.vcd = vcd
+        self.token = token
+        self.profiling = False
+
+    def render_GET(self, request):
+        expected = 'Bearer {}'.format(self.token).encode('utf-8')
+        if not hmac.compare_digest(request.getHeader(b'authorization') or b'', expected):
+            request.setResponseCode(403)
+            return "Debug token required".encode()
+
+        target = request.args.get(b'target', [b'default'])[0].decode('utf-8')
+        sort = request.args.get(b'sort', [b'cumulative'])[0].decode('utf-8')
+        dump = request.args.get(b'format', [b'text'])[0] == b'pstats'
+        try:
+            top = int(request.args.get(b'top', [PROFILE_TOP])[0])
+            shard = self.vcd.request_shard(request)
+        except ValueError as err:
+            request.setResponseCode(400)
+            return "Invalid parameter: {}".format(err).encode()
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            request.setResponseCode(400)
+            return "Invalid sort: {}".format(sort).encode()
+
+        settings = self.vcd.configure(target)
+        if settings == 2:
+            return "No Config found for: {}".format(target).encode()
+        if self.profiling:
+            # cProfile and tracemalloc are global to the process
+            request.setResponseCode(409)
+            return "A profile is already running".encode()
+
+        log("Profiling a collection of: {}".format(target))
+        self.profiling = True
+        profile = CollectionProfile()
+        profile.start()
+        # Entity models are left alone, incremental targets are collected in full like on a first scrape
+        result = _collect_target(self.vcd.sessions, {}, target, settings, shard, profile=profile)
+
+        def onSuccess(families):
+            start = time.time()
+            size = len(ExpositionWriter(families).render())
+            render = time.time() - start
+            profile.stop()
+
+            if dump:
+                # Same format as pstats.Stats.dump_stats(), for pstats or snakeviz
+                request.setHeader("Content-Type", "application/octet-stream")
+                return marshal.dumps(profile.stats().stats)
+            request.setHeader("Content-Type", "text/plain; charset=UTF-8")
+            return profile.report(target, render, size, top, sort).encode('utf-8')
+
+        def onError(err):
+            if profile.duration is None:
+                profile.stop()
+            log("Profiled collection failed for {}: {}".format(target, err))
+            request.setHeader("Content-Type", "text/plain; charset=UTF-8")
+            request.setResponseCode(500)
+            return "Collection failed for: {}".format(target).encode()
+
+        def onDone(body):
+            self.profiling = False
+            request.write(body)
+            request.finish()
+
+        result.addCallback(onSuccess)
+        result.addErrback(onError)
+        result.addCallback(onDone)
+
+        return NOT_DONE_YET
+
+
+class VcdConnection:
+    """
+    Class for vCD connection context
+    """
+
+    def __str__(self):
+        return str(self.vcd_client)
+
     def __repr__(self):
         return "<vCD Connection: {}>".format(self.vcd_client)
 
@@ -510,24 +3275,702 @@ class VcdConnection:
         else:
             log("Connection ({}) ERROR: Type: {}, Value: {}, Traceback: {}".format(self, exc_type, exc_val, exc_tb))
 
-    def __init__(self, vcd_user, vcd_org, vcd_password, vcd_host, ignore_ssl):
+    def __init__(self, vcd_user, vcd_org, vcd_password, vcd_host, ignore_ssl, pool_size=MAX_REQUESTS, target=None,
+                 scheduling=None, http_client=HTTP_CLIENTS[0]):
         # Create vCD Client Connection
+        self.target = target or vcd_host
+        # The vCD calls of a connection run in its own threads, a slow vCD only holds up its own targets
+        self.pool = ThreadPool(minthreads=0, maxthreads=pool_size, name='vcd-{}'.format(self.target))
+        self.pool.start()
+        self.shutdown = reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+        self.inflight = 0
+        self.closed = False
+        self.stopped = False
+        self.scheduler = RequestScheduler(self.target, max_requests=pool_size, runner=self.run_in_thread,
+                                          **(scheduling or {}))
+        self.credentials = BasicLoginCredentials(vcd_user, vcd_org, vcd_password)
+        self.key = (vcd_user, vcd_org, vcd_password, vcd_host, ignore_ssl, pool_size,
+                    tuple(sorted((scheduling or {}).items())), http_client)
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
         try:
             self.vcd_client = Client(
                 vcd_host,
                 api_version='31.0',
                 verify_ssl_certs=ignore_ssl
             )
-            self.vcd_client.set_credentials(BasicLoginCredentials(vcd_user, vcd_org, vcd_password))
         except Exception as err:
+            self.vcd_client = None
             self.__exit__(
                 "ConnectionFailed",
                 "126",
                 err
             )
 
+        self.agent = None
+        if http_client == 'agent' and self.vcd_client is not None:
+            self.agent = VcdAgent(self.vcd_client, self.target, pool_size)
+
+    def login(self):
+        """
+        Authenticate the client, blocking until vCD answers
+        """
+        previous = self.vcd_client._session
+        self.vcd_client.set_credentials(self.credentials)
+        if previous is not None:
+            previous.close()
+
+        # Keep one pooled keep-alive connection per concurrent request instead of urllib3's default of 10
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.vcd_client._session.mount('https://', adapter)
+        self.vcd_client._session.mount('http://', adapter)
+        self.vcd_client._session.hooks['response'].append(self.on_response)
+
+        # pyvcloud fills its query link map lazily and not atomically, prime it
+        # before the client is shared by concurrent requests
+        self.vcd_client._get_query_list_map()
+        return self.vcd_client
+
+    def on_response(self, response, *args, **kwargs):
+        """
+        Count and time every vCD API response, called by requests in the worker thread
+        """
+        start = time.time()
+        size = len(response.content or b'')
+        elapsed = response.elapsed.total_seconds() + time.time() - start
+        _http_time.seconds = getattr(_http_time, 'seconds', 0.0) + elapsed
+
+        endpoint = _endpoint(response.request.url)
+        VCD_REQUESTS.labels(self.target, response.request.method, endpoint, str(response.status_code)).inc()
+        VCD_REQUEST_DURATION.labels(self.target, endpoint).observe(elapsed)
+        VCD_RESPONSE_BYTES.labels(self.target, endpoint).inc(size)
+        return response
+
+    def relogin(self, token):
+        """
+        Authenticate again after vCD rejected the session, blocking
+        :param token: authorization token of the rejected session, the first thread to
+                      report it logs in again and the others reuse the new session
+        """
+        with self.lock:
+            if self.vcd_client.get_xvcloud_authorization_token() == token:
+                log("Session expired, authenticating again: {}".format(self))
+                self.login()
+
+    def call(self, fn, *args):
+        """
+        Run a blocking vCD call, authenticating again once if the session expired
+        """
+        token = self.vcd_client.get_xvcloud_authorization_token()
+        try:
+            return fn(*args)
+        except UnauthorizedException:
+            self.relogin(token)
+            return fn(*args)
+
+    def get(self, uri):
+        """
+        GET a vCD resource with the HTTP agent, authenticating again once if the session expired
+        :return: Deferred firing with the body of the response
+        """
+        token = self.vcd_client.get_xvcloud_authorization_token()
+        result = self.agent.get(uri)
+
+        def onError(err):
+            err.trap(UnauthorizedException)
+            return self.run_in_thread(self.relogin, token).addCallback(lambda _: self.agent.get(uri))
+
+        result.addErrback(onError)
+
+        return result
+
     def connection(self):
-        return defer.succeed(self.vcd_client)
+        # Login is a blocking round trip, run it in the thread pool
+        return self.run_in_thread(self.login)
+
+    def run_in_thread(self, fn, *args):
+        """
+        Run a blocking call in the threads of the connection, or in the reactor ones once they are stopped
+        :return: Deferred firing with the result of the call
+        """
+        if self.stopped:
+            return threads.deferToThread(fn, *args)
+        self.inflight += 1
+        return threads.deferToThreadPool(reactor, self.pool, fn, *args).addBoth(self._returned)
+
+    def _returned(self, result):
+        self.inflight -= 1
+        if self.closed and not self.inflight:
+            self._stop()
+        return result
+
+    def close(self, logout=True):
+        """
+        Log out of vCD, the threads of the connection are stopped once the calls in flight are done
+        :return: Deferred firing when logged out
+        """
+        self.closed = True
+        if self.agent is not None:
+            self.agent.close()
+        if logout and self.vcd_client is not None:
+            return self.run_in_thread(self.vcd_client.logout)
+        if not self.inflight:
+            self._stop()
+        return defer.succeed(None)
+
+    def _stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        reactor.removeSystemEventTrigger(self.shutdown)
+        # Joining the threads blocks, do it out of the reactor thread
+        reactor.callInThread(self.pool.stop)
+
+
+@implementer(IPolicyForHTTPS)
+class _UnverifiedPolicy(object):
+    """
+    TLS policy of an agent not verifying the certificate of vCD, like pyvcloud without verify_ssl_certs
+    """
+
+    def creatorForNetloc(self, hostname, port):
+        from twisted.internet import ssl
+        return ssl.CertificateOptions(verify=False)
+
+
+class VcdAgent:
+    """
+    Class for reading vCD resources without a thread per request, on a Twisted Agent that sends at
+    most pool_size requests at a time and keeps their connections to vCD alive between requests.
+    It sends the session headers of a logged in pyvcloud client, so both share one vCD session.
+    """
+
+    def __init__(self, vcd_client, target, pool_size=MAX_REQUESTS, clock=reactor):
+        self.vcd_client = vcd_client
+        self.target = target
+        self.pool = HTTPConnectionPool(clock, persistent=True)
+        # The pool only bounds the idle connections it keeps, the semaphore bounds those in use
+        self.pool.maxPersistentPerHost = pool_size
+        self.connections = defer.DeferredSemaphore(pool_size)
+        # Same certificate check as the pyvcloud client
+        policy = {} if vcd_client._verify_ssl_certs else {'contextFactory': _UnverifiedPolicy()}
+        self.agent = ContentDecoderAgent(Agent(clock, pool=self.pool, **policy), [(b'gzip', GzipDecoder)])
+
+    def get(self, uri):
+        """
+        GET a vCD resource on one of at most pool_size connections, failures raise the same
+        exceptions as pyvcloud
+        :return: Deferred firing with the body of the response
+        """
+        return self.connections.run(self._get, uri)
+
+    def _get(self, uri):
+        client = self.vcd_client
+        headers = Headers({'Accept': ['application/*+xml;version={}'.format(client.get_api_version())]})
+        for name in (client._HEADER_X_VCLOUD_AUTH_NAME, client._HEADER_AUTHORIZATION_NAME):
+            if client._session.headers.get(name):
+                headers.setRawHeaders(name, [client._session.headers[name]])
+
+        start = time.time()
+        result = self.agent.request(b'GET', uri.encode('utf-8'), headers)
+
+        def onResponse(response):
+            return readBody(response).addCallback(lambda body: (response, body))
+
+        result.addCallback(onResponse)
+
+        def onBody(answer):
+            response, body = answer
+            endpoint = _endpoint(uri)
+            VCD_REQUESTS.labels(self.target, 'GET', endpoint, str(response.code)).inc()
+            VCD_REQUEST_DURATION.labels(self.target, endpoint).observe(time.time() - start)
+            VCD_RESPONSE_BYTES.labels(self.target, endpoint).inc(len(body))
+            if response.code == requests.codes.ok:
+                return body
+
+            request_id = response.headers.getRawHeaders(client._HEADER_REQUEST_ID_NAME, [None])[0]
+            client._response_code_to_exception(response.code, request_id,
+                                               objectify.fromstring(body) if body else None)
+
+        result.addCallback(onBody)
+
+        return result
+
+    def close(self):
+        """
+        Close the idle connections, and the others once their request is done
+        """
+        self.pool.persistent = False
+        return self.pool.closeCachedConnections()
+
+
+class VcdSessionManager:
+    """
+    Class for keeping one logged in vCD connection per config section
+    """
+
+    def __init__(self):
+        self.connections = {}
+        self.logins = SingleFlight()
+
+    def connection(self, section, settings):
+        """
+        Get the logged in connection of a section, logging in on first use or when its settings changed
+        :return: Deferred firing with a VcdConnection
+        """
+        key = (settings.get('vcd_user'), settings.get('vcd_org'), settings.get('vcd_password'),
+               settings.get('vcd_host'), settings.get('ignore_ssl'), settings.get('max_requests', MAX_REQUESTS),
+               tuple((name, settings.get(name, default)) for name, default in sorted(SCHEDULER_SETTINGS.items())),
+               _http_client(section, settings)[0])
+        current = self.connections.get(section)
+        if current is not None:
+            if current.key == key:
+                return defer.succeed(current)
+            self.close(section)
+
+        return self.logins.run(section, self._login, section, key)
+
+    def _login(self, section, key):
+        with VcdConnection(*key[:5], pool_size=key[5], target=section, scheduling=dict(key[6]),
+                           http_client=key[7]) as vcd:
+            result = vcd.connection()
+
+        def onSuccess(_):
+            self.connections[section] = vcd
+            return vcd
+
+        def onError(err):
+            vcd.close(logout=False)
+            return err
+
+        result.addCallbacks(onSuccess, onError)
+
+        return result
+
+    def close(self, section):
+        """
+        Drop the session of a section and log it out of vCD
+        """
+        vcd = self.connections.pop(section, None)
+        if vcd is None:
+            return
+
+        def onError(err):
+            log("Unable to logout from vCD: {}".format(err))
+
+        vcd.close().addErrback(onError)
+
+
+class NotificationConsumer:
+    """
+    Class for consuming the vCD notifications of a section from its AMQP broker and applying
+    them to the entity models of the section, connecting again whenever the connection is lost
+    """
+
+    def __init__(self, target, settings, models):
+        self.target = target
+        self.settings = dict(NOTIFICATION_SETTINGS, **settings)
+        self.models = models
+        self.connection = None
+        self.retry = None
+        self.stopped = False
+        # Time since which every notification was received, None while disconnected
+        self.subscribed = None
+
+    def start(self):
+        parameters = pika.URLParameters(self.settings['url'])
+        if parameters.ssl_options is not None:
+            from twisted.internet import ssl
+            endpoint = endpoints.SSL4ClientEndpoint(reactor, parameters.host, parameters.port,
+                                                    ssl.optionsForClientTLS(parameters.host))
+        else:
+            endpoint = endpoints.TCP4ClientEndpoint(reactor, parameters.host, parameters.port)
+
+        result = endpoints.connectProtocol(endpoint, TwistedProtocolConnection(parameters))
+        result.addCallback(lambda connection: connection.ready)
+        result.addCallback(self._subscribe)
+        result.addErrback(self._lost)
+
+    def stop(self):
+        self.stopped = True
+        if self.retry is not None and self.retry.active():
+            self.retry.cancel()
+        if self.connection is not None:
+            self.connection.close()
+
+    def _subscribe(self, connection):
+        """
+        Bind a queue to the notifications of orgs, vDCs, vApps and VMs and consume it
+        """
+        self.connection = connection
+        queue = self.settings['queue']
+        channels = []
+
+        result = connection.channel()
+
+        def onChannel(channel):
+            channels.append(channel)
+            return channel.queue_declare(queue=queue, durable=bool(queue), exclusive=not queue,
+                                         auto_delete=not queue)
+
+        result.addCallback(onChannel)
+
+        def onQueue(frame):
+            name = frame.method.queue
+            bindings = defer.gatherResults([
+                channels[0].queue_bind(queue=name, exchange=self.settings['exchange'], routing_key=key)
+                for key in NOTIFICATION_KEYS
+            ], consumeErrors=True)
+            return bindings.addCallback(lambda _: channels[0].basic_consume(queue=name, auto_ack=True))
+
+        result.addCallback(onQueue)
+
+        def onConsuming(consuming):
+            messages, _ = consuming
+            self.subscribed = time.time()
+            log("Receiving the vCD notifications of: {}".format(self.target))
+            connection.closed.addBoth(self._lost)
+            self._read(messages)
+
+        result.addCallback(onConsuming)
+
+        return result
+
+    def _read(self, messages):
+        def onMessage(message):
+            try:
+                notification = _parse_notification(message.body)
+            except Exception as err:
+                log("Unable to read vCD notification: {}".format(err))
+            else:
+                for (target, _), model in list(self.models.items()):
+                    if target == self.target:
+                        model.notify(notification)
+            # Read the next one from the reactor, a backlog of messages would recurse otherwise
+            reactor.callLater(0, self._read, messages)
+
+        messages.get().addCallbacks(onMessage, self._lost)
+
+    def _lost(self, reason):
+        """
+        Fall back to full collections and connect again later
+        """
+        if self.stopped or (self.retry is not None and self.retry.active()):
+            return
+        if isinstance(reason, failure.Failure):
+            reason = reason.getErrorMessage()
+        log("vCD notifications of {} not received, connecting again in {}s: {}".format(
+            self.target, NOTIFICATION_RETRY, reason))
+        self.subscribed = None
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+        self.connection = None
+        self.retry = reactor.callLater(NOTIFICATION_RETRY, self.start)
+
+
+class UsageCollector:
+    """
+    Class for the VM usage metrics of a target and shard, fetched from the vCD metrics API apart
+    from the inventory collection, on their own interval, and cached in between
+    """
+
+    def __init__(self, target, settings, sessions):
+        self.target = target
+        self.settings = settings
+        self.sessions = sessions
+        self.key = self.settings_key(settings)
+        self.interval, limit = self.key
+        self.requests = defer.DeferredSemaphore(limit)
+        self.labels = []
+        self.vms = []
+        self.families = []
+        self.refreshing = SingleFlight()
+        self.loop = task.LoopingCall(self.refresh)
+
+    @staticmethod
+    def settings_key(settings):
+        """
+        Settings a collector is created again for when they change
+        """
+        return (float(settings.get('usage_interval', USAGE_INTERVAL)),
+                int(settings.get('max_usage_requests', MAX_USAGE_REQUESTS)))
+
+    def update(self, families):
+        """
+        Take the VMs of a collection as the ones to fetch usage for, the first time starts the refreshes
+        """
+        self.vms = []
+        for family in families:
+            if family.name == 'vcd_vdc_vapp_vm_status':
+                self.labels = family.labels
+                self.vms = [labels for labels, _ in family.samples]
+        if not self.loop.running:
+            self.loop.start(self.interval, now=True)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def refresh(self):
+        """
+        Fetch the current usage of every VM, at most max_usage_requests at a time and after the
+        requests of the inventory collections of the same session, concurrent calls share one refresh
+        :return: Deferred firing once the cached families were replaced
+        """
+        return self.refreshing.run(self.target, self._refresh)
+
+    def _refresh(self):
+        vms = self.vms
+        start = time.time()
+        result = self.sessions.connection(self.target, self.settings)
+
+        def onConnected(vcd_connection):
+            api = vcd_connection.vcd_client.get_api_uri()
+            if vcd_connection.agent is not None:
+                run = vcd_connection.scheduler.prioritized(USAGE_PRIORITY, runner=defer.maybeDeferred)
+            else:
+                run = vcd_connection.scheduler.prioritized(USAGE_PRIORITY)
+
+            def fetch(labels):
+                href = '{}/vApp/vm-{}/metrics/current'.format(api, labels[0].rsplit(':', 1)[-1])
+                if vcd_connection.agent is not None:
+                    fetched = self.requests.run(run, vcd_connection.get, href)
+                    fetched.addCallback(lambda body: vcd_connection.run_in_thread(_parse_usage, body))
+                else:
+                    fetched = self.requests.run(run, vcd_connection.call, self._vcd_usage, vcd_connection.vcd_client,
+                                                href)
+
+                def onError(err):
+                    log("Unable to get the usage of VM {}: {}".format(labels[0], err.getErrorMessage()))
+                    COLLECTION_ERRORS.labels(self.target, 'usage').inc()
+                    return []
+
+                return fetched.addErrback(onError)
+
+            return defer.gatherResults([fetch(labels) for labels in vms])
+
+        result.addCallback(onConnected)
+
+        def onFetched(usages):
+            families = {}
+            for labels, metrics in zip(vms, usages):
+                for metric, unit, value in metrics:
+                    name = _usage_family_name(metric, unit)
+                    if name not in families:
+                        families[name] = GaugeFamily(name, 'vCD {} metric of VM in {}'.format(metric, unit),
+                                                     labels=self.labels)
+                    try:
+                        families[name].add_metric(labels, float(value) * USAGE_UNITS.get(unit, ('', 1))[1])
+                    except (TypeError, ValueError):
+                        continue
+
+            timestamp = GaugeFamily('vcd_vm_usage_timestamp_seconds', 'Time the VM usage metrics were fetched at')
+            timestamp.add_metric((), time.time())
+            self.families = [families[name] for name in sorted(families)] + [timestamp]
+
+            for name, family in families.items():
+                SERIES.labels(self.target, name).set(len(family.samples))
+            PHASE_DURATION.labels(self.target, 'usage').observe(time.time() - start)
+            log("Fetched the usage of {} VMs of: {}".format(len(vms), self.target))
+
+        result.addCallback(onFetched)
+
+        def onError(err):
+            # Keep the previous usage and the refresh loop going
+            log("VM usage refresh failed for {}: {}".format(self.target, err.getErrorMessage()))
+
+        result.addErrback(onError)
+
+        return result
+
+    @staticmethod
+    def _vcd_usage(vcd_client, href):
+        """
+        Fetch and read the current usage of a VM, runs in the thread pool
+        """
+        return _parse_usage(_get_raw(vcd_client, href))
+
+
+class WorkerPool:
+    """
+    Class for the worker processes collecting targets, or org partitions of a target, outside of
+    the process serving HTTP so that parsing the vCD XML can use more than one core
+    """
+
+    def __init__(self, size, timeout=WORKER_TIMEOUT, threads=25):
+        self.size = size
+        self.timeout = timeout
+        self.threads = threads
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = [None] * size
+        self.locks = [threading.Lock() for _ in range(size)]
+        # Last value of each worker metric gauge by worker
+        self.gauges = {}
+        self.gauges_lock = threading.Lock()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def _start(self, index):
+        connection, child = self.context.Pipe()
+        process = self.context.Process(target=_worker_main, args=(child, self.threads),
+                                       name='vcd_exporter-worker-{}'.format(index), daemon=True)
+        process.start()
+        child.close()
+        self.workers[index] = (process, connection)
+        log("Started collection worker {}: pid {}".format(index, process.pid))
+        return self.workers[index]
+
+    def _stop(self, index, reason):
+        process, connection = self.workers[index]
+        self.workers[index] = None
+        connection.close()
+        if process.is_alive():
+            # A hung worker may not get to handle SIGTERM
+            os.kill(process.pid, signal.SIGKILL)
+        process.join(5)
+        self._add_metrics(index, [])
+        WORKER_RESTARTS.labels(reason).inc()
+        log("Stopped collection worker {} ({}): pid {}".format(index, reason, process.pid))
+
+    def run(self, index, job):
+        """
+        Run a job in a worker, blocking, a worker that died is started again and one that does not
+        answer within the timeout is killed
+        :return: list of (name, documentation, labels, samples) tuples of the families collected
+        """
+        with self.locks[index]:
+            if self.workers[index] is not None and not self.workers[index][0].is_alive():
+                self._stop(index, 'crashed')
+            process, connection = self.workers[index] or self._start(index)
+
+            try:
+                connection.send(job)
+                if not connection.poll(self.timeout):
+                    self._stop(index, 'hung')
+                    raise Exception("Collection worker {} hung on: {}".format(index, job[0]))
+                status, payload, metrics = connection.recv()
+            except (EOFError, OSError):
+                if self.workers[index] is not None:
+                    self._stop(index, 'crashed')
+                raise Exception("Collection worker {} died on: {}".format(index, job[0]))
+            self._add_metrics(index, metrics)
+
+        if status != 'ok':
+            raise Exception(payload)
+        return payload
+
+    def _add_metrics(self, index, metrics):
+        """
+        Add the metric changes sent by a worker to the metrics of the exporter process, the gauges
+        of a worker that is not sent are dropped
+        :param metrics: list of changes from _worker_metrics()
+        """
+        with self.gauges_lock:
+            changed = set()
+            for key, by_worker in self.gauges.items():
+                if by_worker.pop(index, None) is not None:
+                    changed.add(key)
+
+            for metric_index, labels, values in metrics:
+                metric, merge = WORKER_METRICS[metric_index]
+                if merge is not None:
+                    self.gauges.setdefault((metric_index, labels), {})[index] = values[0]
+                    changed.add((metric_index, labels))
+                elif isinstance(metric, Histogram):
+                    child = metric.labels(*labels)
+                    for bucket, count in zip(child._buckets, values):
+                        bucket.inc(count)
+                    child._sum.inc(values[-1])
+                else:
+                    metric.labels(*labels).inc(values[0])
+
+            for metric_index, labels in changed:
+                metric, merge = WORKER_METRICS[metric_index]
+                by_worker = self.gauges[(metric_index, labels)]
+                if by_worker:
+                    metric.labels(*labels).set(merge(by_worker.values()))
+                else:
+                    del self.gauges[(metric_index, labels)]
+                    metric.remove(*labels)
+
+    def collect(self, target, settings, shard):
+        """
+        Collect a target in the workers, each worker takes one partition of its orgs, query
+        collections are not partitioned as every partition would fetch the same query pages
+        :return: Deferred firing with the merged list of GaugeFamily
+        """
+        start = datetime.utcnow()
+        if settings.get('collection_backend') == 'query' or self.size == 1:
+            # Always the same worker for a target so that it keeps its session
+            jobs = {_shard_of(target, self.size): (0, 1)}
+        else:
+            jobs = {index: (index, self.size) for index in range(self.size)}
+            settings = _partition_settings(settings, self.size)
+
+        result = defer.gatherResults([
+            threads.deferToThread(self.run, index, (target, settings, shard, partition))
+            for index, partition in sorted(jobs.items())
+        ], consumeErrors=True)
+
+        def onCollected(results):
+            # Partitions hold the same families in the same order
+            families = [GaugeFamily(name, documentation, labels) for name, documentation, labels, _ in results[0]]
+            for partition in results:
+                for family, (_, _, _, samples) in zip(families, partition):
+                    family.samples.extend(samples)
+
+            for family in families:
+                SERIES.labels(target, family.name).set(len(family.samples))
+            COLLECTION_DURATION.labels(target).observe((datetime.utcnow() - start).total_seconds())
+            return families
+
+        result.addCallback(onCollected)
+
+        def onError(err):
+            err.trap(defer.FirstError)
+            return err.value.subFailure
+
+        result.addErrback(onError)
+
+        return result
+
+    def close(self):
+        for index in range(self.size):
+            if self.workers[index] is not None:
+                process, connection = self.workers[index]
+                self.workers[index] = None
+                connection.close()
+                process.terminate()
+
+
+def _worker_main(connection, pool_size):
+    """
+    Main loop of a collection worker process, it runs its own reactor in a thread and keeps its
+    own vCD sessions and entity models between jobs
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    reactor.suggestThreadPoolSize(pool_size)
+    threading.Thread(target=reactor.run, kwargs={'installSignalHandlers': False}, daemon=True).start()
+
+    sessions = VcdSessionManager()
+    models = {}
+    sent = {}
+    while True:
+        try:
+            target, settings, shard, partition = connection.recv()
+        except EOFError:
+            break
+
+        try:
+            families = threads.blockingCallFromThread(
+                reactor, _collect_target, sessions, models, target, settings, shard, partition)
+            connection.send(('ok', [(family.name, family.documentation, family.labels, family.samples)
+                                    for family in families], _worker_metrics(sent)))
+        except Exception as err:
+            connection.send(('error', "Collection failed in worker: {}".format(err), _worker_metrics(sent)))
+
+    reactor.callFromThread(reactor.stop)
 
 
 def main(argv=None):
@@ -540,16 +3983,49 @@ def main(argv=None):
                         default=None, help="configuration file")
     parser.add_argument('-p', '--port', dest='port', type=int,
                         default=9274, help="HTTP port to expose metrics")
+    parser.add_argument('-t', '--threads', dest='threads', type=int,
+                        default=25, help="size of the shared thread pool waiting on workers and state files")
+    parser.add_argument('--shard-index', dest='shard_index', type=int,
+                        default=0, help="shard of the orgs collected by this exporter, from 0")
+    parser.add_argument('--shard-count', dest='shard_count', type=int,
+                        default=1, help="number of exporters the orgs are spread over")
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        default=0, help="worker processes collecting targets, 0 collects in the exporter process")
+    parser.add_argument('--worker-timeout', dest='worker_timeout', type=float,
+                        default=WORKER_TIMEOUT, help="seconds after which a busy worker process is restarted")
+    parser.add_argument('--state-dir', dest='state_dir',
+                        default=None, help="directory the last collections are saved in and restored from on start")
+    parser.add_argument('--debug-token', dest='debug_token',
+                        default=None, help="enables /debug/profile for requests bearing this token")
 
     args = parser.parse_args(argv or sys.argv[1:])
+    try:
+        _shard(args.shard_index, args.shard_count)
+    except ValueError as err:
+        parser.error(str(err))
+    if args.workers < 0:
+        parser.error("Workers must not be negative, got: {}".format(args.workers))
 
-    # Flag for improvements
-    # reactor.suggestThreadPoolSize(25)
+    # vCD requests run in the thread pool of their connection, this one waits on workers and writes state files
+    reactor.suggestThreadPoolSize(args.threads)
 
     root = Resource()
     root.putChild(b'healthz', HealthzResource())
     root.putChild(b'metrics', MetricsResource())
-    root.putChild(b'vcd', VcdApplicationResource(args))
+    vcd = VcdApplicationResource(args)
+    vcd.putChild(b'all', VcdAllResource(vcd))
+    root.putChild(b'vcd', vcd)
+    if args.debug_token:
+        debug = Resource()
+        debug.putChild(b'profile', DebugProfileResource(vcd, args.debug_token))
+        root.putChild(b'debug', debug)
+
+    REGISTRY.register(SnapshotCollector(vcd))
+    vcd.restore()
+    vcd.start_schedules()
+
+    # Reload the configuration on SIGHUP
+    signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(vcd.reload_config))
 
     factory = Site(root)
     endpoint = endpoints.TCP4ServerEndpoint(reactor, args.port)